@@ -0,0 +1,4 @@
+import time
+
+# When assh started being imported, so timings can include import time
+STARTED_AT = time.perf_counter()
@@ -1,56 +1,411 @@
+import contextlib
 import datetime
+import fcntl
 import json
+import logging
 import os
+import subprocess
+import sys
 
+from pathlib import Path
+from typing import List, Optional, Sequence
+
+from assh.collector import get_collector
+from assh.config import Target, current_profile
+from assh.credentials import role_account, role_name
 from assh.exceptions import TooManyResultsException, NoResultsException
-from assh.instance import Instance, get_instances as _get_fresh_instances
+from assh.images import ImageCache
+from assh.instance import (
+    SSM_UNREGISTERED,
+    Instance,
+    get_instances as _get_fresh_instances,
+    get_launched_since as _get_launched_since,
+    get_running_ids as _get_running_ids,
+    get_ssm_ping_statuses as _get_ssm_ping_statuses,
+)
+from assh.store import read_shard, remove_legacy_cache, write_shard
+from assh.timings import span
+
+# Fetches spend nearly all their time waiting on AWS, and there's one per
+# account and region. Each gets its own thread, up to this many (the
+# fetch-workers cache option), so a cold refresh of that many targets takes
+# about as long as the slowest. Beyond it, targets queue for a free thread.
+MAX_FETCH_WORKERS = 64
+
+# Seconds of leeway for the local clock being ahead of AWS's launch times
+CLOCK_SKEW = 300
+
+# How long to remember instances which have disappeared, in seconds
+TOMBSTONE_TTL = 24 * 60 * 60
+
+
+def _shard_name(target: Target) -> str:
+    region = target.region or "default"
+    if target.role:
+        return f"{role_account(target.role)}-{role_name(target.role)}-{region}"
+
+    profile = target.profile or current_profile() or "default"
+    return f"{profile}-{region}"
+
+
+def _shard_age(shard) -> float:
+    now = datetime.datetime.now(datetime.timezone.utc)
+    fetched_at = datetime.datetime.fromtimestamp(
+        shard.fetched_at if shard is not None else 0, tz=datetime.timezone.utc
+    )
+    return (now - fetched_at).total_seconds()
+
+
+@contextlib.contextmanager
+def _shard_lock(cache_dir: Path, target: Target, blocking: bool = True):
+    """Serialise refreshes of a shard across assh processes.
+
+    Yields whether the lock was acquired, which is always True when blocking.
+    """
+    lock_path = cache_dir / f"instances-{_shard_name(target)}.lock"
+    with open(lock_path, "a") as lock_file:
+        flags = fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+        try:
+            fcntl.flock(lock_file, flags)
+        except BlockingIOError:
+            yield False
+            return
+
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _fetch_target(target: Target) -> List[Instance]:
+    logging.info("Fetching instances for %s", target)
+    return _get_fresh_instances(
+        profile=target.profile, region=target.region, role=target.role
+    )
+
+
+def _reconcile_target(target: Target, shard) -> List[Instance]:
+    """Bring a cached shard up to date by fetching only what changed.
+
+    Instances which have stopped are dropped, and only instances which have
+    started since the shard was written are described in full. That includes
+    instances which were stopped and started again in between, as their
+    public IP has usually changed.
+    """
+    logging.info("Reconciling instances for %s", target)
+    running_ids = _get_running_ids(
+        profile=target.profile, region=target.region, role=target.role
+    )
+    relaunched = _get_launched_since(
+        profile=target.profile,
+        region=target.region,
+        since=shard.fetched_at - CLOCK_SKEW,
+        role=target.role,
+    )
+    running_ids.difference_update(instance.id for instance in relaunched)
+
+    kept = []
+    for position in range(len(shard)):
+        instance = shard.instance(position)
+        if instance.id in running_ids:
+            kept.append(instance)
+            running_ids.discard(instance.id)
+
+    added = []
+    if running_ids:
+        added = _get_fresh_instances(
+            profile=target.profile,
+            region=target.region,
+            instance_ids=sorted(running_ids),
+            role=target.role,
+        )
+
+    return kept + relaunched + added
+
+
+def _record_ssm_pings(target: Target, instances: List[Instance]):
+    """Store whether each instance can currently be reached through SSM."""
+    from botocore.exceptions import BotoCoreError, ClientError
+
+    try:
+        statuses = _get_ssm_ping_statuses(
+            profile=target.profile, region=target.region, role=target.role
+        )
+    except (BotoCoreError, ClientError) as exc:
+        # Keep whatever was known before, rather than failing the refresh
+        logging.warning("Couldn't fetch SSM status for %s: %s", target, exc)
+        return
+
+    for instance in instances:
+        instance.ssm_ping = statuses.get(instance.id, SSM_UNREGISTERED)
+
+
+def _tombstones(shard, instances: List[Instance], now: float) -> dict:
+    """Record when each instance which has disappeared from a shard was last seen.
+
+    Tombstones are kept for TOMBSTONE_TTL seconds.
+    """
+    tombstones = {} if shard is None else dict(shard.meta.get("tombstones", {}))
+    current_ids = {instance.id for instance in instances}
+
+    if shard is not None:
+        for position in range(len(shard)):
+            instance_id = shard.field(position, "id")
+            if instance_id not in current_ids:
+                tombstones[instance_id] = now
+
+    return {
+        instance_id: removed_at
+        for instance_id, removed_at in tombstones.items()
+        if instance_id not in current_ids and now - removed_at <= TOMBSTONE_TTL
+    }
+
+
+def _refresh_target(
+    cache_dir: Path,
+    target: Target,
+    ttl: float,
+    blocking: bool,
+    search_tags: Sequence[str] = (),
+    shard_format: str = "binary",
+    incremental: bool = False,
+    full_refresh_interval: float = 3600,
+    ssm_status: bool = False,
+):
+    name = _shard_name(target)
+    with _shard_lock(cache_dir, target, blocking) as acquired:
+        if not acquired:
+            logging.info("Refresh of %s already in progress", target)
+            return None
+
+        # Another process may have refreshed the shard while we waited
+        shard = read_shard(cache_dir, name, shard_format)
+        if shard is not None and _shard_age(shard) <= ttl:
+            return shard
+
+        now = datetime.datetime.now(datetime.timezone.utc).timestamp()
+        full_refresh_at = now
+        if shard is not None:
+            full_refresh_at = shard.meta.get("full_refresh_at", shard.fetched_at)
 
+        # Changes to instances which keep running (tags, IPs) are only picked
+        # up by a full refresh, so one is still made every so often
+        if incremental and shard is not None and (
+            now - full_refresh_at <= full_refresh_interval
+        ):
+            instances = _reconcile_target(target, shard)
+        else:
+            instances = _fetch_target(target)
+            full_refresh_at = now
+
+        # Ping statuses change without the instance changing, so they're
+        # fetched afresh on every refresh, incremental or not
+        if ssm_status:
+            _record_ssm_pings(target, instances)
+
+        meta = {
+            "full_refresh_at": full_refresh_at,
+            "tombstones": _tombstones(shard, instances, now),
+        }
+        return write_shard(
+            cache_dir,
+            name,
+            shard_format,
+            now,
+            [instance.to_dict() for instance in instances],
+            search_tags,
+            meta,
+        )
+
+
+def _refresh_or_skip(cache_dir: Path, target: Target, *args, **refresh_options):
+    """Refresh a target, leaving roles which can't be used out of the inventory.
+
+    One account out of hundreds denying access shouldn't stop assh finding
+    instances in all the others.
+    """
+    from botocore.exceptions import BotoCoreError, ClientError
+
+    try:
+        with span("refresh", shard=_shard_name(target)):
+            return _refresh_target(cache_dir, target, *args, **refresh_options)
+    except (BotoCoreError, ClientError) as exc:
+        if target.role is None:
+            raise
+        logging.warning("Couldn't refresh %s: %s", target, exc)
+        return None
+
+
+def refresh_instances(
+    cache_dir: Path,
+    targets: List[Target],
+    ttl: float = 0,
+    blocking: bool = True,
+    ssh_config: Optional[str] = None,
+    fetch_workers: int = MAX_FETCH_WORKERS,
+    **refresh_options,
+) -> dict:
+    """Refresh the shards of the given targets concurrently.
+
+    Without blocking, targets being refreshed by another process are skipped.
+    With ssh_config set, the inventory is rendered to that path afterwards.
+    At most fetch_workers targets are fetched at once.
+    """
+    from concurrent.futures import ThreadPoolExecutor
 
-def get_instances(cache_dir):
     if not cache_dir.exists():
         os.makedirs(cache_dir)
+    remove_legacy_cache(cache_dir)
 
-    region_suffix = "default"
-    cache_path = cache_dir / f"instances-{region_suffix}.json"
-    cached_response = {}
-    instances = []
+    workers = max(min(len(targets), fetch_workers), 1)
+    # Every fetching thread may be waiting on an API call at once
+    get_collector().reserve_workers(workers)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(
+            lambda target: _refresh_or_skip(
+                cache_dir, target, ttl, blocking, **refresh_options
+            ),
+            targets,
+        )
+        refreshed = {
+            target: shard
+            for target, shard in zip(targets, results)
+            if shard is not None
+        }
+
+    # Resolve every image in the inventory now, so username resolution
+    # never has to call describe_images when connecting
+    ImageCache(cache_dir).prefetch(
+        shard.instance(position)
+        for shard in refreshed.values()
+        for position in range(len(shard))
+    )
+
+    if ssh_config and refreshed:
+        # Imported here, as rendering depends on this module
+        from assh.inventory import update_ssh_config
+
+        with span("render ssh_config"):
+            update_ssh_config(cache_dir, Path(ssh_config))
 
-    if cache_path.exists():
-        with open(cache_path) as cache_file:
-            cached_response = json.load(cache_file)
+    return refreshed
 
-    cache_updated = datetime.datetime.fromtimestamp(
-        cached_response.get("fetched_at", 0), tz=datetime.timezone.utc
+
+def _spawn_refresher(cache_dir: Path, targets: List[Target], refresh_options: dict):
+    logging.info("Refreshing %s in the background", targets)
+    subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "assh.refresh",
+            str(cache_dir),
+            json.dumps({"targets": targets, "options": refresh_options}),
+        ],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        # Detach, so the refresh outlives this process handing over to ssh
+        start_new_session=True,
     )
-    now = datetime.datetime.now(datetime.timezone.utc)
 
-    if cache_updated < (now - datetime.timedelta(minutes=1)):
-        instances = _get_fresh_instances()
 
-        with open(cache_path, "w+") as cache_file:
-            json.dump(
-                {
-                    "fetched_at": now.timestamp(),
-                    "instances": [instance.to_dict() for instance in instances],
-                },
-                cache_file,
+def _load_shards(
+    cache_dir: Path,
+    targets: Optional[List[Target]] = None,
+    ttl: float = 60,
+    max_stale: float = 3600,
+    stale_while_revalidate: bool = False,
+    **refresh_options,
+) -> dict:
+    """Load each target's shard, refreshing those which have expired.
+
+    Targets without a usable shard, like roles which couldn't be refreshed,
+    are left out of the result.
+    """
+    if not cache_dir.exists():
+        os.makedirs(cache_dir)
+
+    targets = targets or [Target()]
+    shard_format = refresh_options.get("shard_format", "binary")
+    with span("read cache", shards=len(targets)):
+        shards = {
+            target: read_shard(cache_dir, _shard_name(target), shard_format)
+            for target in targets
+        }
+
+    expired = []
+    revalidate = []
+    for target, shard in shards.items():
+        age = _shard_age(shard)
+        if age <= ttl:
+            continue
+
+        if stale_while_revalidate and shard is not None and age <= max_stale:
+            revalidate.append(target)
+        else:
+            expired.append(target)
+
+    if expired:
+        shards.update(refresh_instances(cache_dir, expired, ttl, **refresh_options))
+
+    if revalidate:
+        _spawn_refresher(cache_dir, revalidate, refresh_options)
+
+    return {
+        target: shards[target] for target in targets if shards[target] is not None
+    }
+
+
+def _unique(instances):
+    # The same account can be reachable through several profiles
+    seen = set()
+    for instance in instances:
+        if instance.id not in seen:
+            seen.add(instance.id)
+            yield instance
+
+
+def get_instances(cache_dir, targets: Optional[List[Target]] = None, **options):
+    shards = _load_shards(cache_dir, targets, **options)
+    return list(
+        _unique(
+            shard.instance(position)
+            for shard in shards.values()
+            for position in range(len(shard))
+        )
+    )
+
+
+def find_instances(
+    cache_dir, query, targets: Optional[List[Target]] = None, **options
+) -> List[Instance]:
+    search_tags = options.get("search_tags", ())
+    shards = _load_shards(cache_dir, targets, **options)
+
+    with span("search"):
+        return list(
+            _unique(
+                shard.instance(position)
+                for shard in shards.values()
+                for position in shard.search_index(search_tags).search(query)
             )
-    else:
-        instances = [
-            Instance.from_dict(instance) for instance in cached_response["instances"]
-        ]
+        )
+
 
-    return instances
+def recently_removed(
+    cache_dir, instance_id: str, targets: Optional[List[Target]] = None, **options
+) -> bool:
+    """Whether an instance left the inventory within the last TOMBSTONE_TTL.
 
+    Only running instances are cached, so it may just have been stopped.
+    """
+    shards = _load_shards(cache_dir, targets, **options)
+    return any(
+        instance_id in shard.meta.get("tombstones", {}) for shard in shards.values()
+    )
 
-def get_instance(cache_dir, query):
-    instances = get_instances(cache_dir)
-    matched = [
-        instance
-        for instance in instances
-        if (query in instance.id or query.lower() in instance.name.lower())
-    ]
 
+def single_instance(matched: List[Instance], query: str) -> Instance:
     if len(matched) > 1:
         raise TooManyResultsException(
             f"Query was too vague, {len(matched)} results were returned"
@@ -60,3 +415,7 @@ def get_instance(cache_dir, query):
         raise NoResultsException(f"No results could be found with query term '{query}'")
 
     return matched[0]
+
+
+def get_instance(cache_dir, query, targets: Optional[List[Target]] = None, **options):
+    return single_instance(find_instances(cache_dir, query, targets, **options), query)
@@ -1,31 +1,197 @@
 #!/usr/bin/env python3
 import contextlib
+import datetime
+import json
 import logging
 import os
 import random
 import signal
 import string
 import subprocess
+import sys
+import time
 
 from pathlib import Path
 
 import click
-import yaml
 
-from .ssh_config import SSHConfig
-from .caching import get_instance, get_instances
+from .ssh_config import SSHConfig, control_socket_name
+from . import daemon, timings
+from .caching import find_instances, recently_removed, single_instance
+from .connection import (
+    aws_cli_args,
+    aws_cli_env,
+    destination_settings,
+    jump_settings,
+    resolve_key_path,
+    resolve_mode,
+)
+from .exceptions import NoResultsException, NoRouteException, TooManyResultsException
+from .fanout import Result, run_parallel, summarise
+from .history import History
+from .matching import exact_match, rank, still_matches
+from .query import parse_query
+from .multiplexing import close_master, control_dir, list_masters, register_master
+from .tunnels import close_tunnel, list_tunnels, open_tunnel
+from .images import ImageCache
+from .usernames import UsernameResolver
+from .config import (
+    CACHE_DIR,
+    CONFIG_PATH,
+    TOOL_DIR,
+    get_cache_options,
+    get_daemon_options,
+    get_matching_options,
+    get_targets,
+    load_config,
+)
+
+
+def _find_instances(config, query):
+    """Search the daemon's inventory when it's running, otherwise the cache."""
+    with timings.span("daemon lookup"):
+        instances = daemon.find_instances(query)
+    if instances is not None:
+        return instances
+
+    if get_daemon_options(config)["enabled"]:
+        daemon.spawn()
+
+    return find_instances(
+        CACHE_DIR, query, get_targets(config), **get_cache_options(config)
+    )
+
+
+def _interactive():
+    return sys.stdin.isatty() and sys.stderr.isatty()
+
+
+def _pick_instance(ranked, heading):
+    click.echo(heading, err=True)
+    for number, instance in enumerate(ranked, start=1):
+        name = instance.name or "-"
+        line = f"{number:>3}) {name}\t{instance.id}\t{instance.private_ip}"
+        click.echo(line, err=True)
+
+    choice = click.prompt(
+        "Connect to", type=click.IntRange(1, len(ranked)), default=1, err=True
+    )
+    return ranked[choice - 1]
+
+
+def _get_instance(config, query, last_used=None):
+    """Find the instance a query means, ranking the matches when it's ambiguous.
+
+    Queries matching nothing as typed are retried word by word, and fuzzily,
+    against every instance. Several matches are offered in a picker, best
+    first, when running interactively, as are any found by that retry, even
+    alone, so a typo never connects anywhere unasked. last_used favours
+    recently used instances when ranking.
+    """
+    instances = _find_instances(config, query)
+    if len(instances) == 1:
+        return instances[0]
+
+    chosen = exact_match(instances, query)
+    if chosen is not None:
+        return chosen
+
+    # Structured queries are only ranked by their free text, and aren't
+    # loosened when they match nothing
+    parsed = parse_query(query)
+    loosened = not instances and not parsed.terms
+    if loosened:
+        instances = _find_instances(config, "")
+
+    options = get_matching_options(config)
+    with timings.span("rank"):
+        ranked = rank(
+            instances,
+            parsed.text,
+            options["max_results"],
+            get_cache_options(config)["search_tags"],
+            last_used,
+        )
+    if not ranked or (len(ranked) == 1 and not loosened):
+        return single_instance(ranked, query)
+
+    if not (options["interactive"] and _interactive()):
+        labels = ", ".join(_instance_labels(ranked))
+        if loosened:
+            raise NoResultsException(
+                f"No results could be found with query term '{query}',"
+                f" did you mean: {labels}"
+            )
+        raise TooManyResultsException(
+            f"Query was too vague, the best matches were: {labels}"
+        )
+
+    if loosened:
+        heading = f"'{query}' matched nothing, did you mean:"
+    else:
+        heading = f"'{query}' matched several instances:"
+    return _pick_instance(ranked, heading)
 
-TOOL_DIR = Path.home() / ".assh"
 
-CONFIG_PATH = TOOL_DIR / "config.yaml"
-CACHE_DIR = TOOL_DIR / "cache"
+LAST_HOST = "-"
+
+
+def _cached_instance(config, instance_id):
+    """The instance with this ID in the inventory, if it's still there."""
+    # IDs are looked up exactly, so only this instance is decoded
+    found = [
+        instance
+        for instance in _find_instances(config, instance_id)
+        if instance.id == instance_id
+    ]
+    return found[0] if found else None
+
+
+def _recall_instance(config, history, instance_id):
+    """An instance from the history, forgetting it if it no longer exists.
+
+    Instances which only recently left the inventory are kept, as they may
+    have been stopped and be started again.
+    """
+    instance = _cached_instance(config, instance_id)
+    if instance is None and not recently_removed(
+        CACHE_DIR, instance_id, get_targets(config), **get_cache_options(config)
+    ):
+        logging.info("Forgetting %s, which no longer exists", instance_id)
+        history.forget(instance_id)
+    return instance
+
+
+def _resolve_instance(config, query, history):
+    """Find the instance a query means, trying what it meant last time first.
+
+    The query "-" means the instance connected to most recently.
+    """
+    if query == LAST_HOST:
+        # Skipping any which have gone, or are stopped, for the one before
+        last_used = history.last_used()
+        for instance_id in sorted(last_used, key=last_used.get, reverse=True):
+            instance = _recall_instance(config, history, instance_id)
+            if instance is not None:
+                return instance
+        raise NoResultsException("There is no previous instance to connect to")
+
+    instance_id = history.remembered(query)
+    if instance_id is not None:
+        instance = _recall_instance(config, history, instance_id)
+        tag_keys = get_cache_options(config)["search_tags"]
+        if instance is not None and still_matches(instance, query, tag_keys):
+            return instance
+        if instance is not None:
+            history.forget_query(query)
+
+    return _get_instance(config, query, history.last_used())
 
 
 def _autocomplete_instances(ctx, args, incomplete):
+    config = load_config(CONFIG_PATH)
     return [
-        (instance.id, instance.name)
-        for instance in get_instances(CACHE_DIR)
-        if (incomplete in instance.id or incomplete.lower() in instance.name.lower())
+        (instance.id, instance.name) for instance in _find_instances(config, incomplete)
     ]
 
 
@@ -46,12 +212,202 @@ def ignore_user_entered_signals():
             signal.signal(user_signal, actual_signals[sig])
 
 
-@click.command()
+REMOTE_COMMAND = "assh.remote_command"
+
+
+class DefaultGroup(click.Group):
+    """A group which runs its default command when no subcommand is given.
+
+    This keeps `assh <query>` working alongside subcommands like `assh masters`.
+    A query starting with a subcommand's name needs `assh connect <query>`.
+    """
+
+    def __init__(self, *args, default_command=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.default_command = default_command
+
+    def parse_args(self, ctx, args):
+        # Keep everything after -- verbatim, as the command to run remotely
+        if "--" in args:
+            split = args.index("--")
+            ctx.meta[REMOTE_COMMAND] = args[split + 1 :]
+            args = args[:split]
+
+        # The group's own flags, like --timings, come before any command
+        group_flags = {opt for param in self.params for opt in param.opts}
+        start = 0
+        while start < len(args) and args[start] in group_flags:
+            start += 1
+
+        rest = args[start:]
+        if not rest or (rest[0] not in self.commands and rest[0] != "--help"):
+            args = [*args[:start], self.default_command, *rest]
+        return super().parse_args(ctx, args)
+
+
+@click.group(cls=DefaultGroup, default_command="connect")
+@click.option(
+    "--timings",
+    "show_timings",
+    is_flag=True,
+    envvar="ASSH_TIMINGS",
+    help="Show how long each phase took, when assh exits",
+)
+@click.option(
+    "--timings-log",
+    is_flag=True,
+    envvar="ASSH_TIMINGS_LOG",
+    help="Append each phase's timing to ~/.assh/timings.jsonl",
+)
+@click.option(
+    "--cprofile",
+    is_flag=True,
+    envvar="ASSH_CPROFILE",
+    help="Write a cProfile dump of the run to ~/.assh/profiles",
+)
+def main(show_timings, timings_log, cprofile):
+    """Connect to AWS EC2 instances."""
+    if show_timings or timings_log or cprofile:
+        timings.enable(report=show_timings, log=timings_log, cprofile=cprofile)
+
+
+def _ssm_command(instance, remote_command=None, interactive=True):
+    start_session = [
+        "aws",
+        *aws_cli_args(instance),
+        "ssm",
+        "start-session",
+        "--target",
+        instance.id,
+    ]
+    if remote_command:
+        document = (
+            "AWS-StartInteractiveCommand"
+            if interactive
+            else "AWS-StartNonInteractiveCommand"
+        )
+        start_session.extend(
+            [
+                "--document-name",
+                document,
+                "--parameters",
+                json.dumps({"command": [" ".join(remote_command)]}),
+            ]
+        )
+    return start_session
+
+
+@contextlib.contextmanager
+def _ssh_config_file(sshconf):
+    suffix = "".join(random.choice(string.ascii_lowercase) for _ in range(6))
+    conf_path = TOOL_DIR / f".sshconf-{suffix}"
+    with open(conf_path, "w+") as conf_file:
+        sshconf.write(conf_file)
+
+    try:
+        yield conf_path
+    finally:
+        os.remove(conf_path)
+
+
+def _instance_labels(instances):
+    names = [instance.name or instance.id for instance in instances]
+    # Fall back to IDs to tell apart instances which share a name
+    return [
+        f"{name} ({instance.id})" if names.count(name) > 1 else name
+        for name, instance in zip(names, instances)
+    ]
+
+
+def _fan_out_routes(config, instances, mode, via_instance, login_name, identity_file):
+    """Resolve how to reach each instance, as for connecting to it alone.
+
+    Returns an ssh config with a host named after each instance ID (plus the
+    jump host), the (label, instance, mode) of each reachable instance, and
+    failed results for those which can't be reached.
+    """
+    usernames = UsernameResolver(config, ImageCache(CACHE_DIR))
+
+    sshconf = SSHConfig()
+    if via_instance:
+        key_path = resolve_key_path(config, via_instance, identity_file)
+        sshconf.add_host(
+            "jump", **jump_settings(via_instance, login_name, key_path, usernames)
+        )
+
+    unreachable = []
+    routes = []
+    for label, instance in zip(_instance_labels(instances), instances):
+        try:
+            instance_mode = resolve_mode(instance, mode, via_instance)
+        except NoRouteException as exc:
+            click.echo(f"{label}: {exc}", err=True)
+            unreachable.append(Result(label, 255, 0))
+            continue
+
+        routes.append((label, instance, instance_mode))
+        if instance_mode != "ssm":
+            key_path = resolve_key_path(config, instance, identity_file)
+            sshconf.add_host(
+                instance.id,
+                **destination_settings(
+                    instance,
+                    instance_mode,
+                    "jump" if via_instance else None,
+                    login_name,
+                    key_path,
+                    usernames,
+                ),
+            )
+    return sshconf, routes, unreachable
+
+
+def _fan_out(
+    config,
+    instances,
+    mode,
+    via_instance,
+    login_name,
+    identity_file,
+    remote_command,
+    workers,
+    timeout,
+):
+    """Run the remote command on every instance, and return an exit status."""
+    sshconf, routes, unreachable = _fan_out_routes(
+        config, instances, mode, via_instance, login_name, identity_file
+    )
+
+    with _ssh_config_file(sshconf) as conf_path:
+        commands = []
+        for label, instance, instance_mode in routes:
+            if instance_mode == "ssm":
+                command = _ssm_command(instance, remote_command, interactive=False)
+            else:
+                # BatchMode stops hosts prompting for input nobody can give
+                command = ["ssh", "-F", str(conf_path), "-o", "BatchMode=yes"]
+                command += [instance.id, *remote_command]
+            env = aws_cli_env(instance) if instance_mode != "ssh" else None
+            commands.append((label, command, env))
+
+        with timings.span("fan out", instances=len(commands)):
+            results = unreachable + run_parallel(commands, workers, timeout)
+
+    for line in summarise(results):
+        click.echo(line, err=True)
+
+    return 0 if all(result.ok for result in results) else 1
+
+
+@main.command()
 @click.argument("query", nargs=-1, autocompletion=_autocomplete_instances)
 @click.option("--log-level", required=False, default="warning", help="Set log level")
 # @click.option("--region", required=False, help="AWS Region")
 @click.option(
-    "-m", "--mode", default="ssh", help="Connection mode (ssh, ssm, ssm-ssh)",
+    "-m",
+    "--mode",
+    default="ssh",
+    help="Connection mode (ssh, ssm, ssm-ssh, auto)",
 )
 @click.option(
     "-v",
@@ -64,91 +420,437 @@ def ignore_user_entered_signals():
     "-l", "--login_name", required=False, help="EC2 Instance Username Override"
 )
 @click.option("-i", "--identity_file", required=False, help="SSH Private Key")
-def main(query, log_level, mode, via, login_name, identity_file):
+@click.option(
+    "--multiplex/--no-multiplex",
+    default=None,
+    help="Reuse SSH connections through ControlMaster",
+)
+@click.option(
+    "-a",
+    "--all",
+    "run_all",
+    is_flag=True,
+    help="Run the command after -- on every matching instance",
+)
+@click.option(
+    "-w", "--workers", default=16, help="Instances to run on at once with --all"
+)
+@click.option(
+    "-t", "--timeout", type=float, help="Seconds to allow each instance with --all"
+)
+def connect(
+    query,
+    log_level,
+    mode,
+    via,
+    login_name,
+    identity_file,
+    multiplex,
+    run_all,
+    workers,
+    timeout,
+):
+    """Connect to the instance matching QUERY.
+
+    Anything after -- is run as a command on the instance instead.
+    """
     logging.basicConfig(level=log_level.upper())
 
+    with timings.span("config"):
+        config = load_config(CONFIG_PATH)
+    remote_command = click.get_current_context().meta.get(REMOTE_COMMAND, [])
+
     query = " ".join(query)
-    instance = get_instance(CACHE_DIR, query)
 
-    sshconf = SSHConfig()
-    dest_kwargs = {"HostName": instance.public_ip}
+    if run_all:
+        if not remote_command:
+            raise click.UsageError("--all needs a command to run after --")
 
-    current_aws_profile = os.environ.get(
-        "AWS_PROFILE", os.environ.get("AWS_DEFAULT_PROFILE")
-    )
+        with timings.span("lookup"):
+            instances = _find_instances(config, query)
+        if not instances:
+            raise NoResultsException(
+                f"No results could be found with query term '{query}'"
+            )
 
-    config = {}
-    if CONFIG_PATH.exists():
-        with open(CONFIG_PATH) as config_file:
-            config = yaml.load(config_file, Loader=yaml.SafeLoader)
+        via_instance = _get_instance(config, via) if via else None
+        sys.exit(
+            _fan_out(
+                config,
+                instances,
+                mode,
+                via_instance,
+                login_name,
+                identity_file,
+                remote_command,
+                workers,
+                timeout,
+            )
+        )
+
+    history = History()
+    with timings.span("lookup"):
+        instance = _resolve_instance(config, query, history)
+    history.record(None if query == LAST_HOST else query, instance)
+    mode = resolve_mode(instance, mode, via)
+    logging.info("Connecting with mode '%s'", mode)
 
     if mode == "ssm":
-        start_session = ["aws", "ssm", "start-session", "--target", instance.id]
+        start_session = _ssm_command(instance, remote_command)
         logging.info(
             "Attempting to connect using command '%s'", " ".join(start_session)
         )
-        with ignore_user_entered_signals():
-            subprocess.run(start_session)
+        with ignore_user_entered_signals(), timings.span("ssm session"):
+            subprocess.run(start_session, env=aws_cli_env(instance))
         return
 
-    # Username
-    username_patterns = config.get("username-patterns", {}).get(current_aws_profile, [])
-    username_patterns.extend(config.get("global-username-patterns", []))
-    logging.info("Gathered custom username patterns: %s", username_patterns)
-    resolved_username = (
-        login_name if login_name else instance.default_username(username_patterns)
+    sshconf = SSHConfig()
+    usernames = UsernameResolver(config, ImageCache(CACHE_DIR))
+    key_path = resolve_key_path(config, instance, identity_file)
+
+    # Jump Host
+    via_instance = jump_kwargs = None
+    if via:
+        via_instance = _get_instance(config, via)
+        jump_kwargs = jump_settings(via_instance, login_name, key_path, usernames)
+        sshconf.add_host("jump", **jump_kwargs)
+
+    with timings.span("username"):
+        dest_kwargs = destination_settings(
+            instance, mode, "jump" if via else None, login_name, key_path, usernames
+        )
+    logging.info("Creating SSH Configuration with %s", dest_kwargs)
+    sshconf.add_host("destination", **dest_kwargs)
+
+    # Connection Multiplexing
+    multiplexing = config.get("multiplex", {})
+    if multiplex is None:
+        multiplex = multiplexing.get("enabled", False)
+    if multiplex:
+        persist = multiplexing.get("persist", "10m")
+        hosts = [("destination", dest_kwargs, jump_kwargs, instance)]
+        if jump_kwargs:
+            hosts.append(("jump", jump_kwargs, None, via_instance))
+
+        for host, host_kwargs, host_jump_kwargs, host_instance in hosts:
+            socket_name = control_socket_name(host_kwargs, host_jump_kwargs)
+            sshconf.enable_multiplexing(
+                host, control_dir(TOOL_DIR) / socket_name, persist
+            )
+            register_master(
+                TOOL_DIR,
+                socket_name,
+                instance=host_instance.id,
+                label=host_instance.name,
+                user=host_kwargs.get("User"),
+                via=via_instance.id if host_jump_kwargs else None,
+            )
+
+    with _ssh_config_file(sshconf) as conf_path:
+        ssh_command = ["ssh", "-F", str(conf_path), "destination", *remote_command]
+
+        logging.info("Attempting to connect using command '%s'", " ".join(ssh_command))
+        # The ProxyCommand starting the SSM session inherits the environment
+        env = aws_cli_env(instance) if mode == "ssm-ssh" else None
+        with timings.span("ssh session"):
+            subprocess.run(ssh_command, env=env)
+
+
+REMOTE_PATH = ":"
+
+
+def _local_size(paths):
+    """The size in bytes of local files, counting everything under directories."""
+    total = 0
+    for path in map(Path, paths):
+        if path.is_dir():
+            files = [item for item in path.rglob("*") if item.is_file()]
+            total += sum(item.stat().st_size for item in files)
+        elif path.is_file():
+            total += path.stat().st_size
+    return total
+
+
+def _copy(
+    config,
+    instances,
+    mode,
+    via_instance,
+    login_name,
+    identity_file,
+    sources,
+    destination,
+    pull,
+    recursive,
+    workers,
+    timeout,
+    retries,
+):
+    """Copy files to or from every instance, and return an exit status.
+
+    Files copied from instances go in a directory for each one, under the
+    destination.
+    """
+    sshconf, routes, unreachable = _fan_out_routes(
+        config, instances, mode, via_instance, login_name, identity_file
     )
-    logging.info("Resolved username as '%s'", resolved_username)
-    dest_kwargs["User"] = resolved_username
 
-    # Private Key
-    if identity_file:
-        key_path = identity_file
-    else:
-        key_path = (
-            (
-                config.get("profiles", {})
-                .get(current_aws_profile, {})
-                .get(instance.keyname)
+    with _ssh_config_file(sshconf) as conf_path:
+        commands = []
+        host_dirs = {}
+        for label, instance, instance_mode in routes:
+            if instance_mode == "ssm":
+                click.echo(f"{label}: files can't be copied over ssm", err=True)
+                unreachable.append(Result(label, 255, 0))
+                continue
+
+            command = ["scp", "-F", str(conf_path), "-o", "BatchMode=yes"]
+            if recursive:
+                command.append("-r")
+            if pull:
+                host_dir = Path(destination) / label.replace(os.sep, "_")
+                host_dir.mkdir(parents=True, exist_ok=True)
+                host_dirs[label] = (host_dir, _local_size([host_dir]))
+                command += [f"{instance.id}{source}" for source in sources]
+                command.append(str(host_dir))
+            else:
+                command += [*sources, f"{instance.id}{destination}"]
+
+            env = aws_cli_env(instance) if instance_mode != "ssh" else None
+            commands.append((label, command, env))
+
+        start = time.monotonic()
+        with timings.span("copy", instances=len(commands)):
+            results = run_parallel(
+                commands, workers, timeout, retries=retries, progress=sys.stderr
             )
-            or config.get("default-keypairs", {}).get(instance.keyname)
-            or config.get("default-key")
+        elapsed = time.monotonic() - start
+
+    copied = [result for result in results if result.ok]
+    if pull:
+        size = sum(
+            _local_size([host_dirs[result.label][0]]) - host_dirs[result.label][1]
+            for result in copied
         )
+    else:
+        size = _local_size(sources) * len(copied)
 
-    if key_path:
-        dest_kwargs["IdentityFile"] = key_path
+    results = unreachable + results
+    for line in summarise(results):
+        click.echo(line, err=True)
+    rate = size / elapsed if elapsed else 0
+    click.echo(
+        f"Copied {size / 1e6:.1f} MB in {elapsed:.1f}s ({rate / 1e6:.1f} MB/s)",
+        err=True,
+    )
 
-    # Jump Host
-    if via:
-        dest_kwargs["HostName"] = instance.private_ip
-        via_instance = get_instance(CACHE_DIR, via)
-        via_username = login_name if login_name else via_instance.default_username()
-        sshconf.add_host(
-            "jump",
-            HostName=via_instance.public_ip,
-            User=via_username,
-            IdentityFile=key_path,
+    return 0 if all(result.ok for result in results) else 1
+
+
+@main.command()
+@click.argument("query", autocompletion=_autocomplete_instances)
+@click.argument("paths", nargs=-1, required=True)
+@click.option("--log-level", required=False, default="warning", help="Set log level")
+@click.option(
+    "-m",
+    "--mode",
+    default="ssh",
+    help="Connection mode (ssh, ssm-ssh, auto)",
+)
+@click.option(
+    "-v",
+    "--via",
+    required=False,
+    help="Proxy SSH via host",
+    autocompletion=_autocomplete_instances,
+)
+@click.option(
+    "-l", "--login_name", required=False, help="EC2 Instance Username Override"
+)
+@click.option("-i", "--identity_file", required=False, help="SSH Private Key")
+@click.option("-r", "--recursive", is_flag=True, help="Copy directories")
+@click.option("-w", "--workers", default=16, help="Instances to copy with at once")
+@click.option("-t", "--timeout", type=float, help="Seconds to allow each attempt")
+@click.option("--retries", default=2, help="Times to retry each failed instance")
+def cp(
+    query,
+    paths,
+    log_level,
+    mode,
+    via,
+    login_name,
+    identity_file,
+    recursive,
+    workers,
+    timeout,
+    retries,
+):
+    """Copy files to or from every instance matching QUERY.
+
+    Paths on the instances start with a colon. `assh cp web app.conf :/etc/`
+    copies to every match, and `assh cp web :/var/log/app.log logs` copies
+    from each into its own directory, like logs/web-1/app.log.
+    """
+    logging.basicConfig(level=log_level.upper())
+
+    *sources, destination = paths
+    remote = [path.startswith(REMOTE_PATH) for path in sources]
+    pull = not destination.startswith(REMOTE_PATH)
+    if not sources or any(remote) != pull or len(set(remote)) > 1:
+        raise click.UsageError(
+            "Copy either local paths to a remote one, or remote paths to a local"
+            " one, with remote paths starting with ':'"
         )
-        dest_kwargs["ProxyJump"] = "jump"
 
-    # SSM Support
-    if mode == "ssm-ssh":
-        dest_kwargs["HostName"] = instance.id
-        dest_kwargs[
-            "ProxyCommand"
-        ] = "sh -c \"aws ssm start-session --target %h --document-name AWS-StartSSHSession --parameters 'portNumber=%p'\""
+    with timings.span("config"):
+        config = load_config(CONFIG_PATH)
+    with timings.span("lookup"):
+        instances = _find_instances(config, query)
+    if not instances:
+        raise NoResultsException(f"No results could be found with query term '{query}'")
 
-    logging.info("Creating SSH Configuration with %s", dest_kwargs)
-    sshconf.add_host("destination", **dest_kwargs)
+    via_instance = _get_instance(config, via) if via else None
+    sys.exit(
+        _copy(
+            config,
+            instances,
+            mode,
+            via_instance,
+            login_name,
+            identity_file,
+            sources,
+            destination,
+            pull,
+            recursive,
+            workers,
+            timeout,
+            retries,
+        )
+    )
 
-    suffix = "".join(random.choice(string.ascii_lowercase) for _ in range(6))
-    conf_path = TOOL_DIR / f".sshconf-{suffix}"
-    with open(conf_path, "w+") as conf_file:
-        sshconf.write(conf_file)
 
-    ssh_command = ["ssh", "-F", str(conf_path), "destination"]
+@main.command()
+@click.option("--close", "close", multiple=True, help="Close the named master")
+@click.option("--close-all", is_flag=True, help="Close every master")
+def masters(close, close_all):
+    """List or close multiplexed SSH connections."""
+    live = list_masters(TOOL_DIR)
+
+    if close_all:
+        close = [master["name"] for master in live]
+
+    if close:
+        for name in close:
+            status = "closed" if close_master(TOOL_DIR, name) else "not running"
+            click.echo(f"{name}: {status}")
+        return
+
+    for master in live:
+        via = f" via {master['via']}" if master["via"] else ""
+        click.echo(
+            f"{master['name']}\t{master['user']}@{master['instance']}"
+            f" ({master['label']}){via}"
+        )
+
 
-    logging.info("Attempting to connect using command '%s'", " ".join(ssh_command))
-    subprocess.run(ssh_command)
+@main.command()
+@click.argument("query", nargs=-1, autocompletion=_autocomplete_instances)
+@click.option("-p", "--port", type=int, help="Port to forward to")
+@click.option("-L", "--local-port", type=int, help="Local port to listen on")
+@click.option(
+    "-H", "--host", "remote_host", help="Forward to this host, through the instance"
+)
+@click.option("-n", "--name", help="Name the tunnel")
+@click.option("--close", "close", multiple=True, help="Close the named tunnel")
+@click.option("--close-all", is_flag=True, help="Close every tunnel")
+def tunnel(query, port, local_port, remote_host, name, close, close_all):
+    """Forward a local port to the instance matching QUERY, over SSM.
 
-    os.remove(conf_path)
+    A tunnel already forwarding to the same place is reused. Tunnels keep
+    running in the background, and reconnect if their session drops. Without
+    a QUERY, the running tunnels are listed.
+    """
+    if close_all:
+        close = [running["name"] for running in list_tunnels(TOOL_DIR)]
+
+    if close:
+        for tunnel_name in close:
+            closed = close_tunnel(TOOL_DIR, tunnel_name)
+            click.echo(f"{tunnel_name}: {'closed' if closed else 'not running'}")
+        return
+
+    if not query:
+        for running in list_tunnels(TOOL_DIR):
+            target = running["remote_host"] or running["instance"]["id"]
+            via = f" via {running['instance']['id']}" if running["remote_host"] else ""
+            click.echo(
+                f"{running['name']}\tlocalhost:{running['local_port']} ->"
+                f" {target}:{running['remote_port']}{via}"
+                f" ({running['label']}, {running['restarts']} restarts)"
+            )
+        return
+
+    if port is None:
+        raise click.UsageError("--port is needed to open a tunnel")
+
+    config = load_config(CONFIG_PATH)
+    query = " ".join(query)
+    history = History()
+    instance = _resolve_instance(config, query, history)
+    history.record(query, instance)
+    # Fails straight away if the SSM agent is known to be offline
+    resolve_mode(instance, "ssm", None)
+
+    details, reused = open_tunnel(
+        TOOL_DIR,
+        instance,
+        _instance_labels([instance])[0],
+        port,
+        local_port,
+        remote_host,
+        name,
+    )
+    click.echo(
+        f"{'Reusing' if reused else 'Started'} tunnel {details['name']}", err=True
+    )
+    click.echo(f"localhost:{details['local_port']}")
+
+
+@main.command()
+@click.option("-n", "--limit", default=10, help="How many instances to list")
+def recent(limit):
+    """List the instances connected to most, often and recently."""
+    config = load_config(CONFIG_PATH)
+    history = History()
+
+    for instance_id in history.recent(limit):
+        instance = _recall_instance(config, history, instance_id)
+        if instance is None:
+            continue
+
+        host = history.host(instance_id)
+        last = datetime.datetime.fromtimestamp(host["last"])
+        click.echo(
+            f"{instance.name or '-'}\t{instance.id}"
+            f"\t{host['visits']} visits, last {last:%Y-%m-%d %H:%M}"
+        )
+
+
+@main.command("daemon")
+@click.option("--status", is_flag=True, help="Show whether the daemon is running")
+@click.option("--stop", is_flag=True, help="Stop the daemon")
+def daemon_command(status, stop):
+    """Start the lookup daemon, or manage a running one."""
+    running = daemon.request({"op": "status"})
+
+    if stop:
+        if running:
+            daemon.request({"op": "stop"})
+        click.echo("stopped" if running else "not running")
+    elif status:
+        click.echo(f"running (pid {running['pid']})" if running else "not running")
+    elif running:
+        click.echo(f"already running (pid {running['pid']})")
+    else:
+        daemon.spawn()
+        click.echo("started")
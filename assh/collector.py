@@ -0,0 +1,221 @@
+"""Rate limited AWS API calls for collecting the inventory.
+
+Every call is made through one asyncio event loop, running in a background
+thread and shared by every thread fetching instances. This lets it limit the
+concurrency and request rate of each endpoint (a profile, region and service)
+across all of them, and slow down when AWS starts throttling requests.
+"""
+import functools
+import random
+import threading
+import time
+
+from typing import Callable, Iterator, Optional, Tuple
+
+# Error codes AWS uses to say requests are arriving too quickly
+THROTTLING_CODES = {
+    "RequestLimitExceeded",
+    "Throttling",
+    "ThrottlingException",
+    "TooManyRequestsException",
+}
+
+# Error codes which are worth retrying, but aren't about the request rate
+TRANSIENT_CODES = {
+    "InternalError",
+    "InternalFailure",
+    "ServiceUnavailable",
+    "Unavailable",
+}
+
+# Requests in flight at once, per endpoint
+MAX_CONCURRENCY = 8
+
+# Threads making blocking boto3 calls, across every endpoint. Grown to match
+# the number of targets being fetched at once, see reserve_workers.
+MAX_WORKERS = 64
+
+# Sustained requests per second, and how many can be made in a burst, per
+# endpoint. EC2's describe calls refill at 20 a second, shared by every client
+# of the account, so this leaves headroom for others.
+RATE = 10.0
+BURST = 20
+MIN_RATE = 0.5
+
+MAX_ATTEMPTS = 8
+BASE_DELAY = 0.25
+MAX_DELAY = 20.0
+
+Endpoint = Tuple[Optional[str], Optional[str], str]
+
+
+class TokenBucket:
+    """Limits the request rate, adapting it to throttling.
+
+    The rate is halved whenever a request is throttled, and recovers a little
+    with each success, up to the configured rate.
+    """
+
+    def __init__(self, rate: float = RATE, burst: int = BURST):
+        self.max_rate = self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        import asyncio
+
+        self._refill()
+        while self.tokens < 1:
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+            self._refill()
+        self.tokens -= 1
+
+    def throttled(self):
+        self.rate = max(self.rate / 2, MIN_RATE)
+        self.tokens = 0
+
+    def succeeded(self):
+        self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+
+class _Limits:
+    def __init__(self, concurrency: int, rate: float, burst: int):
+        import asyncio
+
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.bucket = TokenBucket(rate, burst)
+
+
+def _retryable(exc: Exception) -> Tuple[bool, bool]:
+    """Whether an error is worth retrying, and whether it was throttling."""
+    from botocore.exceptions import ClientError, ConnectionError as BotoConnectionError
+
+    if isinstance(exc, ClientError):
+        code = exc.response.get("Error", {}).get("Code")
+        return code in THROTTLING_CODES | TRANSIENT_CODES, code in THROTTLING_CODES
+    return isinstance(exc, BotoConnectionError), False
+
+
+class Collector:
+    def __init__(
+        self,
+        concurrency: int = MAX_CONCURRENCY,
+        rate: float = RATE,
+        burst: int = BURST,
+        max_attempts: int = MAX_ATTEMPTS,
+    ):
+        # Both take a while to import, and lookups served from the cache never
+        # make a call, so they're only imported once a collector is needed
+        import asyncio
+        from concurrent.futures import ThreadPoolExecutor
+
+        self.concurrency = concurrency
+        self.rate = rate
+        self.burst = burst
+        self.max_attempts = max_attempts
+        self.limits = {}
+
+        # Blocking boto3 calls run here, so they don't hold up the loop
+        self.workers = MAX_WORKERS
+        self.executor = ThreadPoolExecutor(max_workers=self.workers)
+        self._executor_lock = threading.Lock()
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+
+    def reserve_workers(self, workers: int):
+        """Make sure at least this many calls can be waiting on AWS at once."""
+        from concurrent.futures import ThreadPoolExecutor
+
+        with self._executor_lock:
+            if workers <= self.workers:
+                return
+            # Calls already running finish on the old executor
+            previous = self.executor
+            self.workers = workers
+            self.executor = ThreadPoolExecutor(max_workers=workers)
+            previous.shutdown(wait=False)
+
+    def _limits(self, endpoint: Endpoint) -> _Limits:
+        # Only ever called on the loop, so no locking is needed
+        if endpoint not in self.limits:
+            self.limits[endpoint] = _Limits(self.concurrency, self.rate, self.burst)
+        return self.limits[endpoint]
+
+    async def call(self, endpoint: Endpoint, operation: Callable, **kwargs):
+        """Make an API call within the endpoint's limits, retrying throttling."""
+        import asyncio
+
+        limits = self._limits(endpoint)
+        for attempt in range(1, self.max_attempts + 1):
+            async with limits.semaphore:
+                await limits.bucket.acquire()
+                try:
+                    result = await self.loop.run_in_executor(
+                        self.executor, functools.partial(operation, **kwargs)
+                    )
+                except Exception as exc:
+                    retryable, throttled = _retryable(exc)
+                    if not retryable or attempt == self.max_attempts:
+                        raise
+                    if throttled:
+                        limits.bucket.throttled()
+                else:
+                    limits.bucket.succeeded()
+                    return result
+
+            # Exponential backoff with full jitter, outside the semaphore so
+            # other requests can go ahead meanwhile
+            await asyncio.sleep(
+                random.uniform(0, min(MAX_DELAY, BASE_DELAY * 2 ** attempt))
+            )
+
+    def run(self, coroutine):
+        """Run a coroutine on the collector's loop, from any other thread."""
+        import asyncio
+
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def pages(
+        self, endpoint: Endpoint, operation: Callable, **kwargs
+    ) -> Iterator[dict]:
+        """Call a paginated operation, yielding each page as it arrives."""
+        while True:
+            page = self.run(self.call(endpoint, operation, **kwargs))
+            yield page
+
+            if not page.get("NextToken"):
+                return
+            kwargs["NextToken"] = page["NextToken"]
+
+
+_collector = None
+_collector_lock = threading.Lock()
+
+
+def get_collector() -> Collector:
+    global _collector
+    with _collector_lock:
+        if _collector is None:
+            _collector = Collector()
+    return _collector
+
+
+def make_client(session, service: str):
+    """Create a client whose retries are left to the collector."""
+    from botocore.config import Config
+
+    return session.client(service, config=Config(retries={"max_attempts": 0}))
+
+
+def endpoint_of(aws_client, profile: Optional[str]) -> Endpoint:
+    return (
+        profile,
+        aws_client.meta.region_name,
+        aws_client.meta.service_model.service_name,
+    )
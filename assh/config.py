@@ -0,0 +1,246 @@
+import hashlib
+import json
+import os
+import re
+
+from pathlib import Path
+from typing import List, NamedTuple, Optional
+
+from assh.exceptions import ConfigException
+from assh.files import atomic_write_json
+
+TOOL_DIR = Path.home() / ".assh"
+
+CONFIG_PATH = TOOL_DIR / "config.yaml"
+CACHE_DIR = TOOL_DIR / "cache"
+
+
+class Target(NamedTuple):
+    """An AWS profile and region pair to fetch instances from.
+
+    A value of None means boto3's ambient configuration is used. With a role
+    set, instances are fetched from the role's account, assuming it with the
+    profile's credentials.
+    """
+
+    profile: Optional[str] = None
+    region: Optional[str] = None
+    role: Optional[str] = None
+
+
+def current_profile() -> Optional[str]:
+    return os.environ.get("AWS_PROFILE", os.environ.get("AWS_DEFAULT_PROFILE"))
+
+
+# Sections which must hold a mapping, or a list, if they're present at all
+MAPPING_SECTIONS = (
+    "default-keypairs",
+    "profiles",
+    "username-patterns",
+    "cache",
+    "multiplex",
+    "ssh-config",
+    "daemon",
+    "matching",
+)
+LIST_SECTIONS = (
+    "aws-profiles",
+    "regions",
+    "global-username-patterns",
+    "search-tags",
+    "roles",
+)
+
+ROLE_ARN = re.compile(r"^arn:aws[\w-]*:iam::\d{12}:role/\S+$")
+
+# Bumped whenever validation changes, so older snapshots are checked again
+SNAPSHOT_VERSION = 3
+
+
+def _check_rules(rules, section: str) -> list:
+    if rules is None:
+        return []
+    if not isinstance(rules, list):
+        raise ConfigException(f"'{section}' must be a list of username patterns")
+
+    for rule in rules:
+        if not isinstance(rule, dict) or "username" not in rule:
+            raise ConfigException(f"Every rule in '{section}' needs a username")
+    return rules
+
+
+def normalise_config(config) -> dict:
+    """Validate a parsed config, replacing empty sections with empty values.
+
+    Raises ConfigException if a section has the wrong shape.
+    """
+    if config is None:
+        return {}
+    if not isinstance(config, dict):
+        raise ConfigException("The config file must hold a mapping")
+
+    config = dict(config)
+    for section in MAPPING_SECTIONS:
+        if section in config:
+            config[section] = config[section] or {}
+            if not isinstance(config[section], dict):
+                raise ConfigException(f"'{section}' must be a mapping")
+
+    for section in LIST_SECTIONS:
+        if section in config:
+            config[section] = config[section] or []
+            if not isinstance(config[section], list):
+                raise ConfigException(f"'{section}' must be a list")
+
+    for profile, keypairs in config.get("profiles", {}).items():
+        keypairs = config["profiles"][profile] = keypairs or {}
+        if not isinstance(keypairs, dict):
+            raise ConfigException(f"'profiles.{profile}' must map keypairs to keys")
+
+    for profile, rules in config.get("username-patterns", {}).items():
+        config["username-patterns"][profile] = _check_rules(
+            rules, f"username-patterns.{profile}"
+        )
+
+    if "global-username-patterns" in config:
+        _check_rules(config["global-username-patterns"], "global-username-patterns")
+
+    for role in config.get("roles", []):
+        if not isinstance(role, str) or not ROLE_ARN.match(role):
+            raise ConfigException(f"'{role}' in 'roles' isn't an IAM role ARN")
+
+    return config
+
+
+def _snapshot_path(path: Path) -> Path:
+    return path.with_suffix(".snapshot.json")
+
+
+def _read_snapshot(path: Path) -> dict:
+    try:
+        with open(_snapshot_path(path)) as snapshot_file:
+            snapshot = json.load(snapshot_file)
+    except (OSError, ValueError):
+        return {}
+
+    return snapshot if snapshot.get("version") == SNAPSHOT_VERSION else {}
+
+
+def _write_snapshot(path: Path, snapshot: dict):
+    try:
+        atomic_write_json(_snapshot_path(path), snapshot)
+    except OSError:
+        # The snapshot only saves time, so carry on without one
+        pass
+
+
+def _parse_config(content: bytes) -> dict:
+    # Only pay for importing yaml when the config has to be parsed
+    import yaml
+
+    # LibYAML's loader is several times faster, when PyYAML was built with it
+    loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+    config = normalise_config(yaml.load(content, Loader=loader))
+
+    # Round trip through JSON, so a fresh parse gives exactly what a snapshot
+    # would (with numeric profile names as strings, for instance)
+    return json.loads(json.dumps(config, default=str))
+
+
+def load_config(path: Path = CONFIG_PATH) -> dict:
+    """Load the config, from a snapshot of the last parse where possible.
+
+    The snapshot is used while the file's mtime and size are unchanged, or
+    its content hashes the same.
+    """
+    try:
+        stat = path.stat()
+    except FileNotFoundError:
+        return {}
+
+    snapshot = _read_snapshot(path)
+    if snapshot.get("mtime_ns") == stat.st_mtime_ns and (
+        snapshot.get("size") == stat.st_size
+    ):
+        return snapshot["config"]
+
+    content = path.read_bytes()
+    digest = hashlib.sha1(content).hexdigest()
+    # Touched, or rewritten with the same content
+    config = snapshot["config"] if snapshot.get("sha1") == digest else None
+    if config is None:
+        config = _parse_config(content)
+
+    _write_snapshot(
+        path,
+        {
+            "version": SNAPSHOT_VERSION,
+            "mtime_ns": stat.st_mtime_ns,
+            "size": stat.st_size,
+            "sha1": digest,
+            "config": config,
+        },
+    )
+    return config
+
+
+def get_targets(config: dict) -> List[Target]:
+    profiles = config.get("aws-profiles") or [None]
+    regions = config.get("regions") or [None]
+
+    targets = [Target(profile, region) for profile in profiles for region in regions]
+
+    # Roles are assumed with one profile's credentials, usually the account
+    # trusted by every other account
+    source_profile = config.get("role-source-profile")
+    targets.extend(
+        Target(source_profile, region, role)
+        for role in config.get("roles", [])
+        for region in regions
+    )
+    return targets
+
+
+def get_ssh_config_path(config: dict) -> Optional[Path]:
+    ssh_config = config.get("ssh-config") or {}
+    if not ssh_config.get("enabled", False):
+        return None
+
+    return Path(ssh_config.get("path", TOOL_DIR / "ssh_config")).expanduser()
+
+
+def get_daemon_options(config: dict) -> dict:
+    daemon = config.get("daemon") or {}
+
+    return {
+        "enabled": daemon.get("enabled", False),
+        "idle_timeout": daemon.get("idle-timeout", 1800),
+    }
+
+
+def get_matching_options(config: dict) -> dict:
+    matching = config.get("matching") or {}
+
+    return {
+        "max_results": matching.get("max-results", 10),
+        "interactive": matching.get("interactive", True),
+    }
+
+
+def get_cache_options(config: dict) -> dict:
+    cache = config.get("cache") or {}
+    ssh_config_path = get_ssh_config_path(config)
+
+    return {
+        "ttl": cache.get("ttl", 60),
+        "max_stale": cache.get("max-stale", 3600),
+        "stale_while_revalidate": cache.get("stale-while-revalidate", False),
+        "search_tags": config.get("search-tags", []),
+        "shard_format": cache.get("format", "binary"),
+        "incremental": cache.get("incremental", False),
+        "full_refresh_interval": cache.get("full-refresh-interval", 3600),
+        "ssm_status": cache.get("ssm-status", False),
+        "fetch_workers": cache.get("fetch-workers", 64),
+        # Passed on to background refreshes, so kept JSON serialisable
+        "ssh_config": str(ssh_config_path) if ssh_config_path else None,
+    }
@@ -0,0 +1,125 @@
+"""Build the ssh_config settings used to reach an instance."""
+import logging
+import os
+
+from typing import Optional
+
+from assh.config import current_profile
+from assh.credentials import assume_role
+from assh.exceptions import NoRouteException
+from assh.instance import SSM_ONLINE
+
+
+def aws_cli_args(instance):
+    """Point the AWS CLI at the account and region the instance was found in."""
+    args = []
+    # Instances found through a role are reached with its credentials instead,
+    # passed in the environment
+    if instance.profile and not instance.role:
+        args.extend(["--profile", instance.profile])
+    if instance.region:
+        args.extend(["--region", instance.region])
+    return args
+
+
+def aws_cli_env(instance) -> Optional[dict]:
+    """The environment the AWS CLI needs, if the instance was found via a role.
+
+    Returns None when the current environment will do.
+    """
+    if not instance.role:
+        return None
+
+    credentials = assume_role(instance.profile, instance.role)
+    env = dict(os.environ)
+    for variable in ("AWS_PROFILE", "AWS_DEFAULT_PROFILE"):
+        env.pop(variable, None)
+    env.update(
+        AWS_ACCESS_KEY_ID=credentials["AccessKeyId"],
+        AWS_SECRET_ACCESS_KEY=credentials["SecretAccessKey"],
+        AWS_SESSION_TOKEN=credentials["SessionToken"],
+    )
+    return env
+
+
+def resolve_mode(instance, mode, via):
+    """Pick how to connect to an instance, using its cached SSM ping status.
+
+    In auto mode, an explicit jump host wins, then SSM if the agent is online,
+    then the public IP. Explicit SSM modes fail straight away if the agent is
+    known to be unreachable, rather than waiting on the session to time out.
+    """
+    if mode == "auto":
+        if via:
+            return "ssh"
+        if instance.ssm_ping == SSM_ONLINE:
+            # ssm-ssh still needs a key the instance accepts
+            return "ssm-ssh" if instance.keyname else "ssm"
+        if instance.public_ip:
+            return "ssh"
+        raise NoRouteException(
+            f"{instance.id} has no public IP and isn't online in SSM, try --via"
+        )
+
+    if mode in ("ssm", "ssm-ssh") and instance.ssm_ping not in (None, SSM_ONLINE):
+        raise NoRouteException(
+            f"{instance.id} can't be reached through SSM "
+            f"(ping status: {instance.ssm_ping})"
+        )
+
+    return mode
+
+
+def resolve_key_path(config, instance, identity_file):
+    if identity_file:
+        return identity_file
+
+    current_aws_profile = instance.profile or current_profile()
+    return (
+        (config.get("profiles", {}).get(current_aws_profile, {}).get(instance.keyname))
+        or config.get("default-keypairs", {}).get(instance.keyname)
+        or config.get("default-key")
+    )
+
+
+def destination_settings(instance, mode, jump_host, login_name, key_path, usernames):
+    """Build the ssh_config settings for connecting to an instance.
+
+    jump_host is the name of the ssh_config Host to jump through, if any.
+    """
+    dest_kwargs = {"HostName": instance.public_ip}
+
+    # Username
+    resolved_username = login_name if login_name else usernames.resolve(instance)
+    logging.info("Resolved username as '%s'", resolved_username)
+    dest_kwargs["User"] = resolved_username
+
+    # Private Key
+    if key_path:
+        dest_kwargs["IdentityFile"] = key_path
+
+    # Jump Host
+    if jump_host:
+        dest_kwargs["HostName"] = instance.private_ip
+        dest_kwargs["ProxyJump"] = jump_host
+
+    # SSM Support
+    if mode == "ssm-ssh":
+        dest_kwargs["HostName"] = instance.id
+        aws_args = " ".join(aws_cli_args(instance))
+        dest_kwargs[
+            "ProxyCommand"
+        ] = f"sh -c \"aws {aws_args} ssm start-session --target %h --document-name AWS-StartSSHSession --parameters 'portNumber=%p'\""
+
+    return dest_kwargs
+
+
+def jump_settings(via_instance, login_name, key_path, usernames):
+    via_username = (
+        login_name if login_name else usernames.resolve(via_instance, use_rules=False)
+    )
+    return {
+        "HostName": via_instance.public_ip,
+        "User": via_username,
+        "IdentityFile": key_path,
+    }
@@ -0,0 +1,98 @@
+"""Assume IAM roles in other accounts, caching their credentials until expiry."""
+import datetime
+import hashlib
+import json
+import threading
+
+from collections import defaultdict
+from pathlib import Path
+from typing import Optional
+
+from assh.collector import endpoint_of, get_collector, make_client
+from assh.config import CACHE_DIR
+from assh.files import atomic_write_json
+
+CREDENTIALS_DIR = CACHE_DIR / "credentials"
+
+SESSION_NAME = "assh"
+ROLE_DURATION = 60 * 60
+
+# Cached credentials are replaced this long before they expire, so they don't
+# run out part way through a refresh or a session being started
+EXPIRY_MARGIN = 5 * 60
+
+# Every target in an account's regions asks for the same role at once, but
+# only the first needs to call STS
+_locks = defaultdict(threading.Lock)
+
+
+def role_account(role: str) -> str:
+    """The account ID from a role ARN, arn:aws:iam::<account>:role/<name>."""
+    return role.split(":")[4]
+
+
+def role_name(role: str) -> str:
+    return role.split(":")[5].split("/")[-1]
+
+
+def _credentials_path(credentials_dir: Path, profile: Optional[str], role: str):
+    key = hashlib.sha1(json.dumps([profile, role]).encode()).hexdigest()
+    return credentials_dir / f"{key}.json"
+
+
+def _read_credentials(path: Path) -> Optional[dict]:
+    try:
+        with open(path) as credentials_file:
+            credentials = json.load(credentials_file)
+    except (OSError, ValueError):
+        return None
+
+    now = datetime.datetime.now(datetime.timezone.utc).timestamp()
+    if credentials.get("Expiration", 0) - now <= EXPIRY_MARGIN:
+        return None
+    return credentials
+
+
+def _write_credentials(path: Path, credentials: dict):
+    path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+
+    # Only the current user may read them, from the moment they're written
+    atomic_write_json(path, credentials, mode=0o600)
+
+
+def assume_role(
+    profile: Optional[str], role: str, credentials_dir: Path = CREDENTIALS_DIR
+) -> dict:
+    """Get credentials for a role, assumed using the profile's credentials.
+
+    Returns the AccessKeyId, SecretAccessKey and SessionToken, along with
+    the Expiration as a timestamp.
+    """
+    path = _credentials_path(credentials_dir, profile, role)
+    with _locks[path]:
+        credentials = _read_credentials(path)
+        if credentials is not None:
+            return credentials
+
+        import boto3
+
+        sts = make_client(boto3.session.Session(profile_name=profile), "sts")
+        collector = get_collector()
+        response = collector.run(
+            collector.call(
+                endpoint_of(sts, profile),
+                sts.assume_role,
+                RoleArn=role,
+                RoleSessionName=SESSION_NAME,
+                DurationSeconds=ROLE_DURATION,
+            )
+        )
+
+        credentials = {
+            "AccessKeyId": response["Credentials"]["AccessKeyId"],
+            "SecretAccessKey": response["Credentials"]["SecretAccessKey"],
+            "SessionToken": response["Credentials"]["SessionToken"],
+            "Expiration": response["Credentials"]["Expiration"].timestamp(),
+        }
+        _write_credentials(path, credentials)
+        return credentials
@@ -0,0 +1,245 @@
+"""Optional daemon which keeps the inventory in memory and answers lookups.
+
+The daemon listens on a Unix socket in ~/.assh, and speaks one JSON object
+per line in each direction. Clients fall back to reading the cache
+themselves whenever it isn't running.
+"""
+import datetime
+import fcntl
+import json
+import logging
+import os
+import socket
+import socketserver
+import subprocess
+import sys
+import threading
+import time
+
+from pathlib import Path
+from typing import List, Optional
+
+from assh.caching import _load_shards, _shard_age, _unique, refresh_instances
+from assh.config import (
+    CACHE_DIR,
+    TOOL_DIR,
+    get_cache_options,
+    get_daemon_options,
+    get_targets,
+    load_config,
+)
+from assh.instance import Instance
+
+SOCKET_PATH = TOOL_DIR / "daemon.sock"
+LOCK_PATH = TOOL_DIR / "daemon.lock"
+
+# Long enough for a lookup which has to wait on a refresh
+RESPONSE_TIMEOUT = 10
+
+# Whether this process has already started a daemon
+_spawned = False
+
+
+def request(message: dict, socket_path: Path = SOCKET_PATH) -> Optional[dict]:
+    """Send a message to the daemon, returning None if it isn't running."""
+    if not socket_path.exists():
+        return None
+
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+            conn.settimeout(RESPONSE_TIMEOUT)
+            conn.connect(str(socket_path))
+            conn.sendall(json.dumps(message).encode() + b"\n")
+            with conn.makefile("rb") as responses:
+                response = responses.readline()
+    except OSError:
+        return None
+
+    return json.loads(response) if response else None
+
+
+def find_instances(
+    query: str, socket_path: Path = SOCKET_PATH
+) -> Optional[List[Instance]]:
+    """Search the daemon's inventory, returning None if it couldn't answer."""
+    response = request({"op": "find", "query": query}, socket_path)
+    if response is None or "error" in response:
+        return None
+
+    return [Instance.from_dict(instance) for instance in response["instances"]]
+
+
+def _is_serving(lock_path: Path) -> bool:
+    """Whether a daemon holds the lock, even if it isn't listening yet."""
+    try:
+        with open(lock_path) as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        return True
+    except FileNotFoundError:
+        pass
+    return False
+
+
+def spawn(lock_path: Path = LOCK_PATH):
+    """Start the daemon in the background, unless it's already starting.
+
+    Started at most once per process, however many lookups it makes.
+    """
+    global _spawned
+    if _spawned or _is_serving(lock_path):
+        return
+    _spawned = True
+
+    logging.info("Starting the assh daemon")
+    subprocess.Popen(
+        [sys.executable, "-m", "assh.daemon"],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True,
+    )
+
+
+class Inventory:
+    """The shards of every configured target, kept open between lookups."""
+
+    def __init__(self, cache_dir: Path):
+        self.cache_dir = cache_dir
+        self.lock = threading.Lock()
+        self.shards = {}
+        self.indexes = {}
+
+    def _current(self, targets, options) -> list:
+        with self.lock:
+            expired = [
+                target
+                for target in targets
+                if target not in self.shards
+                or _shard_age(self.shards[target]) > options["ttl"]
+            ]
+            if expired:
+                self.shards.update(_load_shards(self.cache_dir, expired, **options))
+            return [
+                (target, self.shards[target])
+                for target in targets
+                if target in self.shards
+            ]
+
+    def _index(self, target, shard, tag_keys):
+        key = (target, tuple(tag_keys))
+        cached = self.indexes.get(key)
+        if cached is None or cached[0] is not shard:
+            cached = self.indexes[key] = (shard, shard.search_index(tag_keys))
+        return cached[1]
+
+    def find(self, query: str) -> List[Instance]:
+        config = load_config()
+        targets, options = get_targets(config), get_cache_options(config)
+        tag_keys = options["search_tags"]
+        return list(
+            _unique(
+                shard.instance(position)
+                for target, shard in self._current(targets, options)
+                for position in self._index(target, shard, tag_keys).search(query)
+            )
+        )
+
+    def refresh(self):
+        """Refresh shards which are half way to expiring, so lookups never wait."""
+        config = load_config()
+        targets, options = get_targets(config), get_cache_options(config)
+        ttl = options.pop("ttl")
+        for option in ("max_stale", "stale_while_revalidate"):
+            options.pop(option)
+
+        refreshed = refresh_instances(
+            self.cache_dir, targets, ttl / 2, blocking=False, **options
+        )
+        with self.lock:
+            self.shards.update(refreshed)
+        return ttl
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        self.server.last_request = time.monotonic()
+        try:
+            message = json.loads(self.rfile.readline())
+            if message["op"] == "find":
+                instances = self.server.inventory.find(message["query"])
+                response = {"instances": [instance.to_dict() for instance in instances]}
+            elif message["op"] == "status":
+                response = {"pid": os.getpid(), "started_at": self.server.started_at}
+            elif message["op"] == "stop":
+                response = {"stopping": True}
+                threading.Thread(target=self.server.shutdown).start()
+            else:
+                response = {"error": f"Unknown op {message['op']}"}
+        except Exception as exc:
+            # Let the client fall back to looking the instance up itself
+            logging.exception("Lookup failed")
+            response = {"error": str(exc)}
+
+        self.wfile.write(json.dumps(response).encode() + b"\n")
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def _schedule(server, inventory: Inventory, idle_timeout: float):
+    while True:
+        try:
+            interval = inventory.refresh()
+        except Exception:
+            logging.exception("Scheduled refresh failed")
+            interval = 60
+
+        if time.monotonic() - server.last_request > idle_timeout:
+            logging.info("Idle for %ss, exiting", idle_timeout)
+            server.shutdown()
+            return
+        time.sleep(max(min(interval / 2, idle_timeout), 1))
+
+
+def serve(
+    socket_path: Path = SOCKET_PATH,
+    lock_path: Path = LOCK_PATH,
+    cache_dir: Path = CACHE_DIR,
+    idle_timeout: float = 1800,
+):
+    lock_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(lock_path, "a") as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            logging.info("The assh daemon is already running")
+            return
+
+        # Left behind by a daemon which didn't exit cleanly
+        if socket_path.exists():
+            os.remove(socket_path)
+
+        # Only the current user may connect
+        umask = os.umask(0o077)
+        try:
+            server = _Server(str(socket_path), _Handler)
+        finally:
+            os.umask(umask)
+        server.inventory = Inventory(cache_dir)
+        server.started_at = datetime.datetime.now(datetime.timezone.utc).timestamp()
+        server.last_request = time.monotonic()
+
+        threading.Thread(
+            target=_schedule, args=(server, server.inventory, idle_timeout), daemon=True
+        ).start()
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+            os.remove(socket_path)
+
+
+if __name__ == "__main__":
+    serve(idle_timeout=get_daemon_options(load_config())["idle_timeout"])
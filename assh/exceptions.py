@@ -4,3 +4,15 @@ class TooManyResultsException(Exception):
 
 class NoResultsException(Exception):
     pass
+
+
+class NoRouteException(Exception):
+    pass
+
+
+class ConfigException(Exception):
+    pass
+
+
+class TunnelException(Exception):
+    pass
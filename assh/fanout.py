@@ -0,0 +1,228 @@
+"""Run a command against many instances at once."""
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+from typing import Dict, List, NamedTuple, Optional, Sequence, TextIO, Tuple
+
+# Seconds before retrying a failed command, doubling with each attempt
+RETRY_DELAY = 1
+
+
+class Result(NamedTuple):
+    label: str
+    returncode: int
+    duration: float
+    timed_out: bool = False
+    attempts: int = 1
+
+    @property
+    def ok(self) -> bool:
+        return self.returncode == 0 and not self.timed_out
+
+
+class _PrefixedOutput:
+    """Writes whole lines from many hosts to one stream, prefixed with the host."""
+
+    def __init__(self, stream: TextIO, width: int):
+        self.stream = stream
+        self.width = width
+        self.lock = threading.Lock()
+
+    def write(self, label: str, line: str):
+        with self.lock:
+            self.stream.write(f"{label:<{self.width}} | {line.rstrip()}\n")
+            self.stream.flush()
+
+
+def _kill_group(process: subprocess.Popen):
+    # Along with anything it started, like ssh's ProxyCommand
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+class _Running:
+    """Commands which are running, so an interrupt can stop all of them.
+
+    Each runs in its own session, out of reach of the terminal's Ctrl-C.
+    """
+
+    def __init__(self):
+        self.processes = set()
+        self.stopped = False
+        self.lock = threading.Lock()
+
+    def start(self, command, env) -> Optional[subprocess.Popen]:
+        with self.lock:
+            if self.stopped:
+                return None
+            process = subprocess.Popen(
+                command,
+                env=env,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                universal_newlines=True,
+                errors="replace",
+                start_new_session=True,
+            )
+            self.processes.add(process)
+            return process
+
+    def finished(self, process: subprocess.Popen):
+        with self.lock:
+            self.processes.discard(process)
+
+    def stop(self):
+        with self.lock:
+            self.stopped = True
+            for process in self.processes:
+                _kill_group(process)
+
+
+def _run_one(
+    label: str,
+    command: Sequence[str],
+    timeout: Optional[float],
+    output,
+    env: Optional[Dict[str, str]],
+    running: _Running,
+) -> Result:
+    start = time.monotonic()
+    process = running.start(command, env)
+    if process is None:
+        return Result(label, -signal.SIGINT, 0)
+
+    timed_out = threading.Event()
+
+    def _kill():
+        timed_out.set()
+        _kill_group(process)
+
+    timer = threading.Timer(timeout, _kill) if timeout else None
+    if timer:
+        timer.start()
+    try:
+        for line in process.stdout:
+            output.write(label, line)
+        returncode = process.wait()
+    finally:
+        if timer:
+            timer.cancel()
+        running.finished(process)
+
+    return Result(label, returncode, time.monotonic() - start, timed_out.is_set())
+
+
+def _run_with_retries(
+    label: str,
+    command: Sequence[str],
+    timeout: Optional[float],
+    output,
+    env: Optional[Dict[str, str]],
+    retries: int,
+    running: _Running,
+) -> Result:
+    start = time.monotonic()
+    for attempt in range(1, retries + 2):
+        result = _run_one(label, command, timeout, output, env, running)
+        if result.ok or attempt > retries or running.stopped:
+            break
+
+        delay = RETRY_DELAY * 2 ** (attempt - 1)
+        output.write(label, f"failed, retrying in {delay:.0f}s")
+        time.sleep(delay)
+    return result._replace(duration=time.monotonic() - start, attempts=attempt)
+
+
+class _Progress:
+    """Reports each host as it finishes, with how many are done so far."""
+
+    def __init__(self, stream: Optional[TextIO], total: int):
+        self.stream = stream
+        self.total = total
+        self.done = 0
+        self.lock = threading.Lock()
+
+    def finished(self, result: Result):
+        if self.stream is None:
+            return
+
+        status = "ok" if result.ok else "timed out" if result.timed_out else "failed"
+        with self.lock:
+            self.done += 1
+            self.stream.write(
+                f"[{self.done}/{self.total}] {result.label}: {status}"
+                f" in {result.duration:.1f}s\n"
+            )
+            self.stream.flush()
+
+
+def run_parallel(
+    commands: List[Tuple],
+    workers: int = 16,
+    timeout: Optional[float] = None,
+    stream: TextIO = sys.stdout,
+    retries: int = 0,
+    progress: Optional[TextIO] = None,
+) -> List[Result]:
+    """Run (label, command) pairs on a bounded pool, streaming prefixed output.
+
+    A command may be followed by the environment to run it in, as a third
+    item. Failed commands are run again up to retries times, waiting longer
+    before each attempt. With progress, a line is written there as each
+    command finishes. Results are returned in the same order as the commands.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    if not commands:
+        return []
+
+    output = _PrefixedOutput(stream, max(len(labelled[0]) for labelled in commands))
+    tracker = _Progress(progress, len(commands))
+    running = _Running()
+
+    def _run(labelled):
+        label, command, env = (*labelled, None)[:3]
+        result = _run_with_retries(
+            label, command, timeout, output, env, retries, running
+        )
+        tracker.finished(result)
+        return result
+
+    with ThreadPoolExecutor(max_workers=min(workers, len(commands))) as executor:
+        try:
+            return list(executor.map(_run, commands))
+        except KeyboardInterrupt:
+            # Otherwise the pool would wait for every command to finish
+            running.stop()
+            raise
+
+
+def _attempts(result: Result) -> str:
+    return f" ({result.attempts} attempts)" if result.attempts > 1 else ""
+
+
+def summarise(results: List[Result]) -> List[str]:
+    succeeded = [result for result in results if result.ok]
+    timed_out = [result for result in results if result.timed_out]
+    failed = [result for result in results if not result.ok and not result.timed_out]
+
+    lines = [
+        f"{len(succeeded)} succeeded, {len(failed)} failed, "
+        f"{len(timed_out)} timed out"
+    ]
+    lines.extend(
+        f"  {result.label}: exit {result.returncode}{_attempts(result)}"
+        for result in failed
+    )
+    lines.extend(
+        f"  {result.label}: timed out after {result.duration:.0f}s{_attempts(result)}"
+        for result in timed_out
+    )
+    return lines
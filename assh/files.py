@@ -0,0 +1,42 @@
+"""Files shared by every assh process, which may be read or written at once."""
+import json
+import os
+import threading
+
+from pathlib import Path
+from typing import Callable, TypeVar, Union
+
+T = TypeVar("T")
+
+
+def atomic_write(path: Path, data: Union[str, bytes], mode: int = 0o666):
+    """Replace the file at path, so readers never see it partially written.
+
+    The file is created with mode, less the umask, before anything is written.
+    """
+    # Unique to each thread, as threads may write the same file at once
+    tmp_path = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+    descriptor = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+    try:
+        with os.fdopen(descriptor, "wb" if isinstance(data, bytes) else "w") as file:
+            file.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def atomic_write_json(path: Path, value, mode: int = 0o666):
+    atomic_write(path, json.dumps(value), mode)
+
+
+def update_json(path: Path, load: Callable[[], T], change: Callable[[T], None]) -> T:
+    """Apply a change on top of whatever other assh processes have saved.
+
+    Saving only what this process loaded would drop anything they've written
+    since. Returns the saved value.
+    """
+    value = load()
+    change(value)
+    atomic_write_json(path, value)
+    return value
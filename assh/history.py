@@ -0,0 +1,138 @@
+"""Remember what each query resolved to, and which instances are used most.
+
+The history maps normalised queries to the instance they last connected to,
+so repeating a query can skip searching the inventory. It also counts visits
+to each instance, to rank them by frecency: how often and how recently they
+were used.
+"""
+import json
+import time
+
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from assh.config import TOOL_DIR
+from assh.files import update_json
+from assh.instance import Instance
+
+HISTORY_PATH = TOOL_DIR / "history.json"
+
+MAX_QUERIES = 500
+MAX_HOSTS = 200
+
+# Visits count for more the more recent the last one was
+HOUR = 60 * 60
+RECENCY_WEIGHTS = ((HOUR, 4), (24 * HOUR, 2), (7 * 24 * HOUR, 0.5))
+OLD_WEIGHT = 0.25
+
+
+def normalize_query(query: str) -> str:
+    return " ".join(query.lower().split())
+
+
+def frecency(host: dict, now: float) -> float:
+    age = now - host["last"]
+    weight = next(
+        (weight for limit, weight in RECENCY_WEIGHTS if age <= limit), OLD_WEIGHT
+    )
+    return host["visits"] * weight
+
+
+class History:
+    """Queries and visited instances, stored on disk between runs."""
+
+    def __init__(self, path: Path = HISTORY_PATH):
+        self.path = path
+        self._history = None
+
+    @property
+    def history(self) -> dict:
+        if self._history is None:
+            self._history = self._load()
+        return self._history
+
+    def _load(self) -> dict:
+        try:
+            with open(self.path) as history_file:
+                history = json.load(history_file)
+        except (OSError, ValueError):
+            history = {}
+        history.setdefault("queries", {})
+        history.setdefault("hosts", {})
+        return history
+
+    def _update(self, change):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._history = update_json(self.path, self._load, change)
+
+    def remembered(self, query: str) -> Optional[str]:
+        """The ID of the instance the query last connected to."""
+        return self.history["queries"].get(normalize_query(query))
+
+    def recent(self, limit: Optional[int] = None) -> List[str]:
+        """Instance IDs, most frecent first."""
+        hosts = self.history["hosts"]
+        now = time.time()
+        ranked = sorted(hosts, key=lambda key: frecency(hosts[key], now), reverse=True)
+        return ranked[:limit]
+
+    def last(self) -> Optional[str]:
+        """The ID of the instance connected to most recently."""
+        hosts = self.history["hosts"]
+        return max(hosts, key=lambda host: hosts[host]["last"], default=None)
+
+    def last_used(self) -> Dict[str, float]:
+        """When each instance was last connected to, by ID."""
+        return {
+            instance_id: host["last"]
+            for instance_id, host in self.history["hosts"].items()
+        }
+
+    def host(self, instance_id: str) -> Optional[dict]:
+        return self.history["hosts"].get(instance_id)
+
+    def record(self, query: Optional[str], instance: Instance):
+        """Remember a connection, and that the query meant this instance.
+
+        Empty queries aren't remembered, as they'd always mean the same one.
+        """
+        now = time.time()
+        normalized = normalize_query(query or "")
+
+        def _change(history):
+            queries = history["queries"]
+            if normalized:
+                # Reinserted, so the oldest queries are first to be dropped
+                queries.pop(normalized, None)
+                queries[normalized] = instance.id
+            for stale in list(queries)[: max(len(queries) - MAX_QUERIES, 0)]:
+                del queries[stale]
+
+            hosts = history["hosts"]
+            host = hosts.setdefault(instance.id, {"visits": 0})
+            host.update(name=instance.name, visits=host["visits"] + 1, last=now)
+            if len(hosts) > MAX_HOSTS:
+                # Never the one just visited, which is new and so has few visits
+                others = [key for key in hosts if key != instance.id]
+                ranked = sorted(others, key=lambda key: frecency(hosts[key], now))
+                for dropped in ranked[: len(hosts) - MAX_HOSTS]:
+                    _forget(history, dropped)
+
+        self._update(_change)
+
+    def forget_query(self, query: str):
+        normalized = normalize_query(query)
+        self._update(lambda history: history["queries"].pop(normalized, None))
+
+    def forget(self, instance_id: str):
+        """Drop an instance which no longer exists, and every query meaning it."""
+        self._update(lambda history: _forget(history, instance_id))
+
+
+def _forget(history: dict, instance_id: str):
+    history["hosts"].pop(instance_id, None)
+    history["queries"] = {
+        query: remembered
+        for query, remembered in history["queries"].items()
+        if remembered != instance_id
+    }
@@ -0,0 +1,169 @@
+import json
+import logging
+
+from collections import defaultdict
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional
+
+from assh.collector import endpoint_of, get_collector, make_client
+from assh.files import update_json
+from assh.instance import Instance, _principal, _session
+from assh.timings import span
+
+# describe_images accepts at most 200 values for a single filter
+MAX_IMAGES_PER_CALL = 200
+
+
+def _chunks(items: List[str], size: int):
+    for start in range(0, len(items), size):
+        yield items[start : start + size]
+
+
+async def _describe_images(collector, ec2, endpoint, image_ids: List[str]) -> dict:
+    from botocore.exceptions import ClientError
+
+    try:
+        images = await collector.call(endpoint, ec2.describe_images, ImageIds=image_ids)
+    except ClientError as exc:
+        # A single deregistered image fails the whole ImageIds call, whereas a
+        # filter simply leaves it out of the response
+        logging.info("Falling back to an image-id filter: %s", exc)
+        images = await collector.call(
+            endpoint,
+            ec2.describe_images,
+            Filters=[{"Name": "image-id", "Values": image_ids}],
+        )
+
+    return {
+        image["ImageId"]: {
+            "Name": image.get("Name", ""),
+            "Description": image.get("Description", ""),
+        }
+        for image in images["Images"]
+    }
+
+
+def _client(group):
+    """The EC2 client and endpoint for one account and region.
+
+    Made on the calling thread, never the collector's loop, as assuming a role
+    waits on the loop itself.
+    """
+    profile, region, role = group
+    ec2 = make_client(_session(profile, region, role), "ec2")
+    return ec2, endpoint_of(ec2, _principal(profile, role))
+
+
+async def _describe_group(collector, client, image_ids) -> Optional[dict]:
+    """Describe the images used in one account and region.
+
+    Returns None if they couldn't be described, so one account denying
+    ec2:DescribeImages doesn't stop the others being cached.
+    """
+    import asyncio
+    from botocore.exceptions import BotoCoreError, ClientError
+
+    ec2, endpoint = client
+    try:
+        described = await asyncio.gather(
+            *(
+                _describe_images(collector, ec2, endpoint, chunk)
+                for chunk in _chunks(sorted(image_ids), MAX_IMAGES_PER_CALL)
+            )
+        )
+    except (BotoCoreError, ClientError) as exc:
+        logging.warning("Couldn't describe images for %s: %s", endpoint, exc)
+        return None
+
+    found = {image_id: {} for image_id in image_ids}
+    for images in described:
+        found.update(images)
+    return found
+
+
+class ImageCache:
+    """Persistent cache of AMI names and descriptions, keyed by image ID.
+
+    AMI metadata is immutable, so entries never expire.
+    """
+
+    def __init__(self, cache_dir: Path):
+        self.path = cache_dir / "images.json"
+        self._images = None
+        # Image IDs which couldn't be described, so they aren't asked for
+        # once per instance using them
+        self.failed = set()
+
+    @property
+    def images(self) -> Dict[str, dict]:
+        if self._images is None:
+            self._images = self._load()
+        return self._images
+
+    def _load(self) -> Dict[str, dict]:
+        try:
+            with open(self.path) as cache_file:
+                return json.load(cache_file)
+        except (OSError, ValueError):
+            return {}
+
+    def _save(self, new_images: Dict[str, dict]):
+        self._images = update_json(
+            self.path, self._load, lambda images: images.update(new_images)
+        )
+
+    def prefetch(self, instances: Iterable[Instance]):
+        """Fetch every uncached image used by the instances, all at once."""
+        import asyncio
+        from botocore.exceptions import BotoCoreError, ClientError
+
+        missing = defaultdict(set)
+        for instance in instances:
+            if instance.image not in self.images and instance.image not in self.failed:
+                missing[(instance.profile, instance.region, instance.role)].add(
+                    instance.image
+                )
+
+        clients = {}
+        for group, image_ids in missing.items():
+            try:
+                clients[group] = _client(group)
+            except (BotoCoreError, ClientError) as exc:
+                logging.warning("Couldn't describe images for %s: %s", group, exc)
+                self.failed.update(image_ids)
+
+        if not clients:
+            return
+
+        collector = get_collector()
+
+        async def _describe_all():
+            return await asyncio.gather(
+                *(
+                    _describe_group(collector, client, missing[group])
+                    for group, client in clients.items()
+                )
+            )
+
+        # Images that no longer exist are remembered as empty, so they aren't
+        # re-queried. Those which couldn't be described are only tried again
+        # by the next assh process.
+        fetched = {}
+        images = sum(len(missing[group]) for group in clients)
+        with span("describe_images", images=images):
+            results = collector.run(_describe_all())
+        for group, found in zip(clients, results):
+            if found is None:
+                self.failed.update(missing[group])
+            else:
+                fetched.update(found)
+
+        if fetched:
+            self._save(fetched)
+
+    def get(self, instance: Instance) -> Optional[dict]:
+        """The instance's image, or None if it couldn't be described."""
+        if instance.image not in self.images:
+            self.prefetch([instance])
+
+        return self.images.get(instance.image)
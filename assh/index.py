@@ -0,0 +1,249 @@
+import bisect
+
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional, Sequence, Set
+
+from assh.query import TAG_PREFIX, Query, Term, parse_query
+
+NGRAM = 3
+
+# Queries starting with this can only match an ID by prefix
+ID_PREFIX = "i-"
+
+
+def _ngrams(text: str) -> Set[str]:
+    return {text[start : start + NGRAM] for start in range(len(text) - NGRAM + 1)}
+
+
+def _ngram_index(keys: Iterable[Iterable[str]]) -> Dict[str, List[int]]:
+    ngrams = defaultdict(list)
+    for position, instance_keys in enumerate(keys):
+        instance_ngrams = set()
+        for key in instance_keys:
+            instance_ngrams |= _ngrams(key.lower())
+
+        for ngram in instance_ngrams:
+            ngrams[ngram].append(position)
+    return ngrams
+
+
+# Attributes indexed by value for key=value queries, along with every tag.
+# IDs are served by the sorted IDs, and IPs are unique enough to scan for.
+TERM_FIELDS = (
+    "name",
+    "state",
+    "type",
+    "image",
+    "keyname",
+    "az",
+    "profile",
+    "region",
+    "account_id",
+    "role",
+    "ssm_ping",
+)
+
+
+def _field(instance: dict, field: str) -> Optional[str]:
+    if field == "name":
+        return instance["tags"].get("Name", "")
+    return instance.get(field)
+
+
+def _term_index(instances: List[dict]) -> Dict[str, List[int]]:
+    """Map each lowercased field=value and tag:key=value to its instances."""
+    terms = defaultdict(list)
+    for position, instance in enumerate(instances):
+        instance_terms = {
+            f"{field}={_field(instance, field).lower()}"
+            for field in TERM_FIELDS
+            if _field(instance, field) is not None
+        }
+        instance_terms.update(
+            f"{TAG_PREFIX}{key.lower()}={value.lower()}"
+            for key, value in instance["tags"].items()
+        )
+
+        for term in instance_terms:
+            terms[term].append(position)
+    return terms
+
+
+def build_index(instances: List[dict], tag_keys: Sequence[str] = ()) -> dict:
+    """Build the search index for a list of serialised instances.
+
+    The result is JSON serialisable so it can be stored alongside the cache.
+    """
+    by_id = sorted(
+        range(len(instances)), key=lambda position: instances[position]["id"]
+    )
+
+    return {
+        "tag_keys": list(tag_keys),
+        "ids": [instances[position]["id"] for position in by_id],
+        "id_positions": by_id,
+        # IDs are indexed apart from names and tags, as ID-shaped queries are
+        # served by the sorted IDs instead
+        "id_ngrams": _ngram_index([instance["id"]] for instance in instances),
+        "ngrams": _ngram_index(
+            [instance["tags"].get(key, "") for key in ("Name", *tag_keys)]
+            for instance in instances
+        ),
+        "terms": _term_index(instances),
+    }
+
+
+def matches(instance: dict, query: str, tag_keys: Sequence[str] = ()) -> bool:
+    lowered = query.lower()
+    return query in instance["id"] or any(
+        lowered in instance["tags"].get(key, "").lower()
+        for key in ("Name", *tag_keys)
+    )
+
+
+class _TermTable:
+    """Terms in sorted order, so those sharing a prefix can be found together."""
+
+    def __init__(self, terms: Dict[str, List[int]]):
+        self.terms = terms
+        self.sorted_terms = sorted(terms)
+
+    def __len__(self):
+        return len(self.sorted_terms)
+
+    def __getitem__(self, index):
+        return self.sorted_terms[index]
+
+    def get(self, term: str, default=()):
+        return self.terms.get(term, default)
+
+
+class SearchIndex:
+    def __init__(self, index: dict, instances: List[dict]):
+        self.instances = instances
+        self.tag_keys = index["tag_keys"]
+        self.ids = index["ids"]
+        self.id_positions = index["id_positions"]
+        self.id_ngrams = index["id_ngrams"]
+        self.ngrams = index["ngrams"]
+        self._exact = index.get("exact")
+
+        self.terms = index["terms"]
+        if isinstance(self.terms, dict):
+            self.terms = _TermTable(self.terms)
+
+    @classmethod
+    def build(cls, instances: List[dict], tag_keys: Sequence[str] = ()):
+        return cls(build_index(instances, tag_keys), instances)
+
+    def exact(self, instance_id: str):
+        if self._exact is None:
+            self._exact = dict(zip(self.ids, self.id_positions))
+        return self._exact.get(instance_id)
+
+    def id_prefix(self, prefix: str) -> List[int]:
+        start = bisect.bisect_left(self.ids, prefix)
+        end = bisect.bisect_left(self.ids, prefix + "\uffff", lo=start)
+        return self.id_positions[start:end]
+
+    @staticmethod
+    def _ngram_candidates(ngrams: Dict[str, List[int]], query: str) -> List[int]:
+        # Everything matching the query contains all of its n-grams, so the
+        # shortest posting list is a complete candidate set
+        return min(
+            (ngrams.get(ngram, []) for ngram in _ngrams(query.lower())), key=len
+        )
+
+    def value(self, position: int, field: str) -> Optional[str]:
+        # Binary shards decode single fields, rather than whole instances
+        field_of = getattr(self.instances, "field", None)
+        if field_of is not None:
+            return field_of(position, field)
+        return _field(self.instances[position], field)
+
+    def _term_positions(self, term: Term) -> Optional[Set[int]]:
+        """Every instance the term matches, or None if it can't be looked up."""
+        if term.field == "id":
+            return {
+                position
+                for position in self.id_prefix(term.literal_prefix)
+                if term.matches(self.value(position, "id"))
+            }
+        if term.field is not None and term.field not in TERM_FIELDS:
+            return None
+
+        prefix = term.index_prefix
+        if term.is_exact:
+            return set(self.terms.get(prefix + term.pattern))
+
+        # Wildcards are matched against every value starting with the same
+        # literal text, which sit next to each other in the sorted terms
+        start = prefix + term.literal_prefix
+        positions = set()
+        for index in range(bisect.bisect_left(self.terms, start), len(self.terms)):
+            indexed = self.terms[index]
+            if not indexed.startswith(start):
+                break
+            if term.matches(indexed[len(prefix) :]):
+                positions.update(self.terms.get(indexed))
+        return positions
+
+    def select(self, query: Query) -> List[int]:
+        """Return the positions of every instance matching a structured query.
+
+        Terms are looked up in the inverted index and intersected, so only the
+        instances they select are ever decoded.
+        """
+        candidates = None
+        scanned = []
+        for term in query.terms:
+            positions = self._term_positions(term)
+            if positions is None:
+                scanned.append(term)
+                continue
+
+            candidates = positions if candidates is None else candidates & positions
+            if not candidates:
+                return []
+
+        if query.text:
+            found = set(self._search_text(query.text))
+            candidates = found if candidates is None else candidates & found
+
+        if candidates is None:
+            candidates = range(len(self.instances))
+        return sorted(
+            position
+            for position in candidates
+            if all(term.matches(self.value(position, term.field)) for term in scanned)
+        )
+
+    def search(self, query: str) -> List[int]:
+        """Return the positions of every instance matching the query."""
+        parsed = parse_query(query)
+        if parsed.terms:
+            return self.select(parsed)
+        return self._search_text(query)
+
+    def _search_text(self, query: str) -> List[int]:
+        position = self.exact(query)
+        if position is not None:
+            return [position]
+
+        if len(query) < NGRAM:
+            # Too short to use the index, and likely to match most instances
+            candidates: Iterable[int] = range(len(self.instances))
+        else:
+            if query.startswith(ID_PREFIX):
+                id_candidates = self.id_prefix(query)
+            else:
+                id_candidates = self._ngram_candidates(self.id_ngrams, query)
+
+            candidates = set(id_candidates)
+            candidates.update(self._ngram_candidates(self.ngrams, query))
+
+        return sorted(
+            position
+            for position in candidates
+            if matches(self.instances[position], query, self.tag_keys)
+        )
@@ -1,12 +1,70 @@
-import re
+import datetime
+import json
 
-from typing import List, Optional
+from typing import Dict, Iterator, List, Optional, Set
 
-import boto3
+from assh.collector import endpoint_of, get_collector, make_client
+from assh.credentials import assume_role
+from assh.timings import span
+from assh.usernames import compile_rules
+
+
+def _session(
+    profile: Optional[str] = None,
+    region: Optional[str] = None,
+    role: Optional[str] = None,
+):
+    # boto3 takes hundreds of milliseconds to import, so it's only imported
+    # once assh actually needs to talk to AWS, never when serving from cache
+    import boto3
+
+    if role is None:
+        return boto3.session.Session(profile_name=profile, region_name=region)
+
+    credentials = assume_role(profile, role)
+    return boto3.session.Session(
+        aws_access_key_id=credentials["AccessKeyId"],
+        aws_secret_access_key=credentials["SecretAccessKey"],
+        aws_session_token=credentials["SessionToken"],
+        # The profile still supplies the default region
+        profile_name=profile,
+        region_name=region,
+    )
+
+
+def _principal(profile: Optional[str], role: Optional[str]) -> Optional[str]:
+    """Who calls are made as, so each assumed role gets its own rate limits."""
+    return role or profile
+
+
+SSM_ONLINE = "Online"
+
+# Ping status recorded for instances which aren't managed by SSM at all
+SSM_UNREGISTERED = "Unregistered"
 
 
 class Instance:
-    def __init__(self, aws_instance):
+    __slots__ = (
+        "id",
+        "state",
+        "type",
+        "image",
+        "keyname",
+        "private_ip",
+        "public_ip",
+        "profile",
+        "region",
+        "az",
+        "role",
+        "account_id",
+        "ssm_ping",
+        "_name",
+        "_tags",
+    )
+
+    def __init__(
+        self, aws_instance, profile=None, region=None, role=None, account_id=None
+    ):
         self.id = aws_instance["InstanceId"]
         self.state = aws_instance["State"]["Name"]
         self.type = aws_instance["InstanceType"]
@@ -18,14 +76,78 @@ class Instance:
 
         self.private_ip = aws_instance["PrivateIpAddress"]
         self.public_ip = aws_instance.get("PublicIpAddress")
+        self.az = (aws_instance.get("Placement") or {}).get("AvailabilityZone")
 
-        self.tags = {
-            pair["Key"]: pair["Value"] for pair in aws_instance.get("Tags", [])
-        }
+        # Projected responses carry explicit nulls for absent keys
+        self._name = None
+        self._tags = aws_instance.get("Tags") or []
+
+        # Where the instance was discovered, so follow-up API calls (and
+        # SSM sessions) go to the right account and region
+        self.profile = profile
+        self.region = region
+        self.role = role
+        self.account_id = account_id
+
+        # SSM agent ping status, filled in from the cache when it's known
+        self.ssm_ping = None
+
+    @classmethod
+    def from_fields(
+        cls,
+        id,
+        state,
+        type,
+        image,
+        keyname,
+        private_ip,
+        public_ip,
+        tags,
+        profile=None,
+        region=None,
+        name=None,
+        ssm_ping=None,
+        role=None,
+        account_id=None,
+        az=None,
+    ):
+        """Build an Instance straight from cached fields.
+
+        Tags can be a dict, a list of AWS Key/Value pairs, or a JSON string, and
+        are only decoded when first accessed. Passing the name alongside saves
+        decoding them just to display it.
+        """
+        instance = cls.__new__(cls)
+        instance.id = id
+        instance.state = state
+        instance.type = type
+        instance.image = image
+        instance.keyname = keyname
+        instance.private_ip = private_ip
+        instance.public_ip = public_ip
+        instance.az = az
+        instance.profile = profile
+        instance.region = region
+        instance.role = role
+        instance.account_id = account_id
+        instance.ssm_ping = ssm_ping
+        instance._name = name
+        instance._tags = tags
+        return instance
+
+    @property
+    def tags(self) -> dict:
+        if isinstance(self._tags, str):
+            self._tags = json.loads(self._tags)
+        elif isinstance(self._tags, list):
+            self._tags = {pair["Key"]: pair["Value"] for pair in self._tags}
+        return self._tags
 
     @property
     def name(self):
-        return self.tags.get("Name", "")
+        if self._name is None:
+            self._name = self.tags.get("Name", "")
+        return self._name
 
     def to_dict(self):
         return {
@@ -36,63 +158,195 @@ class Instance:
             "keyname": self.keyname,
             "private_ip": self.private_ip,
             "public_ip": self.public_ip,
+            "az": self.az,
             "tags": self.tags,
+            "profile": self.profile,
+            "region": self.region,
+            "role": self.role,
+            "account_id": self.account_id,
+            "ssm_ping": self.ssm_ping,
         }
 
     @classmethod
     def from_dict(cls, instance_dict):
-        return cls(
-            {
-                "InstanceId": instance_dict["id"],
-                "State": {"Name": instance_dict["state"]},
-                "InstanceType": instance_dict["type"],
-                "ImageId": instance_dict["image"],
-                "KeyName": instance_dict["keyname"],
-                "PrivateIpAddress": instance_dict["private_ip"],
-                "PublicIpAddress": instance_dict["public_ip"],
-                "Tags": [
-                    {"Key": key, "Value": value}
-                    for key, value in instance_dict["tags"].items()
-                ],
-            }
+        return cls.from_fields(
+            instance_dict["id"],
+            instance_dict["state"],
+            instance_dict["type"],
+            instance_dict["image"],
+            instance_dict["keyname"],
+            instance_dict["private_ip"],
+            instance_dict["public_ip"],
+            instance_dict["tags"],
+            profile=instance_dict.get("profile"),
+            region=instance_dict.get("region"),
+            ssm_ping=instance_dict.get("ssm_ping"),
+            role=instance_dict.get("role"),
+            account_id=instance_dict.get("account_id"),
+            az=instance_dict.get("az"),
         )
 
-    def default_username(self, custom_rules: Optional[list] = None) -> str:
-        ec2 = boto3.client("ec2")
-        images = ec2.describe_images(ImageIds=[self.image])
-        image = images["Images"][0]
-        # Some images come back without a Description key
-        description = image.get("Description", "").lower()
+    def default_username(
+        self, custom_rules: Optional[list] = None, image_cache=None
+    ) -> str:
+        if image_cache is not None:
+            image = image_cache.get(self)
+        else:
+            ec2 = _session(self.profile, self.region, self.role).client("ec2")
+            images = ec2.describe_images(ImageIds=[self.image])
+            image = images["Images"][0]
+
+        return compile_rules(custom_rules).resolve(image or {})
 
-        if custom_rules and isinstance(custom_rules, list):
-            for rule in custom_rules:
-                if "image-name" in rule and re.search(
-                    rule["image-name"], image["Name"]
-                ):
-                    return rule["username"]
 
-                if "description" in rule and re.search(
-                    rule["description"], description
-                ):
-                    return rule["username"]
+# Only the fields Instance reads are kept from each page, so the rest of the
+# (very large) describe_instances payload can be dropped as soon as it's parsed.
+# Reservations are kept for the account ID they carry.
+INSTANCE_PROJECTION = (
+    "Reservations[].{"
+    "OwnerId: OwnerId, "
+    "Instances: Instances[].{"
+    "InstanceId: InstanceId, "
+    "State: State, "
+    "InstanceType: InstanceType, "
+    "ImageId: ImageId, "
+    "KeyName: KeyName, "
+    "PrivateIpAddress: PrivateIpAddress, "
+    "PublicIpAddress: PublicIpAddress, "
+    "Placement: {AvailabilityZone: Placement.AvailabilityZone}, "
+    "Tags: Tags"
+    "}"
+    "}"
+)
 
-        if "ubuntu" in description:
-            return "ubuntu"
+RUNNING_FILTER = {"Name": "instance-state-name", "Values": ["running"]}
 
-        if "centos" in description:
-            return "centos"
+PAGE_SIZE = 1000
 
-        return "ec2-user"  # Default to amazon linux / RHEL default username
+# describe_instances accepts at most this many instance IDs per call
+MAX_INSTANCE_IDS = 1000
 
+# describe_instance_information returns at most 50 instances per page
+SSM_PAGE_SIZE = 50
 
-def get_instances() -> List[Instance]:
-    ec2 = boto3.client("ec2")
-    instances = ec2.describe_instances()
 
-    instances = [
-        instance
-        for r in instances["Reservations"]
-        for instance in r["Instances"]
-        if instance["State"]["Name"] == "running"
+def iter_instances(
+    profile: Optional[str] = None,
+    region: Optional[str] = None,
+    instance_ids: Optional[List[str]] = None,
+    role: Optional[str] = None,
+    launched_on: Optional[List[str]] = None,
+) -> Iterator[Instance]:
+    import jmespath
+
+    filters = [RUNNING_FILTER]
+    if launched_on:
+        # Launch times only match exactly, or a whole day with a wildcard
+        filters.append(
+            {"Name": "launch-time", "Values": [f"{day}T*" for day in launched_on]}
+        )
+
+    session = _session(profile, region, role)
+    ec2 = make_client(session, "ec2")
+    endpoint = endpoint_of(ec2, _principal(profile, role))
+
+    if instance_ids is None:
+        requests = [{"MaxResults": PAGE_SIZE}]
+    else:
+        # MaxResults can't be combined with InstanceIds
+        requests = [
+            {"InstanceIds": instance_ids[start : start + MAX_INSTANCE_IDS]}
+            for start in range(0, len(instance_ids), MAX_INSTANCE_IDS)
+        ]
+
+    collector = get_collector()
+    for request in requests:
+        pages = collector.pages(
+            endpoint, ec2.describe_instances, Filters=filters, **request
+        )
+
+        # Pages are fetched and projected one at a time
+        for page in pages:
+            for reservation in jmespath.search(INSTANCE_PROJECTION, page) or []:
+                for instance in reservation["Instances"] or []:
+                    yield Instance(
+                        instance,
+                        profile=profile,
+                        region=session.region_name,
+                        role=role,
+                        account_id=reservation["OwnerId"],
+                    )
+
+
+def get_instances(
+    profile: Optional[str] = None,
+    region: Optional[str] = None,
+    instance_ids: Optional[List[str]] = None,
+    role: Optional[str] = None,
+) -> List[Instance]:
+    with span("describe_instances", region=region or "default"):
+        return list(iter_instances(profile, region, instance_ids, role))
+
+
+def get_launched_since(
+    profile: Optional[str] = None,
+    region: Optional[str] = None,
+    since: float = 0,
+    role: Optional[str] = None,
+) -> List[Instance]:
+    """Get running instances launched, or started again, on or after since's day.
+
+    Starting a stopped instance resets its launch time, and usually changes
+    its public IP.
+    """
+    first = datetime.datetime.fromtimestamp(since, datetime.timezone.utc).date()
+    today = datetime.datetime.now(datetime.timezone.utc).date()
+    days = [
+        (first + datetime.timedelta(days=offset)).isoformat()
+        for offset in range((today - first).days + 1)
     ]
-    return [Instance(instance) for instance in instances]
+    with span("describe_instances", region=region or "default"):
+        return list(iter_instances(profile, region, role=role, launched_on=days))
+
+
+def get_running_ids(
+    profile: Optional[str] = None,
+    region: Optional[str] = None,
+    role: Optional[str] = None,
+) -> Set[str]:
+    """Get the IDs of every running instance, without describing them in full."""
+    ec2 = make_client(_session(profile, region, role), "ec2")
+    # Only running instances are returned without IncludeAllInstances
+    pages = get_collector().pages(
+        endpoint_of(ec2, _principal(profile, role)),
+        ec2.describe_instance_status,
+        MaxResults=PAGE_SIZE,
+    )
+
+    with span("describe_instance_status", region=region or "default"):
+        return {
+            status["InstanceId"]
+            for page in pages
+            for status in page["InstanceStatuses"]
+        }
+
+
+def get_ssm_ping_statuses(
+    profile: Optional[str] = None,
+    region: Optional[str] = None,
+    role: Optional[str] = None,
+) -> Dict[str, str]:
+    """Get the SSM agent ping status of every managed instance, by instance ID."""
+    ssm = make_client(_session(profile, region, role), "ssm")
+    pages = get_collector().pages(
+        endpoint_of(ssm, _principal(profile, role)),
+        ssm.describe_instance_information,
+        MaxResults=SSM_PAGE_SIZE,
+    )
+
+    with span("describe_instance_information", region=region or "default"):
+        return {
+            information["InstanceId"]: information["PingStatus"]
+            for page in pages
+            for information in page["InstanceInformationList"]
+        }
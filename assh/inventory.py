@@ -0,0 +1,118 @@
+"""Render the cached inventory as an ssh_config file for plain ssh to use."""
+import logging
+import re
+
+from collections import Counter
+from pathlib import Path
+from typing import List, Optional
+
+from assh.caching import _shard_name, _unique
+from assh.config import CONFIG_PATH, get_cache_options, get_targets, load_config
+from assh.connection import destination_settings, resolve_key_path, resolve_mode
+from assh.exceptions import NoRouteException
+from assh.images import ImageCache
+from assh.index import matches
+from assh.instance import Instance
+from assh.ssh_config import SSHConfig, write_if_changed
+from assh.store import read_shard
+from assh.usernames import UsernameResolver
+
+HEADER = "# Generated by assh from its instance cache, any changes will be lost\n"
+
+# Names which can be used as a Host alias without quoting
+ALIAS = re.compile(r"^[\w.-]+$")
+
+
+def _aliases(instances: List[Instance]) -> dict:
+    """Name each instance's Host block by ID, and by its Name tag where unique."""
+    name_counts = Counter(instance.name for instance in instances)
+    return {
+        instance.id: (
+            f"{instance.id} {instance.name}"
+            if name_counts[instance.name] == 1 and ALIAS.match(instance.name)
+            else instance.id
+        )
+        for instance in instances
+    }
+
+
+def _find_via(instances: List[Instance], query: Optional[str]):
+    if not query:
+        return None
+
+    found = [instance for instance in instances if matches(instance.to_dict(), query)]
+    if len(found) != 1:
+        logging.warning(
+            "ssh-config via '%s' matched %d instances, not jumping", query, len(found)
+        )
+        return None
+    return found[0]
+
+
+def _route(instance: Instance) -> str:
+    mode = resolve_mode(instance, "auto", None)
+
+    # Plain ssh has no way to hand an assumed role's credentials on to the
+    # AWS CLI, so instances found through roles can only be reached directly
+    if instance.role and mode != "ssh":
+        if not instance.public_ip:
+            raise NoRouteException(f"{instance.id} can only be reached through SSM")
+        mode = "ssh"
+    return mode
+
+
+def render_inventory(
+    config: dict, instances: List[Instance], usernames: UsernameResolver
+) -> SSHConfig:
+    """Build a Host block for every instance there's a known route to.
+
+    Instances are routed as with --mode auto, except that those without a
+    public IP or SSM are reached through the ssh-config via host, if set.
+    """
+    instances = sorted(instances, key=lambda instance: instance.id)
+    aliases = _aliases(instances)
+    via_instance = _find_via(instances, config.get("ssh-config", {}).get("via"))
+
+    sshconf = SSHConfig()
+    for instance in instances:
+        jump_host = None
+        try:
+            mode = _route(instance)
+        except NoRouteException:
+            if via_instance is None or via_instance is instance:
+                logging.info("No route to %s, leaving it out", instance.id)
+                continue
+            mode, jump_host = "ssh", via_instance.id
+
+        # Plain ssh can't start a session without SSH, so use ssm-ssh instead
+        if mode == "ssm":
+            mode = "ssm-ssh"
+
+        key_path = resolve_key_path(config, instance, None)
+        sshconf.add_host(
+            aliases[instance.id],
+            **destination_settings(
+                instance, mode, jump_host, None, key_path, usernames
+            ),
+        )
+
+    return sshconf
+
+
+def update_ssh_config(cache_dir: Path, path: Path) -> bool:
+    """Render every configured target's shard into path, if anything changed."""
+    config = load_config(CONFIG_PATH)
+    shard_format = get_cache_options(config)["shard_format"]
+
+    instances = []
+    for target in get_targets(config):
+        shard = read_shard(cache_dir, _shard_name(target), shard_format)
+        if shard is not None:
+            instances.extend(shard.instance(position) for position in range(len(shard)))
+
+    usernames = UsernameResolver(config, ImageCache(cache_dir))
+    sshconf = render_inventory(config, list(_unique(instances)), usernames)
+    written = write_if_changed(path, HEADER + sshconf.render())
+    if written:
+        logging.info("Wrote ssh_config for %d instances to %s", len(instances), path)
+    return written
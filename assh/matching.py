@@ -0,0 +1,128 @@
+"""Rank instances by how well they match a query, to choose between them."""
+import heapq
+import time
+
+from typing import Dict, Iterable, List, Optional, Sequence
+
+from assh.index import SearchIndex
+from assh.instance import Instance
+from assh.query import parse_query
+
+# How well a query word matches a field, from best to worst
+EXACT = 100
+PREFIX = 60
+WORD_PREFIX = 40
+SUBSTRING = 20
+FUZZY = 5
+
+# Tags other than Name say less about which instance was meant
+TAG_WEIGHT = 0.5
+
+# Recently used instances get up to this much extra, halving each week
+RECENCY_BONUS = 30
+RECENCY_HALF_LIFE = 7 * 24 * 60 * 60
+
+
+def _is_subsequence(word: str, text: str) -> bool:
+    remaining = iter(text)
+    return all(char in remaining for char in word)
+
+
+def _word_score(word: str, text: str) -> float:
+    if not text:
+        return 0
+    if word == text:
+        return EXACT
+
+    # Between matches of the same kind, those covering more of the field win
+    coverage = len(word) / len(text)
+    if text.startswith(word):
+        return PREFIX + coverage
+
+    position = text.find(word)
+    if position < 0:
+        return FUZZY + coverage if _is_subsequence(word, text) else 0
+
+    while position >= 0:
+        # Matching the start of a word in a name like "api-prod-1"
+        if not text[position - 1].isalnum():
+            return WORD_PREFIX + coverage
+        position = text.find(word, position + 1)
+    return SUBSTRING + coverage
+
+
+def score(
+    instance: Instance,
+    words: Sequence[str],
+    tag_keys: Sequence[str] = (),
+    last_used: Optional[float] = None,
+    now: Optional[float] = None,
+) -> Optional[float]:
+    """Score an instance against the lowercased words of a query.
+
+    Every word must match the ID, Name or one of the tags, in any order, or
+    the instance doesn't match at all and None is returned.
+    """
+    fields = [(instance.id.lower(), 1), (instance.name.lower(), 1)]
+    fields.extend((instance.tags.get(key, "").lower(), TAG_WEIGHT) for key in tag_keys)
+
+    total = 0.0
+    for word in words:
+        best = max(_word_score(word, text) * weight for text, weight in fields)
+        if not best:
+            return None
+        total += best
+
+    if last_used is not None:
+        age = (now or time.time()) - last_used
+        total += RECENCY_BONUS * 0.5 ** (max(age, 0) / RECENCY_HALF_LIFE)
+    return total
+
+
+def rank(
+    instances: Iterable[Instance],
+    query: str,
+    limit: int = 10,
+    tag_keys: Sequence[str] = (),
+    last_used: Optional[Dict[str, float]] = None,
+) -> List[Instance]:
+    """Return the best matching instances, best first.
+
+    Only the top results are kept while scoring, so ranking a large inventory
+    never sorts the whole of it. last_used maps instance IDs to when they were
+    last connected to.
+    """
+    words = query.lower().split()
+    last_used = last_used or {}
+    now = time.time()
+
+    def _scored():
+        for instance in instances:
+            found = score(instance, words, tag_keys, last_used.get(instance.id), now)
+            if found is not None:
+                yield found, instance
+
+    return [
+        instance
+        for _, instance in heapq.nlargest(limit, _scored(), key=lambda pair: pair[0])
+    ]
+
+
+def exact_match(instances: Iterable[Instance], query: str) -> Optional[Instance]:
+    """The only instance whose ID or Name is exactly the query, if there is one."""
+    lowered = query.lower()
+    found = [
+        instance
+        for instance in instances
+        if lowered in (instance.id.lower(), instance.name.lower())
+    ]
+    return found[0] if len(found) == 1 else None
+
+
+def still_matches(instance: Instance, query: str, tag_keys: Sequence[str] = ()) -> bool:
+    """Whether a query would still find the instance, as it did when remembered."""
+    parsed = parse_query(query)
+    if parsed.terms:
+        index = SearchIndex.build([instance.to_dict()], tag_keys)
+        return bool(index.select(parsed))
+    return score(instance, query.lower().split(), tag_keys) is not None
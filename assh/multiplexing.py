@@ -0,0 +1,60 @@
+"""Book-keeping for the SSH ControlMaster sockets assh creates."""
+import datetime
+import json
+import os
+import subprocess
+
+from pathlib import Path
+from typing import List
+
+
+def control_dir(tool_dir: Path) -> Path:
+    path = tool_dir / "cm"
+    if not path.exists():
+        # Anyone who can reach a master socket can use its connection
+        os.makedirs(path, mode=0o700)
+    return path
+
+
+def register_master(tool_dir: Path, name: str, **details):
+    details["created_at"] = datetime.datetime.now(datetime.timezone.utc).timestamp()
+    with open(control_dir(tool_dir) / f"{name}.json", "w+") as details_file:
+        json.dump(details, details_file)
+
+
+def _control(socket_path: Path, command: str) -> bool:
+    # The host argument is required by ssh, but unused with -O
+    result = subprocess.run(
+        ["ssh", "-O", command, "-S", str(socket_path), "assh-master"],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    return result.returncode == 0
+
+
+def _forget(socket_path: Path):
+    for path in (socket_path, socket_path.with_suffix(".json")):
+        if path.exists():
+            os.remove(path)
+
+
+def list_masters(tool_dir: Path) -> List[dict]:
+    """List live masters, cleaning up after any which have exited."""
+    masters = []
+    for details_path in sorted(control_dir(tool_dir).glob("cm-*.json")):
+        socket_path = details_path.with_suffix("")
+        if not (socket_path.exists() and _control(socket_path, "check")):
+            _forget(socket_path)
+            continue
+
+        with open(details_path) as details_file:
+            details = json.load(details_file)
+        masters.append(dict(details, name=socket_path.name))
+    return masters
+
+
+def close_master(tool_dir: Path, name: str) -> bool:
+    socket_path = control_dir(tool_dir) / name
+    closed = socket_path.exists() and _control(socket_path, "exit")
+    _forget(socket_path)
+    return closed
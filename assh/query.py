@@ -0,0 +1,107 @@
+"""Parse structured queries like ``env=prod type=m5.* az=eu-west-1a``.
+
+Words of the form key=value select instances by an attribute, or by a tag
+when the key isn't an attribute (``tag:Key=value`` always means a tag). Values
+are matched case-insensitively, and may use ``*`` and ``?`` wildcards. Every
+other word is free text, searched for in the ID, Name and search tags as
+before.
+"""
+import fnmatch
+import functools
+import re
+import shlex
+
+from typing import NamedTuple, Optional, Tuple
+
+# Query keys naming instance attributes, and the field each one reads
+ATTRIBUTES = {
+    "id": "id",
+    "name": "name",
+    "state": "state",
+    "type": "type",
+    "image": "image",
+    "ami": "image",
+    "key": "keyname",
+    "keyname": "keyname",
+    "ip": "private_ip",
+    "private-ip": "private_ip",
+    "public-ip": "public_ip",
+    "profile": "profile",
+    "region": "region",
+    "az": "az",
+    "account": "account_id",
+    # Plain "role" is left for the Role tag many fleets use
+    "iam-role": "role",
+    "ssm": "ssm_ping",
+}
+
+TAG_PREFIX = "tag:"
+
+TERM = re.compile(r"^(?P<key>[^=\s]+)=(?P<value>.*)$")
+WILDCARDS = re.compile(r"[*?\[]")
+
+
+class Term(NamedTuple):
+    """One key=value word. Exactly one of field and tag is set."""
+
+    field: Optional[str]
+    tag: Optional[str]
+    pattern: str
+
+    @property
+    def index_prefix(self) -> str:
+        """Where this term's values sit in the inverted index."""
+        if self.field is not None:
+            return f"{self.field}="
+        return f"{TAG_PREFIX}{self.tag}="
+
+    @property
+    def literal_prefix(self) -> str:
+        """The pattern up to its first wildcard."""
+        return WILDCARDS.split(self.pattern, 1)[0]
+
+    @property
+    def is_exact(self) -> bool:
+        return not WILDCARDS.search(self.pattern)
+
+    def matches(self, value: Optional[str]) -> bool:
+        return fnmatch.fnmatchcase((value or "").lower(), self.pattern)
+
+
+class Query(NamedTuple):
+    terms: Tuple[Term, ...]
+    text: str
+
+
+def _term(key: str, value: str) -> Term:
+    key, value = key.lower(), value.lower()
+    if key.startswith(TAG_PREFIX):
+        return Term(None, key[len(TAG_PREFIX) :], value)
+    if key in ATTRIBUTES:
+        return Term(ATTRIBUTES[key], None, value)
+    return Term(None, key, value)
+
+
+@functools.lru_cache(maxsize=64)
+def parse_query(query: str) -> Query:
+    """Split a query into key=value terms and free text.
+
+    Parsed queries are kept, as the same query is run against every shard.
+    """
+    try:
+        words = shlex.split(query)
+    except ValueError:
+        # An unbalanced quote, so take it as typed
+        words = query.split()
+
+    terms = []
+    text = []
+    for word in words:
+        match = TERM.match(word)
+        if match:
+            terms.append(_term(match["key"], match["value"]))
+        else:
+            text.append(word)
+
+    # Queries without terms are searched exactly as typed, spaces and all
+    return Query(tuple(terms), " ".join(text) if terms else query)
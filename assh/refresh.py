@@ -0,0 +1,23 @@
+"""Background cache refresher, spawned by assh.caching when serving stale data."""
+import json
+import sys
+
+from pathlib import Path
+
+from assh.caching import refresh_instances
+from assh.config import Target
+
+
+def main(argv):
+    cache_dir, payload = argv
+    payload = json.loads(payload)
+    refresh_instances(
+        Path(cache_dir),
+        [Target(*target) for target in payload["targets"]],
+        blocking=False,
+        **payload["options"],
+    )
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,3 +1,29 @@
+import hashlib
+import json
+
+from pathlib import Path
+
+from assh.files import atomic_write
+
+
+def control_socket_name(destination: dict, jump: dict = None) -> str:
+    """Name a ControlMaster socket after everything which identifies the connection.
+
+    The jump host is included, so the same destination reached by different
+    routes gets a master of its own.
+    """
+    identity = {
+        "destination": {
+            key: destination.get(key) for key in ("HostName", "Port", "User")
+        },
+        "jump": jump
+        and {key: jump.get(key) for key in ("HostName", "Port", "User")},
+    }
+    digest = hashlib.sha1(json.dumps(identity, sort_keys=True).encode())
+    # Kept short, as unix socket paths are limited to around 100 characters
+    return f"cm-{digest.hexdigest()[:16]}"
+
+
 class SSHConfig:
     def __init__(self):
         self.configuration = {}
@@ -5,12 +31,32 @@ class SSHConfig:
     def add_host(self, name, **kwargs):
         self.configuration[name] = kwargs
 
-    def write(self, config_file):
+    def enable_multiplexing(self, name, control_path, persist="10m"):
+        self.configuration[name].update(
+            ControlMaster="auto", ControlPath=control_path, ControlPersist=persist
+        )
+
+    def render(self) -> str:
         lines = []
         for hostname, conf in self.configuration.items():
             lines.append(f"Host {hostname}")
             for key, value in conf.items():
                 lines.append(f"\t{key} {value}")
 
-        for line in lines:
-            config_file.write(f"{line}\n")
+        return "".join(f"{line}\n" for line in lines)
+
+    def write(self, config_file):
+        config_file.write(self.render())
+
+
+def write_if_changed(path: Path, content: str) -> bool:
+    """Replace the file at path with content, unless it already matches.
+
+    Returns whether the file was written.
+    """
+    if path.exists() and path.read_text() == content:
+        return False
+
+    # Replaced atomically, as ssh may be reading the file at any time
+    atomic_write(path, content)
+    return True
@@ -0,0 +1,465 @@
+"""On-disk formats for cache shards.
+
+A shard holds the instances fetched for one profile and region, plus the
+search index built over them. Two formats are supported:
+
+* ``json``, a single JSON document which is fully decoded on every load.
+* ``binary``, fixed-size records of string references into a deduplicated
+  string table, followed by the search index. The file is memory-mapped and
+  only the records that are actually looked at get decoded.
+"""
+import array
+import bisect
+import contextlib
+import json
+import mmap
+import os
+import struct
+
+from pathlib import Path
+from typing import Iterator, List, Optional, Sequence
+
+from assh.files import atomic_write
+from assh.index import SearchIndex, build_index
+from assh.instance import Instance
+
+FORMATS = ("binary", "json")
+
+MAGIC = b"ASSH"
+VERSION = 2
+
+# Magic, format version, number of records, fetch timestamp
+HEADER = struct.Struct("=4sHId")
+
+# Offset and length of each section, in bytes
+SECTION = struct.Struct("=QQ")
+(
+    RECORDS,
+    STRING_OFFSETS,
+    STRING_DATA,
+    ID_ORDER,
+    ID_NGRAMS,
+    NGRAMS,
+    TERMS,
+    POSTINGS,
+    META,
+) = range(9)
+SECTION_COUNT = 9
+
+# Serialised instance fields stored in each record, in order. Tags are kept
+# as a JSON string, with Name duplicated alongside so searching never has to
+# decode them. Shards list their own fields, so fields can be added without
+# invalidating existing shards.
+FIELDS = (
+    "id",
+    "state",
+    "type",
+    "image",
+    "keyname",
+    "private_ip",
+    "public_ip",
+    "az",
+    "profile",
+    "region",
+    "role",
+    "account_id",
+    "ssm_ping",
+    "name",
+    "tags",
+)
+
+NULL = 0xFFFFFFFF
+
+
+class JsonShard:
+    def __init__(self, shard: dict):
+        self.shard = shard
+        self.fetched_at = shard.get("fetched_at", 0)
+        self.instances = shard.get("instances", [])
+        self.meta = shard.get("meta", {})
+
+    @classmethod
+    def read(cls, path: Path):
+        with open(path) as cache_file:
+            shard = json.load(cache_file)
+        if not isinstance(shard, dict):
+            raise ValueError(f"{path} is not an assh shard")
+        return cls(shard)
+
+    def __len__(self):
+        return len(self.instances)
+
+    def record(self, position: int) -> dict:
+        return self.instances[position]
+
+    def field(self, position: int, field: str):
+        if field == "name":
+            return self.instances[position]["tags"].get("Name", "")
+        return self.instances[position].get(field)
+
+    def records(self) -> Iterator[dict]:
+        return iter(self.instances)
+
+    def instance(self, position: int) -> Instance:
+        return Instance.from_dict(self.instances[position])
+
+    def search_index(self, tag_keys: Sequence[str]) -> SearchIndex:
+        index = self.shard.get("index")
+        # Shards written before indexing, or with other search tags configured
+        if not index or "terms" not in index or index["tag_keys"] != list(tag_keys):
+            return SearchIndex.build(self.instances, tag_keys)
+
+        return SearchIndex(index, self.instances)
+
+
+def write_json(
+    path: Path,
+    fetched_at: float,
+    instances: List[dict],
+    tag_keys: Sequence[str],
+    meta: Optional[dict] = None,
+) -> JsonShard:
+    shard = {
+        "fetched_at": fetched_at,
+        "instances": instances,
+        "index": build_index(instances, tag_keys),
+        "meta": meta or {},
+    }
+    atomic_write(path, json.dumps(shard).encode())
+    return JsonShard(shard)
+
+
+class _StringTable:
+    def __init__(self):
+        self.ids = {}
+        self.offsets = array.array("I", [0])
+        self.data = bytearray()
+
+    def add(self, value: Optional[str]) -> int:
+        if value is None:
+            return NULL
+
+        string_id = self.ids.get(value)
+        if string_id is None:
+            string_id = self.ids[value] = len(self.offsets) - 1
+            self.data += value.encode()
+            self.offsets.append(len(self.data))
+        return string_id
+
+
+def _ngram_table(ngrams: dict, strings: _StringTable, postings: array.array):
+    table = array.array("I")
+    for ngram in sorted(ngrams):
+        positions = ngrams[ngram]
+        table.extend((strings.add(ngram), len(postings), len(positions)))
+        postings.extend(positions)
+    return table
+
+
+def write_binary(
+    path: Path,
+    fetched_at: float,
+    instances: List[dict],
+    tag_keys: Sequence[str],
+    meta: Optional[dict] = None,
+) -> "BinaryShard":
+    index = build_index(instances, tag_keys)
+    strings = _StringTable()
+
+    records = array.array("I")
+    for instance in instances:
+        for field in FIELDS:
+            if field == "name":
+                value = instance["tags"].get("Name", "")
+            elif field == "tags":
+                value = json.dumps(instance["tags"])
+            else:
+                value = instance.get(field)
+            records.append(strings.add(value))
+
+    postings = array.array("I")
+    id_ngrams = _ngram_table(index["id_ngrams"], strings, postings)
+    ngrams = _ngram_table(index["ngrams"], strings, postings)
+    terms = _ngram_table(index["terms"], strings, postings)
+
+    meta = dict(meta or {}, fields=FIELDS, tag_keys=index["tag_keys"])
+    sections = [
+        records.tobytes(),
+        strings.offsets.tobytes(),
+        bytes(strings.data),
+        array.array("I", index["id_positions"]).tobytes(),
+        id_ngrams.tobytes(),
+        ngrams.tobytes(),
+        terms.tobytes(),
+        postings.tobytes(),
+        json.dumps(meta).encode(),
+    ]
+
+    header = HEADER.pack(MAGIC, VERSION, len(instances), fetched_at)
+    offset = HEADER.size + SECTION.size * SECTION_COUNT
+    table = bytearray()
+    for section in sections:
+        # Keep every section aligned for the uint32 views taken over them
+        offset += -offset % 4
+        table += SECTION.pack(offset, len(section))
+        offset += len(section)
+
+    data = bytearray(header + table)
+    for section in sections:
+        data += bytes(-len(data) % 4)
+        data += section
+
+    atomic_write(path, bytes(data))
+    return BinaryShard(path)
+
+
+class _SortedIds:
+    """Instance IDs in sorted order, decoded as they're probed."""
+
+    def __init__(self, shard):
+        self.shard = shard
+
+    def __len__(self):
+        return len(self.shard._id_order)
+
+    def __getitem__(self, index):
+        return self.shard.field(self.shard._id_order[index], "id")
+
+    def get(self, instance_id: str, default=None):
+        position = bisect.bisect_left(self, instance_id)
+        if position < len(self) and self[position] == instance_id:
+            return self.shard._id_order[position]
+        return default
+
+
+class _NgramTable:
+    """Sorted n-gram (or term) posting lists, looked up by binary search."""
+
+    def __init__(self, shard, table: memoryview):
+        self.shard = shard
+        self.table = table
+
+    def __len__(self):
+        return len(self.table) // 3
+
+    def __getitem__(self, index):
+        return self.shard.string(self.table[index * 3])
+
+    def get(self, ngram: str, default=()):
+        index = bisect.bisect_left(self, ngram)
+        if index == len(self) or self[index] != ngram:
+            return default
+
+        start, count = self.table[index * 3 + 1], self.table[index * 3 + 2]
+        return self.shard._postings[start : start + count]
+
+
+class _SearchView:
+    """The parts of each record SearchIndex matches queries against."""
+
+    def __init__(self, shard, tag_keys: Sequence[str]):
+        self.shard = shard
+        self.tag_keys = tag_keys
+
+    def __len__(self):
+        return len(self.shard)
+
+    def field(self, position: int, field: str):
+        return self.shard.field(position, field)
+
+    def __getitem__(self, position):
+        if self.tag_keys:
+            tags = json.loads(self.shard.field(position, "tags"))
+        else:
+            tags = {"Name": self.shard.field(position, "name")}
+        return {"id": self.shard.field(position, "id"), "tags": tags}
+
+
+class BinaryShard:
+    def __init__(self, path: Path):
+        with open(path, "rb") as shard_file:
+            self._mmap = mmap.mmap(shard_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if len(self._mmap) < HEADER.size + SECTION.size * SECTION_COUNT:
+            raise ValueError(f"{path} is truncated")
+
+        magic, version, self._count, self.fetched_at = HEADER.unpack_from(
+            self._mmap, 0
+        )
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a version {VERSION} assh shard")
+
+        view = memoryview(self._mmap)
+        sections = []
+        for section in range(SECTION_COUNT):
+            offset, length = SECTION.unpack_from(
+                self._mmap, HEADER.size + SECTION.size * section
+            )
+            if offset + length > len(self._mmap):
+                raise ValueError(f"{path} is truncated")
+            sections.append(view[offset : offset + length])
+
+        self._records = sections[RECORDS].cast("I")
+        self._string_offsets = sections[STRING_OFFSETS].cast("I")
+        self._string_data = sections[STRING_DATA]
+        self._id_order = sections[ID_ORDER].cast("I")
+        self._id_ngrams = sections[ID_NGRAMS].cast("I")
+        self._ngrams = sections[NGRAMS].cast("I")
+        self._terms = sections[TERMS].cast("I")
+        self._postings = sections[POSTINGS].cast("I")
+        self.meta = json.loads(bytes(sections[META]))
+
+        self._field_index = {
+            field: index for index, field in enumerate(self.meta["fields"])
+        }
+        self._field_count = len(self.meta["fields"])
+        if len(self._records) < self._count * self._field_count:
+            raise ValueError(f"{path} is damaged")
+
+    def __len__(self):
+        return self._count
+
+    def string(self, string_id: int) -> Optional[str]:
+        if string_id == NULL:
+            return None
+
+        start = self._string_offsets[string_id]
+        end = self._string_offsets[string_id + 1]
+        return str(self._string_data[start:end], "utf-8")
+
+    def field(self, position: int, field: str):
+        index = self._field_index.get(field)
+        if index is None:
+            return None
+        return self.string(self._records[position * self._field_count + index])
+
+    def record(self, position: int) -> dict:
+        record = {
+            field: self.field(position, field)
+            for field in FIELDS
+            if field not in ("name", "tags")
+        }
+        record["tags"] = json.loads(self.field(position, "tags"))
+        return record
+
+    def records(self) -> Iterator[dict]:
+        return (self.record(position) for position in range(len(self)))
+
+    def instance(self, position: int) -> Instance:
+        field = self.field
+        return Instance.from_fields(
+            field(position, "id"),
+            field(position, "state"),
+            field(position, "type"),
+            field(position, "image"),
+            field(position, "keyname"),
+            field(position, "private_ip"),
+            field(position, "public_ip"),
+            # Decoded by Instance if they're ever needed
+            field(position, "tags"),
+            profile=field(position, "profile"),
+            region=field(position, "region"),
+            name=field(position, "name"),
+            ssm_ping=field(position, "ssm_ping"),
+            role=field(position, "role"),
+            account_id=field(position, "account_id"),
+            az=field(position, "az"),
+        )
+
+    def search_index(self, tag_keys: Sequence[str]) -> SearchIndex:
+        if self.meta["tag_keys"] != list(tag_keys):
+            return SearchIndex.build(list(self.records()), tag_keys)
+
+        sorted_ids = _SortedIds(self)
+        index = {
+            "tag_keys": self.meta["tag_keys"],
+            "ids": sorted_ids,
+            "id_positions": self._id_order,
+            "id_ngrams": _NgramTable(self, self._id_ngrams),
+            "ngrams": _NgramTable(self, self._ngrams),
+            "terms": _NgramTable(self, self._terms),
+            "exact": sorted_ids,
+        }
+        return SearchIndex(index, _SearchView(self, tag_keys))
+
+
+def shard_path(cache_dir: Path, name: str, shard_format: str) -> Path:
+    suffix = "bin" if shard_format == "binary" else "json"
+    return cache_dir / f"instances-{name}.{suffix}"
+
+
+def _convert(json_path: Path, path: Path):
+    # Other assh processes may be converting the same shard, which is harmless
+    # as each writes the same contents atomically
+    try:
+        legacy = JsonShard.read(json_path)
+    except FileNotFoundError:
+        # Converted and removed by one of them already
+        return
+    except ValueError:
+        # Truncated, so it's refetched instead
+        legacy = None
+
+    if legacy is not None:
+        write_binary(
+            path,
+            legacy.fetched_at,
+            legacy.instances,
+            legacy.shard.get("index", {}).get("tag_keys", []),
+            legacy.meta,
+        )
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(json_path)
+
+
+def remove_legacy_cache(cache_dir: Path):
+    """Remove the single cache file assh used before caching each target apart.
+
+    It doesn't record which profile it was fetched with, so it's refetched
+    rather than converted.
+    """
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(cache_dir / "instances-default.json")
+
+
+def read_shard(cache_dir: Path, name: str, shard_format: str):
+    """Read a shard, or return None if there isn't a usable one.
+
+    JSON shards are converted the first time they're read as binary.
+    """
+    path = shard_path(cache_dir, name, shard_format)
+    if shard_format == "json":
+        try:
+            return JsonShard.read(path)
+        except FileNotFoundError:
+            return None
+        except ValueError:
+            # Damaged, so refetch it
+            return None
+
+    json_path = shard_path(cache_dir, name, "json")
+    if not path.exists() and json_path.exists():
+        _convert(json_path, path)
+
+    if not path.exists():
+        return None
+
+    try:
+        return BinaryShard(path)
+    except (struct.error, TypeError, ValueError, KeyError):
+        # Written by another version of assh, or damaged, so refetch it
+        return None
+
+
+def write_shard(
+    cache_dir: Path,
+    name: str,
+    shard_format: str,
+    fetched_at: float,
+    instances: List[dict],
+    tag_keys: Sequence[str],
+    meta: Optional[dict] = None,
+):
+    path = shard_path(cache_dir, name, shard_format)
+    writer = write_binary if shard_format == "binary" else write_json
+    return writer(path, fetched_at, instances, tag_keys, meta)
@@ -4,6 +4,8 @@ import pytest
 
 from moto.ec2 import mock_ec2
 
+from assh.instance import Instance
+
 PUBLIC_INSTANCE_NAME = "Public Instance"
 PRIVATE_INSTANCE_NAME = "Private Instance"
 INSTANCE_TYPE = "t3.micro"
@@ -18,6 +20,32 @@ DEFAULT_INSTANCE_KWARGS = {
 }
 
 
+def make_instance(
+    instance_id: str = "i-123abc",
+    name: str = None,
+    image: str = "ami-123",
+    keyname: str = None,
+    public_ip: str = None,
+    tags: dict = None,
+    **fields,
+) -> Instance:
+    """A running instance, as it would be read from the cache."""
+    tags = dict(tags or {})
+    if name is not None:
+        tags["Name"] = name
+    return Instance.from_fields(
+        instance_id,
+        "running",
+        INSTANCE_TYPE,
+        image,
+        keyname,
+        "10.0.0.1",
+        public_ip,
+        tags,
+        **fields,
+    )
+
+
 @pytest.fixture(name="ec2", scope="session")
 def ec2():
     with mock_ec2():
@@ -1,18 +1,26 @@
 """Tests the caching functionality"""
 import datetime
+import functools
 import json
+import time
 import unittest.mock
 
 from pathlib import Path
 
+import boto3
 import botostubs
 import pytest
 
+from moto import mock_sts
+
 import assh.caching
 
 from assh.caching import get_instances, get_instance
+from assh.config import Target
+from assh.credentials import assume_role
 from assh.exceptions import TooManyResultsException, NoResultsException
 from assh.instance import Instance
+from assh.tests.conftest import DEFAULT_INSTANCE_KWARGS, IMAGE_NAME, make_instance
 
 
 @pytest.fixture(name="cache_dir")
@@ -25,7 +33,7 @@ def fxt_cache_dir(tmp_path: Path):
 def test_get_instances_caches_result(
     ec2: botostubs.EC2, cache_dir: Path, mocker, public_aws_instance
 ):
-    expected_path = cache_dir / "instances-default.json"
+    expected_path = cache_dir / "instances-default-default.json"
 
     assert not expected_path.exists()
 
@@ -33,7 +41,7 @@ def test_get_instances_caches_result(
         assh.caching, "_get_fresh_instances"
     )
 
-    instances = get_instances(cache_dir)
+    instances = get_instances(cache_dir, shard_format="json")
 
     assert expected_path.exists()
     assert type(instances[0]) == Instance
@@ -49,7 +57,7 @@ def test_get_instances_caches_result(
     datetime.datetime.fromtimestamp(cache["fetched_at"])
 
     # Expected that this will get from cache
-    cached_instances = get_instances(cache_dir)
+    cached_instances = get_instances(cache_dir, shard_format="json")
 
     # Test that the casting works when retreiving from cache
     assert type(cached_instances[0]) == Instance
@@ -89,3 +97,236 @@ def test_too_specific(ec2: botostubs.EC2, cache_dir: Path):
     """Tests exception is raised when no results were found."""
     with pytest.raises(NoResultsException):
         get_instance(cache_dir, "Lorem Ipsum Dolor Sit Amet")
+
+
+def test_get_instances_per_region_shards(
+    ec2: botostubs.EC2, cache_dir: Path, public_aws_instance
+):
+    """Tests that each region is cached in its own shard and merged."""
+    targets = [Target(region="us-east-1"), Target(region="eu-west-1")]
+
+    instances = get_instances(cache_dir, targets)
+
+    assert (cache_dir / "instances-default-us-east-1.bin").exists()
+    assert (cache_dir / "instances-default-eu-west-1.bin").exists()
+
+    instance_ids = [instance.id for instance in instances]
+    assert public_aws_instance["InstanceId"] in instance_ids
+    assert all(instance.region == "us-east-1" for instance in instances)
+
+
+def _write_stale_shard(cache_dir: Path, age: float):
+    fetched_at = datetime.datetime.now(datetime.timezone.utc).timestamp() - age
+    instance = {
+        "id": "i-stale",
+        "state": "running",
+        "type": "t3.micro",
+        "image": "ami-stale",
+        "keyname": None,
+        "private_ip": "10.0.0.1",
+        "public_ip": None,
+        "tags": {"Name": "Stale Instance"},
+    }
+    with open(cache_dir / "instances-default-default.json", "w") as cache_file:
+        json.dump({"fetched_at": fetched_at, "instances": [instance]}, cache_file)
+
+
+def test_stale_while_revalidate_serves_cache(cache_dir: Path, mocker):
+    """Tests a stale shard is served while it's refreshed in the background."""
+    _write_stale_shard(cache_dir, age=120)
+    spy_fresh_instances = mocker.spy(assh.caching, "_get_fresh_instances")
+    spawn_refresher = mocker.patch.object(assh.caching, "_spawn_refresher")
+
+    instances = get_instances(cache_dir, stale_while_revalidate=True)
+
+    assert [instance.id for instance in instances] == ["i-stale"]
+    spawn_refresher.assert_called_once_with(cache_dir, [Target()], {})
+    spy_fresh_instances.assert_not_called()
+
+
+def test_stale_while_revalidate_respects_max_stale(
+    ec2: botostubs.EC2, cache_dir: Path, mocker, public_aws_instance
+):
+    """Tests a shard older than max-stale is refreshed before being served."""
+    _write_stale_shard(cache_dir, age=7200)
+    spawn_refresher = mocker.patch.object(assh.caching, "_spawn_refresher")
+
+    instances = get_instances(cache_dir, max_stale=3600, stale_while_revalidate=True)
+
+    assert "i-stale" not in [instance.id for instance in instances]
+    spawn_refresher.assert_not_called()
+
+
+def test_refresh_skips_locked_shards(cache_dir: Path, mocker):
+    """Tests a non-blocking refresh leaves shards another process is refreshing."""
+    spy_fresh_instances = mocker.spy(assh.caching, "_get_fresh_instances")
+    with assh.caching._shard_lock(cache_dir, Target()):
+        refreshed = assh.caching.refresh_instances(
+            cache_dir, [Target()], blocking=False
+        )
+
+    assert refreshed == {}
+    spy_fresh_instances.assert_not_called()
+
+
+def test_json_cache_is_migrated(cache_dir: Path, mocker):
+    """Tests an existing JSON cache is converted to the binary format."""
+    _write_stale_shard(cache_dir, age=0)
+    spy_fresh_instances = mocker.spy(assh.caching, "_get_fresh_instances")
+
+    instance = get_instance(cache_dir, "stale")
+
+    assert instance.id == "i-stale"
+    assert instance.name == "Stale Instance"
+    assert (cache_dir / "instances-default-default.bin").exists()
+    assert not (cache_dir / "instances-default-default.json").exists()
+    spy_fresh_instances.assert_not_called()
+
+
+def test_incremental_refresh(ec2: botostubs.EC2, cache_dir: Path, mocker):
+    """Tests an incremental refresh only describes new instances."""
+    # A region of its own, so instances from other tests don't interfere
+    regional_ec2 = boto3.client("ec2", region_name="us-west-2")
+    target = Target(region="us-west-2")
+
+    def _launch():
+        launched = regional_ec2.run_instances(
+            **DEFAULT_INSTANCE_KWARGS, ImageId=IMAGE_NAME
+        )
+        return launched["Instances"][0]["InstanceId"]
+
+    original_id = _launch()
+    assh.caching.refresh_instances(cache_dir, [target], incremental=True)
+
+    new_id = _launch()
+    regional_ec2.terminate_instances(InstanceIds=[original_id])
+    spy_fresh_instances = mocker.spy(assh.caching, "_get_fresh_instances")
+    # Moto doesn't support the launch-time filter
+    mocker.patch.object(assh.caching, "_get_launched_since", return_value=[])
+
+    refreshed = assh.caching.refresh_instances(cache_dir, [target], incremental=True)
+
+    spy_fresh_instances.assert_called_once_with(
+        profile=None, region="us-west-2", instance_ids=[new_id], role=None
+    )
+    shard = refreshed[target]
+    assert [shard.field(position, "id") for position in range(len(shard))] == [
+        new_id
+    ]
+    assert list(shard.meta["tombstones"]) == [original_id]
+    assert assh.caching.recently_removed(cache_dir, original_id, [target])
+    assert not assh.caching.recently_removed(cache_dir, new_id, [target])
+
+
+def test_incremental_refresh_picks_up_restarts(cache_dir: Path, mocker):
+    """Tests an instance stopped and started since the last refresh is described."""
+    _write_stale_shard(cache_dir, age=120)
+    restarted = make_instance(
+        "i-stale", "Stale Instance", image="ami-stale", public_ip="203.0.113.7"
+    )
+    mocker.patch.object(assh.caching, "_get_running_ids", return_value={"i-stale"})
+    launched_since = mocker.patch.object(
+        assh.caching, "_get_launched_since", return_value=[restarted]
+    )
+    spy_fresh_instances = mocker.spy(assh.caching, "_get_fresh_instances")
+
+    refreshed = assh.caching.refresh_instances(cache_dir, [Target()], incremental=True)
+
+    assert launched_since.call_args.kwargs["since"] < time.time() - 120
+    spy_fresh_instances.assert_not_called()
+    (instance,) = get_instances(cache_dir, [Target()])
+    assert instance.public_ip == "203.0.113.7"
+    assert refreshed[Target()].meta["tombstones"] == {}
+
+
+def test_ssm_ping_status_is_cached(ec2: botostubs.EC2, cache_dir: Path, mocker):
+    """Tests SSM ping statuses are fetched in one batch and stored per instance."""
+    regional_ec2 = boto3.client("ec2", region_name="ap-southeast-2")
+    target = Target(region="ap-southeast-2")
+    online_id, missing_id = [
+        instance["InstanceId"]
+        for instance in regional_ec2.run_instances(
+            **dict(DEFAULT_INSTANCE_KWARGS, MinCount=2, MaxCount=2),
+            ImageId=IMAGE_NAME,
+        )["Instances"]
+    ]
+    get_statuses = mocker.patch.object(
+        assh.caching, "_get_ssm_ping_statuses", return_value={online_id: "Online"}
+    )
+
+    assh.caching.refresh_instances(cache_dir, [target], ssm_status=True)
+    instances = get_instances(cache_dir, [target])
+
+    get_statuses.assert_called_once_with(
+        profile=None, region="ap-southeast-2", role=None
+    )
+    statuses = {instance.id: instance.ssm_ping for instance in instances}
+    assert statuses == {online_id: "Online", missing_id: "Unregistered"}
+
+
+def test_refresh_renders_ssh_config(
+    ec2: botostubs.EC2, cache_dir: Path, public_aws_instance
+):
+    """Tests a refresh writes the inventory out as an ssh_config."""
+    ssh_config = cache_dir / "ssh_config"
+
+    assh.caching.refresh_instances(cache_dir, [Target()], ssh_config=str(ssh_config))
+
+    content = ssh_config.read_text()
+    assert content.startswith("# Generated by assh")
+    assert f"Host {public_aws_instance['InstanceId']}" in content
+    assert f"\tHostName {public_aws_instance['PublicIpAddress']}" in content
+
+
+def test_role_targets_are_tagged_with_account(
+    ec2: botostubs.EC2, cache_dir: Path, tmp_path: Path, mocker
+):
+    """Tests instances are fetched from a role's account, with its account ID."""
+    role = "arn:aws:iam::111111111111:role/assh"
+    mocker.patch(
+        "assh.instance.assume_role",
+        functools.partial(assume_role, credentials_dir=tmp_path / "credentials"),
+    )
+
+    with mock_sts():
+        credentials = assume_role(None, role, tmp_path / "credentials")
+        regional_ec2 = boto3.client(
+            "ec2",
+            region_name="eu-central-1",
+            aws_access_key_id=credentials["AccessKeyId"],
+            aws_secret_access_key=credentials["SecretAccessKey"],
+            aws_session_token=credentials["SessionToken"],
+        )
+        instance_id = regional_ec2.run_instances(
+            **DEFAULT_INSTANCE_KWARGS, ImageId=IMAGE_NAME
+        )["Instances"][0]["InstanceId"]
+
+        target = Target(region="eu-central-1", role=role)
+        (instance,) = get_instances(cache_dir, [target])
+
+    assert instance.id == instance_id
+    assert instance.account_id == "111111111111"
+    assert instance.role == role
+    assert (cache_dir / "instances-111111111111-assh-eu-central-1.bin").exists()
+
+
+def test_denied_role_is_left_out(
+    ec2: botostubs.EC2, cache_dir: Path, mocker, public_aws_instance
+):
+    """Tests a role which can't be assumed doesn't stop others being searched."""
+    from botocore.exceptions import ClientError
+
+    denied = ClientError(
+        {"Error": {"Code": "AccessDenied", "Message": "Not authorized"}},
+        "AssumeRole",
+    )
+    mocker.patch("assh.instance.assume_role", side_effect=denied)
+    targets = [Target(), Target(role="arn:aws:iam::111111111111:role/assh")]
+
+    instance_id = public_aws_instance["InstanceId"]
+    instances = get_instances(cache_dir, targets)
+    assert instance_id in [instance.id for instance in instances]
+    assert [
+        instance.id
+        for instance in assh.caching.find_instances(cache_dir, instance_id, targets)
+    ] == [instance_id]
@@ -0,0 +1,261 @@
+"""Tests for the command line entrypoint."""
+import datetime
+import os
+import subprocess
+import sys
+
+from pathlib import Path
+
+import pytest
+
+from click.testing import CliRunner
+
+import assh.cli
+
+from assh.exceptions import NoResultsException, TooManyResultsException
+from assh.history import History
+from assh.store import write_shard
+from assh.tests.conftest import make_instance
+
+CHECK_IMPORTS = """
+import sys
+from assh.cli import _autocomplete_instances
+print(_autocomplete_instances(None, [], "web"))
+heavy = ("boto3", "botocore", "yaml", "asyncio", "concurrent.futures")
+print(sorted(m for m in heavy if m in sys.modules))
+"""
+
+
+def _complete(home: Path):
+    env = dict(os.environ, HOME=str(home))
+    env.pop("AWS_PROFILE", None)
+    env.pop("AWS_DEFAULT_PROFILE", None)
+    return subprocess.run(
+        [sys.executable, "-c", CHECK_IMPORTS],
+        env=env,
+        stdout=subprocess.PIPE,
+        check=True,
+        universal_newlines=True,
+    ).stdout.splitlines()
+
+
+def _write_cache(home: Path):
+    cache_dir = home / ".assh" / "cache"
+    cache_dir.mkdir(parents=True)
+    fetched_at = datetime.datetime.now(datetime.timezone.utc).timestamp()
+    instance = {
+        "id": "i-123abc",
+        "state": "running",
+        "type": "t3.micro",
+        "image": "ami-123",
+        "keyname": None,
+        "private_ip": "10.0.0.1",
+        "public_ip": None,
+        "profile": None,
+        "region": None,
+        "tags": {"Name": "web"},
+    }
+    write_shard(cache_dir, "default-default", "binary", fetched_at, [instance], [])
+
+
+def test_completion_from_cache_avoids_heavy_imports(tmp_path: Path):
+    """Tests completing from a fresh cache never imports boto3, yaml or asyncio."""
+    _write_cache(tmp_path)
+
+    assert _complete(tmp_path) == ["[('i-123abc', 'web')]", "[]"]
+
+
+def test_config_snapshot_avoids_yaml(tmp_path: Path):
+    """Tests yaml is only imported to parse a config which has changed."""
+    _write_cache(tmp_path)
+    (tmp_path / ".assh" / "config.yaml").write_text("search-tags: [Role]\n")
+
+    assert _complete(tmp_path) == ["[('i-123abc', 'web')]", "['yaml']"]
+    assert _complete(tmp_path) == ["[('i-123abc', 'web')]", "[]"]
+
+
+AMBIGUOUS = [
+    make_instance("i-01", "web-prod"),
+    make_instance("i-02", "web"),
+    make_instance("i-03", "db"),
+]
+
+
+def test_ambiguous_query_offers_ranked_picker(mocker):
+    """Tests several matches are offered best first, instead of failing."""
+    mocker.patch.object(assh.cli, "_find_instances", return_value=AMBIGUOUS[:2])
+    mocker.patch.object(assh.cli, "_interactive", return_value=True)
+    prompt = mocker.patch("click.prompt", return_value=2)
+
+    assert assh.cli._get_instance({}, "we").id == "i-01"
+    prompt.assert_called_once()
+
+
+def test_ambiguous_query_without_terminal(mocker):
+    """Tests the best matches are listed when there's nobody to pick one."""
+    mocker.patch.object(assh.cli, "_find_instances", return_value=AMBIGUOUS[:2])
+    mocker.patch.object(assh.cli, "_interactive", return_value=False)
+
+    with pytest.raises(TooManyResultsException, match="web, web-prod"):
+        assh.cli._get_instance({}, "we")
+
+
+def test_query_words_match_in_any_order(mocker):
+    """Tests a query matching nothing as typed is retried against everything."""
+    find = mocker.patch.object(assh.cli, "_find_instances", side_effect=[[], AMBIGUOUS])
+    mocker.patch.object(assh.cli, "_interactive", return_value=True)
+    prompt = mocker.patch("click.prompt", return_value=1)
+
+    assert assh.cli._get_instance({}, "prod web").id == "i-01"
+    find.assert_called_with({}, "")
+    prompt.assert_called_once()
+
+
+def test_retried_query_is_never_connected_to_unasked(mocker):
+    """Tests a lone fuzzy match is only offered, never connected to."""
+    instances = [make_instance("i-01", "web-prod-1"), make_instance("i-02", "db-1")]
+    mocker.patch.object(assh.cli, "_find_instances", side_effect=[[], instances])
+    mocker.patch.object(assh.cli, "_interactive", return_value=False)
+
+    with pytest.raises(NoResultsException, match="did you mean: web-prod-1"):
+        assh.cli._get_instance({}, "bd")
+
+
+def _lookup(instances):
+    """A stand-in for _find_instances, counting the queries it's asked."""
+
+    def _find(config, query):
+        _find.queries.append(query)
+        return [instance for instance in instances if query in instance.id]
+
+    _find.queries = []
+    return _find
+
+
+def test_remembered_query_skips_search(tmp_path: Path, mocker):
+    """Tests a repeated query is resolved by ID, without searching or ranking."""
+    find = mocker.patch.object(assh.cli, "_find_instances", _lookup(AMBIGUOUS))
+    history = History(tmp_path / "history.json")
+    history.record("we", AMBIGUOUS[0])
+
+    assert assh.cli._resolve_instance({}, "WE", history).id == "i-01"
+    assert find.queries == ["i-01"]
+
+
+def test_remembered_instance_which_has_gone(tmp_path: Path, mocker):
+    """Tests instances missing from the inventory are forgotten."""
+    mocker.patch.object(assh.cli, "_find_instances", _lookup(AMBIGUOUS[1:]))
+    mocker.patch.object(assh.cli, "recently_removed", return_value=False)
+    mocker.patch.object(assh.cli, "_get_instance", return_value=AMBIGUOUS[1])
+    history = History(tmp_path / "history.json")
+    history.record("we", AMBIGUOUS[0])
+
+    assert assh.cli._resolve_instance({}, "we", history).id == "i-02"
+    assert history.remembered("we") is None
+    assert history.last() is None
+
+
+def test_last_host(tmp_path: Path, mocker):
+    """Tests "-" connects to the last instance which still exists."""
+    mocker.patch.object(assh.cli, "_find_instances", _lookup(AMBIGUOUS[1:]))
+    mocker.patch.object(assh.cli, "recently_removed", return_value=False)
+    history = History(tmp_path / "history.json")
+    history.record("web", AMBIGUOUS[1])
+    history.record("we", AMBIGUOUS[0])
+
+    assert assh.cli._resolve_instance({}, "-", history).id == "i-02"
+
+    history.forget("i-02")
+    with pytest.raises(NoResultsException):
+        assh.cli._resolve_instance({}, "-", history)
+
+
+
+def test_stopped_instance_is_remembered(tmp_path: Path, mocker):
+    """Tests an instance which just left the inventory is skipped, not forgotten."""
+    mocker.patch.object(assh.cli, "_find_instances", _lookup(AMBIGUOUS[1:]))
+    removed = mocker.patch.object(assh.cli, "recently_removed", return_value=True)
+    history = History(tmp_path / "history.json")
+    history.record("web", AMBIGUOUS[1])
+    history.record("we", AMBIGUOUS[0])
+
+    assert assh.cli._resolve_instance({}, "-", history).id == "i-02"
+    assert removed.call_args[0][1] == "i-01"
+    assert history.host("i-01") is not None
+    assert history.remembered("we") == "i-01"
+
+
+HOSTS = [
+    make_instance(f"i-0{number}", f"web-{number}", public_ip="203.0.113.1")
+    for number in (1, 2)
+]
+
+
+def _copy(mocker, tmp_path, sources, destination, pull):
+    run = mocker.patch.object(assh.cli, "run_parallel", return_value=[])
+    mocker.patch.object(assh.cli, "TOOL_DIR", tmp_path)
+    status = assh.cli._copy(
+        {},
+        HOSTS,
+        "ssh",
+        None,
+        "ec2-user",
+        "key.pem",
+        sources,
+        destination,
+        pull,
+        False,
+        4,
+        None,
+        1,
+    )
+    commands = [command[5:] for _, command, _ in run.call_args[0][0]]
+    return status, commands, run.call_args
+
+
+def test_copy_to_instances(tmp_path: Path, mocker):
+    """Tests files are copied to every instance by its ssh config host."""
+    status, commands, call = _copy(mocker, tmp_path, ["app.conf"], ":/etc/", False)
+
+    assert status == 0
+    assert commands == [
+        ["app.conf", "i-01:/etc/"],
+        ["app.conf", "i-02:/etc/"],
+    ]
+    assert call[1]["retries"] == 1
+
+
+def test_copy_from_instances(tmp_path: Path, mocker):
+    """Tests files copied from instances are kept apart, by instance."""
+    logs = tmp_path / "logs"
+    status, commands, _ = _copy(mocker, tmp_path, [":/var/log/a", ":/b"], logs, True)
+
+    assert commands == [
+        ["i-01:/var/log/a", "i-01:/b", str(logs / "web-1")],
+        ["i-02:/var/log/a", "i-02:/b", str(logs / "web-2")],
+    ]
+    assert (logs / "web-2").is_dir()
+
+
+@pytest.mark.parametrize("paths", [["a", "b"], [":a", ":b"], ["a", ":b", ":c"], [":a"]])
+def test_copy_needs_one_remote_side(paths):
+    """Tests copies must be wholly to or wholly from the instances."""
+    result = CliRunner().invoke(assh.cli.main, ["cp", "web", *paths])
+
+    assert result.exit_code == 2
+
+
+@pytest.mark.parametrize(
+    "args,command,rest",
+    [
+        (["web"], "connect", ["web"]),
+        (["recent"], "recent", []),
+        (["connect", "recent"], "connect", ["recent"]),
+    ],
+)
+def test_subcommands_shadow_queries(args, command, rest):
+    """Tests subcommand names run the subcommand, unless connect is given first."""
+    context = assh.cli.main.make_context("assh", args)
+
+    assert context.protected_args == [command]
+    assert context.args == rest
@@ -0,0 +1,108 @@
+"""Tests for the rate limited API collector."""
+import threading
+import time
+
+import pytest
+
+from botocore.exceptions import ClientError
+
+import assh.collector
+
+from assh.collector import Collector
+
+ENDPOINT = (None, "us-east-1", "ec2")
+
+
+def _error(code):
+    return ClientError({"Error": {"Code": code, "Message": code}}, "DescribeInstances")
+
+
+@pytest.fixture(name="collector")
+def fxt_collector(monkeypatch):
+    monkeypatch.setattr(assh.collector, "BASE_DELAY", 0.001)
+    return Collector(concurrency=2, rate=1000, burst=1000, max_attempts=4)
+
+
+def test_throttling_is_retried_and_slows_down(collector):
+    """Tests throttled calls are retried, and the endpoint's rate is lowered."""
+    responses = [_error("RequestLimitExceeded"), _error("Throttling"), {"ok": True}]
+
+    def operation():
+        response = responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    assert collector.run(collector.call(ENDPOINT, operation)) == {"ok": True}
+    assert collector.limits[ENDPOINT].bucket.rate < 1000
+
+
+def test_other_errors_are_raised(collector):
+    """Tests errors which aren't transient are raised without retrying."""
+    calls = []
+
+    def operation():
+        calls.append(1)
+        raise _error("UnauthorizedOperation")
+
+    with pytest.raises(ClientError):
+        collector.run(collector.call(ENDPOINT, operation))
+    assert len(calls) == 1
+
+
+def test_concurrency_is_limited_per_endpoint(collector):
+    """Tests no more than the configured number of calls run at once."""
+    lock = threading.Lock()
+    in_flight = []
+    peak = []
+
+    def operation():
+        with lock:
+            in_flight.append(1)
+            peak.append(len(in_flight))
+        time.sleep(0.05)
+        with lock:
+            in_flight.pop()
+
+    threads = [
+        threading.Thread(
+            target=collector.run, args=(collector.call(ENDPOINT, operation),)
+        )
+        for _ in range(6)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert max(peak) == 2
+
+
+def test_pages_follow_next_token(collector):
+    """Tests paginated calls continue until there's no NextToken."""
+    responses = {None: {"Items": [1], "NextToken": "a"}, "a": {"Items": [2]}}
+
+    def operation(NextToken=None):
+        return responses[NextToken]
+
+    pages = collector.pages(ENDPOINT, operation)
+    assert [page["Items"] for page in pages] == [[1], [2]]
+
+
+def test_token_bucket_limits_rate():
+    """Tests requests beyond the burst are spread out at the configured rate."""
+    collector = Collector(rate=50, burst=1)
+
+    start = time.monotonic()
+    for _ in range(6):
+        collector.run(collector.call(ENDPOINT, lambda: None))
+
+    assert time.monotonic() - start >= 0.09
+
+
+def test_reserve_workers_only_grows(collector):
+    """Tests the executor grows to fit every fetch thread, and never shrinks."""
+    collector.reserve_workers(200)
+    assert collector.workers == 200
+    collector.reserve_workers(10)
+    assert collector.workers == 200
@@ -0,0 +1,143 @@
+"""Tests for loading the assh configuration file."""
+import os
+
+from pathlib import Path
+
+import pytest
+
+import assh.config
+
+from assh.config import (
+    TOOL_DIR,
+    Target,
+    get_cache_options,
+    get_ssh_config_path,
+    get_targets,
+    load_config,
+)
+from assh.exceptions import ConfigException
+
+
+def test_missing_config(tmp_path: Path):
+    """Tests a missing config file loads as empty."""
+    assert load_config(tmp_path / "config.yaml") == {}
+
+
+def test_default_targets():
+    """Tests the ambient profile and region are used by default."""
+    assert get_targets({}) == [Target(None, None)]
+
+
+def test_configured_targets(tmp_path: Path):
+    """Tests every configured profile is paired with every region."""
+    config_path = tmp_path / "config.yaml"
+    config_path.write_text(
+        "aws-profiles: [dev, prod]\nregions: [eu-west-1, us-east-1]\n"
+    )
+
+    assert get_targets(load_config(config_path)) == [
+        Target("dev", "eu-west-1"),
+        Target("dev", "us-east-1"),
+        Target("prod", "eu-west-1"),
+        Target("prod", "us-east-1"),
+    ]
+
+
+def test_role_targets(tmp_path: Path):
+    """Tests every role is assumed in every region, from the source profile."""
+    config_path = tmp_path / "config.yaml"
+    config_path.write_text(
+        "regions: [eu-west-1]\n"
+        "role-source-profile: hub\n"
+        "roles: [arn:aws:iam::111111111111:role/assh]\n"
+    )
+
+    assert get_targets(load_config(config_path)) == [
+        Target(None, "eu-west-1"),
+        Target("hub", "eu-west-1", "arn:aws:iam::111111111111:role/assh"),
+    ]
+
+
+def test_cache_options():
+    """Tests cache options are read from the cache section."""
+    options = get_cache_options(
+        {
+            "cache": {
+                "ttl": 30,
+                "max-stale": 600,
+                "stale-while-revalidate": True,
+                "format": "json",
+                "incremental": True,
+                "full-refresh-interval": 900,
+                "ssm-status": True,
+                "fetch-workers": 200,
+            }
+        }
+    )
+
+    assert options == {
+        "ttl": 30,
+        "max_stale": 600,
+        "stale_while_revalidate": True,
+        "search_tags": [],
+        "shard_format": "json",
+        "incremental": True,
+        "full_refresh_interval": 900,
+        "ssm_status": True,
+        "fetch_workers": 200,
+        "ssh_config": None,
+    }
+
+
+def test_ssh_config_path():
+    """Tests the persistent ssh_config is only written once enabled."""
+    assert get_ssh_config_path({}) is None
+    assert get_ssh_config_path({"ssh-config": {"enabled": False}}) is None
+    assert get_ssh_config_path({"ssh-config": {"enabled": True}}) == (
+        TOOL_DIR / "ssh_config"
+    )
+    assert get_ssh_config_path(
+        {"ssh-config": {"enabled": True, "path": "~/.ssh/assh"}}
+    ) == (Path.home() / ".ssh" / "assh")
+
+
+def test_config_snapshot(tmp_path: Path, mocker):
+    """Tests the parsed config is reused until the file's content changes."""
+    config_path = tmp_path / "config.yaml"
+    config_path.write_text("regions: [eu-west-1]\nprofiles:\n  123456789012:\n")
+
+    assert load_config(config_path) == {
+        "regions": ["eu-west-1"],
+        "profiles": {"123456789012": {}},
+    }
+
+    parse = mocker.spy(assh.config, "_parse_config")
+    assert load_config(config_path)["regions"] == ["eu-west-1"]
+
+    # Touching the file changes its mtime, but not its content
+    os.utime(config_path, ns=(0, 0))
+    assert load_config(config_path)["regions"] == ["eu-west-1"]
+    parse.assert_not_called()
+
+    config_path.write_text("regions: [us-east-1]\n")
+    assert load_config(config_path) == {"regions": ["us-east-1"]}
+    parse.assert_called_once()
+
+
+@pytest.mark.parametrize(
+    "content",
+    [
+        "- not a mapping\n",
+        "regions: eu-west-1\n",
+        "profiles:\n  dev: ~/.ssh/id_dev\n",
+        "global-username-patterns:\n- image-name: .*\n",
+        "roles: [arn:aws:iam::123:user/assh]\n",
+    ],
+)
+def test_invalid_config(tmp_path: Path, content):
+    """Tests malformed sections are reported when the config is loaded."""
+    config_path = tmp_path / "config.yaml"
+    config_path.write_text(content)
+
+    with pytest.raises(ConfigException):
+        load_config(config_path)
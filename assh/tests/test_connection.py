@@ -0,0 +1,34 @@
+"""Tests for building connection settings."""
+import pytest
+
+from assh.connection import resolve_mode
+from assh.exceptions import NoRouteException
+from assh.tests.conftest import KEY_NAME, make_instance
+
+
+def _instance(public_ip=None, ssm_ping=None, keyname=KEY_NAME):
+    return make_instance(keyname=keyname, public_ip=public_ip, ssm_ping=ssm_ping)
+
+
+def test_auto_mode_routing():
+    """Tests auto mode picks a route from the cached SSM status."""
+    assert resolve_mode(_instance(ssm_ping="Online"), "auto", None) == "ssm-ssh"
+    assert resolve_mode(_instance("192.0.2.1", "Online"), "auto", "jump") == "ssh"
+    assert resolve_mode(_instance(ssm_ping="Online", keyname=None), "auto", None) == (
+        "ssm"
+    )
+    assert resolve_mode(_instance("192.0.2.1", "ConnectionLost"), "auto", None) == (
+        "ssh"
+    )
+
+    with pytest.raises(NoRouteException):
+        resolve_mode(_instance(ssm_ping="Unregistered"), "auto", None)
+
+
+def test_ssm_mode_fails_fast():
+    """Tests SSM modes refuse instances known to be unreachable through SSM."""
+    assert resolve_mode(_instance(), "ssm", None) == "ssm"
+    assert resolve_mode(_instance(ssm_ping="Online"), "ssm-ssh", None) == "ssm-ssh"
+
+    with pytest.raises(NoRouteException):
+        resolve_mode(_instance(ssm_ping="Unregistered"), "ssm", None)
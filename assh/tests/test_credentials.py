@@ -0,0 +1,50 @@
+"""Tests for assuming roles and caching their credentials."""
+import json
+import stat
+
+from pathlib import Path
+
+import pytest
+
+from moto import mock_sts
+
+import assh.credentials
+
+from assh.credentials import assume_role, role_account, role_name
+
+ROLE = "arn:aws:iam::111111111111:role/ops/assh"
+
+
+@pytest.fixture(name="sts")
+def fxt_sts():
+    with mock_sts():
+        yield
+
+
+def test_role_arn_parts():
+    """Tests the account and name are read from a role ARN, ignoring its path."""
+    assert role_account(ROLE) == "111111111111"
+    assert role_name(ROLE) == "assh"
+
+
+def test_credentials_are_cached(sts, tmp_path: Path, mocker):
+    """Tests a role is only assumed once, and its credentials kept private."""
+    make_client = mocker.spy(assh.credentials, "make_client")
+
+    credentials = assume_role(None, ROLE, tmp_path)
+    assert assume_role(None, ROLE, tmp_path) == credentials
+
+    make_client.assert_called_once()
+    (path,) = tmp_path.iterdir()
+    assert stat.S_IMODE(path.stat().st_mode) == 0o600
+
+
+def test_expiring_credentials_are_replaced(sts, tmp_path: Path, mocker):
+    """Tests credentials close to expiring are assumed again."""
+    credentials = assume_role(None, ROLE, tmp_path)
+    (path,) = tmp_path.iterdir()
+    path.write_text(json.dumps(dict(credentials, Expiration=0)))
+    make_client = mocker.spy(assh.credentials, "make_client")
+
+    assert assume_role(None, ROLE, tmp_path)["Expiration"] > 0
+    make_client.assert_called_once()
@@ -0,0 +1,82 @@
+"""Tests for the lookup daemon."""
+import datetime
+import fcntl
+import json
+import threading
+import time
+
+from pathlib import Path
+
+from assh import daemon
+from assh.store import write_shard
+
+
+def _wait_for(socket_path: Path):
+    for _ in range(100):
+        if daemon.request({"op": "status"}, socket_path):
+            return
+        time.sleep(0.05)
+    raise TimeoutError("The daemon didn't start")
+
+
+def test_daemon_lookups(tmp_path: Path, monkeypatch):
+    """Tests the daemon answers searches from its inventory until stopped."""
+    monkeypatch.delenv("AWS_PROFILE", raising=False)
+    monkeypatch.delenv("AWS_DEFAULT_PROFILE", raising=False)
+    fetched_at = datetime.datetime.now(datetime.timezone.utc).timestamp()
+    instances = [
+        {
+            "id": f"i-{index:04x}",
+            "state": "running",
+            "type": "t3.micro",
+            "image": "ami-123",
+            "keyname": None,
+            "private_ip": "10.0.0.1",
+            "public_ip": None,
+            "tags": {"Name": f"web-{index}"},
+        }
+        for index in range(20)
+    ]
+    write_shard(tmp_path, "default-default", "binary", fetched_at, instances, [])
+    with open(tmp_path / "images.json", "w") as images_file:
+        json.dump({"ami-123": {}}, images_file)
+
+    socket_path = tmp_path / "daemon.sock"
+    assert daemon.find_instances("web", socket_path) is None
+
+    server = threading.Thread(
+        target=daemon.serve, args=(socket_path, tmp_path / "daemon.lock", tmp_path)
+    )
+    server.start()
+    try:
+        _wait_for(socket_path)
+
+        found = daemon.find_instances("web-1", socket_path)
+        assert sorted(instance.name for instance in found) == [
+            "web-1",
+            *(f"web-{index}" for index in range(10, 20)),
+        ]
+        assert daemon.find_instances("i-0003", socket_path)[0].name == "web-3"
+    finally:
+        daemon.request({"op": "stop"}, socket_path)
+        server.join(5)
+
+    assert not server.is_alive()
+    assert not socket_path.exists()
+    assert daemon.find_instances("web", socket_path) is None
+
+
+def test_daemon_is_spawned_once(tmp_path: Path, monkeypatch, mocker):
+    """Tests lookups start the daemon once, and not while another is starting."""
+    monkeypatch.setattr(daemon, "_spawned", False)
+    popen = mocker.patch("subprocess.Popen")
+    lock_path = tmp_path / "daemon.lock"
+
+    with open(lock_path, "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        daemon.spawn(lock_path)
+    popen.assert_not_called()
+
+    daemon.spawn(lock_path)
+    daemon.spawn(lock_path)
+    popen.assert_called_once()
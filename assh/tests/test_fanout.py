@@ -0,0 +1,106 @@
+"""Tests for running commands across many instances."""
+import io
+import sys
+import time
+
+import assh.fanout
+
+from assh.fanout import run_parallel, summarise
+
+
+def _python(code):
+    return [sys.executable, "-c", code]
+
+
+def test_output_is_prefixed_with_host():
+    """Tests every output line is labelled with the host it came from."""
+    stream = io.StringIO()
+    results = run_parallel(
+        [
+            ("web-1", _python("print('one'); print('two')")),
+            ("db", _python("import sys; sys.stderr.write('oops\\n')")),
+        ],
+        stream=stream,
+    )
+
+    assert [result.label for result in results] == ["web-1", "db"]
+    assert all(result.ok for result in results)
+    assert sorted(stream.getvalue().splitlines()) == [
+        "db    | oops",
+        "web-1 | one",
+        "web-1 | two",
+    ]
+
+
+def test_slow_hosts_time_out():
+    """Tests a host which runs past the timeout is killed and reported."""
+    results = run_parallel(
+        [
+            ("fast", _python("pass")),
+            ("slow", _python("import time; time.sleep(30)")),
+            ("broken", _python("raise SystemExit(3)")),
+        ],
+        timeout=1,
+        stream=io.StringIO(),
+    )
+
+    fast, slow, broken = results
+    assert fast.ok
+    assert slow.timed_out and slow.duration < 30
+    assert broken.returncode == 3 and not broken.timed_out
+
+    assert summarise(results) == [
+        "1 succeeded, 1 failed, 1 timed out",
+        "  broken: exit 3",
+        "  slow: timed out after 1s",
+    ]
+
+
+def test_timeouts_kill_what_the_command_started():
+    """Tests a timed out command's children are killed along with it."""
+    start = time.monotonic()
+    (result,) = run_parallel(
+        [("slow", ["sh", "-c", "sleep 4 & wait"])], timeout=0.5, stream=io.StringIO()
+    )
+
+    assert result.timed_out
+    # Otherwise reading its output waits for the orphaned sleep to exit
+    assert time.monotonic() - start < 2
+
+
+def test_commands_can_have_their_own_environment():
+    """Tests an environment given alongside a command is used to run it."""
+    stream = io.StringIO()
+    code = "import os; print(os.environ.get('ASSH_TEST', 'unset'))"
+    run_parallel(
+        [("a", _python(code), {"ASSH_TEST": "set"}), ("b", _python(code))],
+        stream=stream,
+    )
+
+    assert sorted(stream.getvalue().splitlines()) == ["a | set", "b | unset"]
+
+
+def test_failed_hosts_are_retried(tmp_path, mocker):
+    """Tests failing hosts are run again, with progress reported as they finish."""
+    mocker.patch.object(assh.fanout, "RETRY_DELAY", 0)
+    marker = tmp_path / "tried"
+    flaky = f"import os, sys; p = {str(marker)!r}; sys.exit(0 if os.path.exists(p) "
+    flaky += "else open(p, 'w').close() or 1)"
+    progress = io.StringIO()
+
+    results = run_parallel(
+        [("flaky", _python(flaky)), ("broken", _python("raise SystemExit(2)"))],
+        workers=1,
+        stream=io.StringIO(),
+        retries=2,
+        progress=progress,
+    )
+
+    flaky_result, broken = results
+    assert flaky_result.ok and flaky_result.attempts == 2
+    assert broken.attempts == 3
+    assert summarise(results)[1] == "  broken: exit 2 (3 attempts)"
+    assert [line.split(" in ")[0] for line in progress.getvalue().splitlines()] == [
+        "[1/2] flaky: ok",
+        "[2/2] broken: failed",
+    ]
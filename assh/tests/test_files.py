@@ -0,0 +1,33 @@
+"""Tests for files shared between assh processes."""
+import json
+import os
+
+from pathlib import Path
+
+from assh.files import atomic_write, update_json
+
+
+def test_atomic_write(tmp_path: Path):
+    """Tests files are replaced whole, with the mode asked for."""
+    path = tmp_path / "secret.json"
+    path.write_text("old")
+
+    atomic_write(path, "new", mode=0o600)
+
+    assert path.read_text() == "new"
+    assert os.stat(path).st_mode & 0o777 == 0o600
+    assert list(tmp_path.iterdir()) == [path]
+
+
+def test_update_json_keeps_other_writes(tmp_path: Path):
+    """Tests a change is applied to what's on disk, not what was loaded earlier."""
+    path = tmp_path / "cache.json"
+    path.write_text(json.dumps({"theirs": 1}))
+
+    def _load():
+        with open(path) as cache_file:
+            return json.load(cache_file)
+
+    saved = update_json(path, _load, lambda cache: cache.update(ours=2))
+
+    assert saved == _load() == {"theirs": 1, "ours": 2}
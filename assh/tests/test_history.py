@@ -0,0 +1,81 @@
+"""Tests for remembering queries and recently used instances."""
+from pathlib import Path
+
+import assh.history
+
+from assh.history import HOUR, History, frecency
+from assh.tests.conftest import make_instance
+
+WEB = make_instance("i-01", "web")
+DB = make_instance("i-02", "db")
+
+
+def test_queries_are_remembered(tmp_path: Path):
+    """Tests queries are remembered however they're spaced or capitalised."""
+    History(tmp_path / "history.json").record("Web  Prod", WEB)
+    history = History(tmp_path / "history.json")
+
+    assert history.remembered("web prod") == "i-01"
+    assert history.remembered("web") is None
+
+
+def test_empty_queries_are_not_remembered(tmp_path: Path):
+    """Tests connecting without a query only counts as a visit."""
+    history = History(tmp_path / "history.json")
+    history.record("", WEB)
+
+    assert history.history["queries"] == {}
+    assert history.last() == "i-01"
+
+
+def test_frecency():
+    """Tests visits count for more the more recently the instance was used."""
+    now = 10 * 24 * HOUR
+
+    assert frecency({"visits": 2, "last": now - 60}, now) == 8
+    assert frecency({"visits": 2, "last": now - 2 * HOUR}, now) == 4
+    assert frecency({"visits": 8, "last": 0}, now) == 2
+
+
+def test_recent_and_last(tmp_path: Path, mocker):
+    """Tests recent hosts are ranked by frecency, and last by time alone."""
+    history = History(tmp_path / "history.json")
+    clock = mocker.patch("time.time", return_value=0)
+    for _ in range(3):
+        history.record("web", WEB)
+    clock.return_value = 2 * HOUR
+    history.record("db", DB)
+
+    assert history.recent() == ["i-01", "i-02"]
+    assert history.last() == "i-02"
+    assert history.last_used() == {"i-01": 0, "i-02": 2 * HOUR}
+
+
+def test_forget(tmp_path: Path):
+    """Tests forgetting an instance drops every query which meant it."""
+    history = History(tmp_path / "history.json")
+    history.record("web", WEB)
+    history.record("w", WEB)
+    history.record("db", DB)
+    history.forget("i-01")
+
+    saved = History(tmp_path / "history.json")
+    assert saved.history["queries"] == {"db": "i-02"}
+    assert saved.recent() == ["i-02"]
+
+
+def test_history_is_bounded(tmp_path: Path, mocker):
+    """Tests the oldest queries and least used hosts are dropped first."""
+    mocker.patch.object(assh.history, "MAX_QUERIES", 2)
+    mocker.patch.object(assh.history, "MAX_HOSTS", 2)
+    history = History(tmp_path / "history.json")
+    history.record("web", WEB)
+    history.record("w", WEB)
+    history.record("db", DB)
+
+    assert history.history["queries"] == {"w": "i-01", "db": "i-02"}
+
+    history.record("app", make_instance("i-03", "app"))
+
+    assert list(history.history["hosts"]) == ["i-01", "i-03"]
+    assert history.history["queries"] == {"app": "i-03"}
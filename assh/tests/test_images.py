@@ -0,0 +1,98 @@
+"""Tests for the AMI metadata cache."""
+import functools
+import threading
+import unittest.mock
+
+from pathlib import Path
+
+import botostubs
+
+from botocore.exceptions import ClientError
+from moto import mock_sts
+
+from assh.credentials import assume_role
+from assh.images import ImageCache
+from assh.instance import Instance
+from assh.tests.conftest import make_instance
+
+
+def test_prefetch_caches_images(
+    ec2: botostubs.EC2, tmp_path: Path, ami_ubuntu, private_aws_instance
+):
+    """Tests prefetched images are persisted and served without API calls."""
+    instance = Instance(private_aws_instance)
+    ImageCache(tmp_path).prefetch([instance])
+
+    assert (tmp_path / "images.json").exists()
+
+    image_cache = ImageCache(tmp_path)
+    with unittest.mock.patch.object(image_cache, "prefetch") as prefetch:
+        assert instance.default_username(image_cache=image_cache) == "ubuntu"
+
+    prefetch.assert_not_called()
+
+
+def test_missing_image_is_remembered(ec2: botostubs.EC2, tmp_path: Path):
+    """Tests images which no longer exist are cached as empty entries."""
+    instance = Instance.from_dict(
+        {
+            "id": "i-123abc",
+            "private_ip": "10.0.0.1",
+            "public_ip": None,
+            "state": "running",
+            "type": "t3.micro",
+            "image": "ami-00000000",
+            "keyname": None,
+            "tags": {},
+        }
+    )
+    image_cache = ImageCache(tmp_path)
+
+    assert instance.default_username(image_cache=image_cache) == "ec2-user"
+    assert ImageCache(tmp_path).images == {"ami-00000000": {}}
+
+
+def test_denied_images_are_skipped(ec2: botostubs.EC2, tmp_path: Path, mocker):
+    """Tests images which can't be described are left to be tried again."""
+    denied = ClientError(
+        {"Error": {"Code": "UnauthorizedOperation", "Message": "Denied"}},
+        "DescribeImages",
+    )
+    describe_images = mocker.patch("assh.images._describe_images", side_effect=denied)
+    instances = [
+        make_instance(f"i-{index}", image="ami-00000000") for index in range(3)
+    ]
+
+    image_cache = ImageCache(tmp_path)
+    image_cache.prefetch(instances)
+
+    # Not asked for again for every instance using it
+    assert [image_cache.get(instance) for instance in instances] == [None] * 3
+    assert describe_images.call_count == 1
+    assert not (tmp_path / "images.json").exists()
+
+    # Whereas a later run tries again
+    ImageCache(tmp_path).prefetch(instances)
+    assert describe_images.call_count == 2
+
+
+def test_prefetch_assumes_roles(ec2: botostubs.EC2, tmp_path: Path, ami_ubuntu, mocker):
+    """Tests images are described for a role without cached credentials."""
+    mocker.patch(
+        "assh.instance.assume_role",
+        functools.partial(assume_role, credentials_dir=tmp_path / "credentials"),
+    )
+    image_id = ami_ubuntu["ImageId"]
+    instance = make_instance(image=image_id, role="arn:aws:iam::111111111111:role/assh")
+    image_cache = ImageCache(tmp_path)
+
+    with mock_sts():
+        # Assuming the role on the collector's loop would wait on it forever
+        prefetch = threading.Thread(
+            target=image_cache.prefetch, args=([instance],), daemon=True
+        )
+        prefetch.start()
+        prefetch.join(timeout=10)
+
+    assert not prefetch.is_alive()
+    assert list(image_cache.images) == [image_id]
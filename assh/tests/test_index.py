@@ -0,0 +1,62 @@
+"""Tests for the instance search index."""
+from assh.index import SearchIndex
+
+INSTANCES = [
+    {"id": "i-0abc123", "tags": {"Name": "web-1", "Role": "frontend"}},
+    {"id": "i-0abd456", "tags": {"Name": "web-2", "Role": "frontend"}},
+    {"id": "i-0fff789", "tags": {"Name": "Database", "Role": "backend"}},
+    {"id": "i-0eee000", "tags": {}},
+]
+
+
+def _ids(index, query):
+    return [INSTANCES[position]["id"] for position in index.search(query)]
+
+
+def test_exact_id():
+    """Tests an exact ID only returns that instance."""
+    index = SearchIndex.build(INSTANCES)
+
+    assert _ids(index, "i-0fff789") == ["i-0fff789"]
+
+
+def test_id_prefix():
+    """Tests ID prefixes are matched."""
+    index = SearchIndex.build(INSTANCES)
+
+    assert _ids(index, "i-0ab") == ["i-0abc123", "i-0abd456"]
+
+
+def test_id_substring():
+    """Tests substrings from the middle of an ID are matched."""
+    index = SearchIndex.build(INSTANCES)
+
+    assert _ids(index, "f789") == ["i-0fff789"]
+
+
+def test_name_substring_is_case_insensitive():
+    """Tests names are matched case insensitively."""
+    index = SearchIndex.build(INSTANCES)
+
+    assert _ids(index, "WEB") == ["i-0abc123", "i-0abd456"]
+    assert _ids(index, "base") == ["i-0fff789"]
+
+
+def test_short_query():
+    """Tests queries shorter than an n-gram still match."""
+    index = SearchIndex.build(INSTANCES)
+
+    assert _ids(index, "-2") == ["i-0abd456"]
+
+
+def test_search_tags():
+    """Tests configured tags are searchable."""
+    assert _ids(SearchIndex.build(INSTANCES), "backend") == []
+    assert _ids(SearchIndex.build(INSTANCES, ["Role"]), "backend") == ["i-0fff789"]
+
+
+def test_no_match():
+    """Tests a query matching nothing returns nothing."""
+    index = SearchIndex.build(INSTANCES)
+
+    assert _ids(index, "lorem ipsum") == []
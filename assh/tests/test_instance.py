@@ -1,9 +1,11 @@
 """Test instance class."""
+import datetime
+
 import botostubs
 
 from pprint import pprint
 
-from assh.instance import Instance, get_instances
+from assh.instance import Instance, get_instances, get_launched_since, iter_instances
 
 from assh.tests.conftest import (
     DEFAULT_INSTANCE_KWARGS,
@@ -42,11 +44,17 @@ def test_serialisation(public_aws_instance, ami_amzn):
         "id": public_aws_instance["InstanceId"],
         "private_ip": public_aws_instance["PrivateIpAddress"],
         "public_ip": public_aws_instance["PublicIpAddress"],
+        "az": public_aws_instance["Placement"]["AvailabilityZone"],
         "state": public_aws_instance["State"]["Name"],
         "type": INSTANCE_TYPE,
         "image": ami_amzn["ImageId"],
         "keyname": KEY_NAME,
         "tags": {"Name": PUBLIC_INSTANCE_NAME},
+        "profile": None,
+        "region": None,
+        "role": None,
+        "account_id": None,
+        "ssm_ping": None,
     }
 
 
@@ -56,11 +64,17 @@ def test_deserialisation():
         "id": "i-123abc",
         "private_ip": "10.0.0.1",
         "public_ip": "1.2.3.4",
+        "az": "eu-west-1a",
         "state": "running",
         "type": INSTANCE_TYPE,
         "image": IMAGE_NAME,
         "keyname": KEY_NAME,
         "tags": {"Name": PUBLIC_INSTANCE_NAME},
+        "profile": "test-profile",
+        "region": "eu-west-1",
+        "role": "arn:aws:iam::111111111111:role/assh",
+        "account_id": "111111111111",
+        "ssm_ping": "ConnectionLost",
     }
 
     instance = Instance.from_dict(instance_dict)
@@ -156,3 +170,76 @@ def test_handles_terminated_instances_gracefully(
 ):
     """Tests that no failures are encountered when parsing terminated instances."""
     get_instances()
+
+
+def test_instance_iteration_only_yields_running(
+    ec2: botostubs.EC2, public_aws_instance, terminated_aws_instance
+):
+    """Tests that instances are streamed and filtered server-side."""
+    instances = iter_instances()
+
+    assert not isinstance(instances, list)
+    assert all(instance.state == "running" for instance in instances)
+
+
+def test_projected_instance_without_optional_fields():
+    """Tests parsing of a projected response with explicit nulls."""
+    instance = Instance(
+        {
+            "InstanceId": "i-123abc",
+            "State": {"Name": "running"},
+            "InstanceType": INSTANCE_TYPE,
+            "ImageId": IMAGE_NAME,
+            "KeyName": None,
+            "PrivateIpAddress": "10.0.0.1",
+            "PublicIpAddress": None,
+            "Tags": None,
+        }
+    )
+
+    assert instance.keyname is None
+    assert instance.public_ip is None
+    assert instance.name == ""
+
+
+def test_instance_has_no_dict():
+    """Tests instances are slotted rather than carrying a __dict__."""
+    instance = Instance.from_fields(
+        "i-123abc", "running", INSTANCE_TYPE, IMAGE_NAME, None, "10.0.0.1", None, {}
+    )
+
+    assert not hasattr(instance, "__dict__")
+
+
+def test_tags_decoded_lazily():
+    """Tests tags stored as JSON are only decoded when accessed."""
+    instance = Instance.from_fields(
+        "i-123abc",
+        "running",
+        INSTANCE_TYPE,
+        IMAGE_NAME,
+        KEY_NAME,
+        "10.0.0.1",
+        None,
+        '{"Name": "Lazy", "Role": "web"}',
+        name="Lazy",
+    )
+
+    assert instance.name == "Lazy"
+    assert isinstance(instance._tags, str)
+
+    assert instance.tags == {"Name": "Lazy", "Role": "web"}
+    assert instance.to_dict()["tags"] == {"Name": "Lazy", "Role": "web"}
+
+
+def test_launched_since_matches_whole_days(mocker):
+    """Tests instances are looked up for every day since, through to today."""
+    iter_instances = mocker.patch("assh.instance.iter_instances", return_value=[])
+    now = datetime.datetime.now(datetime.timezone.utc)
+
+    get_launched_since(since=(now - datetime.timedelta(days=2)).timestamp())
+
+    days = [
+        (now - datetime.timedelta(days=ago)).date().isoformat() for ago in (2, 1, 0)
+    ]
+    assert iter_instances.call_args.kwargs["launched_on"] == days
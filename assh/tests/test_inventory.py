@@ -0,0 +1,65 @@
+"""Tests for rendering the instance cache as an ssh_config."""
+import json
+
+from pathlib import Path
+
+import pytest
+
+from assh.images import ImageCache
+from assh.inventory import render_inventory
+from assh.tests.conftest import KEY_NAME, make_instance
+from assh.usernames import UsernameResolver
+
+
+@pytest.fixture(name="image_cache")
+def fxt_image_cache(tmp_path: Path):
+    with open(tmp_path / "images.json", "w") as images_file:
+        json.dump({"ami-123": {"Name": "ubuntu", "Description": "Ubuntu"}}, images_file)
+    return ImageCache(tmp_path)
+
+
+def _render(config, instances, image_cache):
+    usernames = UsernameResolver(config, image_cache)
+    return render_inventory(config, instances, usernames).configuration
+
+
+def _instance(instance_id, name, **fields):
+    return make_instance(instance_id, name, keyname=KEY_NAME, **fields)
+
+
+def test_render_inventory(image_cache):
+    """Tests each reachable instance gets a Host block, named by ID and Name."""
+    instances = [
+        _instance("i-0001", "bastion", public_ip="192.0.2.1"),
+        _instance("i-0002", "web"),
+        _instance("i-0003", "web", ssm_ping="Online"),
+        _instance("i-0004", "db server"),
+    ]
+    config = {
+        "default-key": "~/.ssh/id_aws",
+        "ssh-config": {"enabled": True, "via": "bastion"},
+    }
+
+    conf = _render(config, instances, image_cache)
+
+    assert list(conf) == ["i-0001 bastion", "i-0002", "i-0003", "i-0004"]
+    assert conf["i-0001 bastion"] == {
+        "HostName": "192.0.2.1",
+        "User": "ubuntu",
+        "IdentityFile": "~/.ssh/id_aws",
+    }
+    assert conf["i-0002"]["HostName"] == "10.0.0.1"
+    assert conf["i-0002"]["ProxyJump"] == "i-0001"
+    assert "ProxyCommand" in conf["i-0003"]
+
+
+def test_unreachable_instances_are_left_out(image_cache):
+    """Tests instances with no known route are skipped without a via host."""
+    instances = [
+        _instance("i-0001", "web", public_ip="192.0.2.1"),
+        _instance("i-0002", "db"),
+    ]
+
+    conf = _render({}, instances, image_cache)
+
+    assert list(conf) == ["i-0001 web"]
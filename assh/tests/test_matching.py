@@ -0,0 +1,75 @@
+"""Tests for ranking instances against a query."""
+import time
+
+import pytest
+
+from assh.matching import exact_match, rank, still_matches
+from assh.tests.conftest import make_instance
+
+
+def _instance(instance_id, name, **tags):
+    return make_instance(instance_id, name, tags=tags)
+
+
+INSTANCES = [
+    _instance("i-01", "api-prod-1", Role="backend"),
+    _instance("i-02", "api-staging-1", Role="backend"),
+    _instance("i-03", "web-prod-1", Role="frontend"),
+    _instance("i-04", "prod-web", Role="frontend"),
+    _instance("i-05", "rapid-test", Role="batch"),
+]
+
+
+def _ids(instances):
+    return [instance.id for instance in instances]
+
+
+@pytest.mark.parametrize(
+    "query,expected",
+    [
+        # Prefixes beat the start of a word, which beats anywhere else
+        ("prod", ["i-04", "i-01", "i-03"]),
+        # Words can match in any order, and in different fields
+        ("prod api", ["i-01"]),
+        ("backend staging", ["i-02"]),
+        # Letters in order, when nothing contains the query as typed
+        ("apstg", ["i-02"]),
+        ("zzz", []),
+    ],
+)
+def test_rank(query, expected):
+    """Tests instances are ranked best first, leaving out non-matches."""
+    assert _ids(rank(INSTANCES, query, tag_keys=["Role"])) == expected
+
+
+def test_rank_keeps_top_results():
+    """Tests only the requested number of results are returned."""
+    assert _ids(rank(INSTANCES, "i-0", limit=2)) == ["i-01", "i-02"]
+
+
+def test_rank_prefers_recently_used():
+    """Tests recently used instances break ties between equal matches."""
+    last_used = {"i-03": time.time()}
+
+    assert _ids(rank(INSTANCES, "prod-1", last_used=last_used))[0] == "i-03"
+
+
+def test_exact_match():
+    """Tests an ID or Name equal to the query is picked out, if it's unique."""
+    assert exact_match(INSTANCES, "PROD-WEB").id == "i-04"
+    assert exact_match(INSTANCES, "prod") is None
+
+
+@pytest.mark.parametrize(
+    "query,expected",
+    [
+        ("web prod", True),
+        ("wbprd", True),
+        ("api", False),
+        ("role=frontend type=t3.*", True),
+        ("role=backend", False),
+    ],
+)
+def test_still_matches(query, expected):
+    """Tests a remembered instance is checked against the query it was for."""
+    assert still_matches(INSTANCES[2], query, ["Role"]) is expected
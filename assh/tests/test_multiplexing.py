@@ -0,0 +1,18 @@
+"""Tests for ControlMaster socket book-keeping."""
+from pathlib import Path
+
+from assh.multiplexing import control_dir, list_masters, register_master
+
+
+def test_exited_masters_are_forgotten(tmp_path: Path):
+    """Tests masters whose socket has gone are cleaned up when listing."""
+    register_master(tmp_path, "cm-test", instance="i-123abc", user="ec2-user")
+
+    assert (control_dir(tmp_path) / "cm-test.json").exists()
+    assert list_masters(tmp_path) == []
+    assert not (control_dir(tmp_path) / "cm-test.json").exists()
+
+
+def test_control_dir_is_private(tmp_path: Path):
+    """Tests the socket directory is only accessible to its owner."""
+    assert control_dir(tmp_path).stat().st_mode & 0o777 == 0o700
@@ -0,0 +1,27 @@
+"""Tests for parsing structured queries."""
+from assh.query import Query, Term, parse_query
+
+
+def test_plain_query_is_kept_as_typed():
+    """Tests queries without terms are searched for exactly as before."""
+    assert parse_query("web  server") == Query((), "web  server")
+
+
+def test_terms_and_text():
+    """Tests key=value words become terms, and the rest free text."""
+    assert parse_query('Env=Prod type=m5.* "Name=web 1" api') == Query(
+        (
+            Term(None, "env", "prod"),
+            Term("type", None, "m5.*"),
+            Term("name", None, "web 1"),
+        ),
+        "api",
+    )
+
+
+def test_tag_prefix_overrides_attributes():
+    """Tests tag: reaches tags whose keys are also attribute names."""
+    (term,) = parse_query("tag:Type=batch").terms
+
+    assert term == Term(None, "type", "batch")
+    assert term.index_prefix == "tag:type="
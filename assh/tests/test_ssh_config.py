@@ -1,6 +1,8 @@
 """Tests which conern SSHConfig"""
 import io
-from assh.ssh_config import SSHConfig
+from pathlib import Path
+
+from assh.ssh_config import SSHConfig, control_socket_name, write_if_changed
 
 
 def test_host_line():
@@ -50,3 +52,40 @@ Host {host_b}
 """
 
     assert content == expected
+
+
+def test_multiplexing():
+    conf = SSHConfig()
+    conf.add_host("destination", HostName="1.2.3.4")
+    conf.enable_multiplexing("destination", "/tmp/cm-test", "5m")
+
+    stream = io.StringIO()
+    conf.write(stream)
+
+    lines = stream.getvalue().split("\n")
+    assert "\tControlMaster auto" in lines
+    assert "\tControlPath /tmp/cm-test" in lines
+    assert "\tControlPersist 5m" in lines
+
+
+def test_control_socket_name_includes_jump_host():
+    destination = {"HostName": "10.0.0.1", "User": "ec2-user"}
+    direct = control_socket_name(destination)
+    via_a = control_socket_name(destination, {"HostName": "1.2.3.4"})
+    via_b = control_socket_name(destination, {"HostName": "5.6.7.8"})
+
+    assert len({direct, via_a, via_b}) == 3
+    assert direct == control_socket_name(dict(destination, IdentityFile="~/.ssh/a"))
+
+
+def test_write_if_changed(tmp_path: Path):
+    """Tests files are only rewritten when their content changes."""
+    path = tmp_path / "ssh_config"
+
+    assert write_if_changed(path, "Host a\n")
+    modified = path.stat().st_mtime_ns
+    assert not write_if_changed(path, "Host a\n")
+    assert path.stat().st_mtime_ns == modified
+
+    assert write_if_changed(path, "Host b\n")
+    assert path.read_text() == "Host b\n"
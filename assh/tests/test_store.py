@@ -0,0 +1,158 @@
+"""Tests for the cache shard formats."""
+from pathlib import Path
+
+import pytest
+
+import assh.store
+
+from assh.store import BinaryShard, read_shard, remove_legacy_cache, write_shard
+
+INSTANCES = [
+    {
+        "id": "i-0abc123",
+        "state": "running",
+        "type": "t3.micro",
+        "image": "ami-123",
+        "keyname": "testkey",
+        "private_ip": "10.0.0.1",
+        "public_ip": "1.2.3.4",
+        "az": "eu-west-1a",
+        "profile": None,
+        "region": "eu-west-1",
+        "role": None,
+        "account_id": "123456789012",
+        "ssm_ping": "Online",
+        "tags": {"Name": "web-1", "Role": "frontend"},
+    },
+    {
+        "id": "i-0def456",
+        "state": "running",
+        "type": "t3.micro",
+        "image": "ami-123",
+        "keyname": None,
+        "private_ip": "10.0.0.2",
+        "public_ip": None,
+        "az": "eu-west-1b",
+        "profile": "prod",
+        "region": "eu-west-1",
+        "role": "arn:aws:iam::111111111111:role/assh",
+        "account_id": "111111111111",
+        "ssm_ping": None,
+        "tags": {"Name": "Datenbank-ü"},
+    },
+]
+
+
+@pytest.mark.parametrize("shard_format", ["binary", "json"])
+def test_round_trip(tmp_path: Path, shard_format):
+    """Tests every record survives being written and read back."""
+    write_shard(tmp_path, "test", shard_format, 123.0, INSTANCES, [])
+    shard = read_shard(tmp_path, "test", shard_format)
+
+    assert shard.fetched_at == 123.0
+    assert len(shard) == 2
+    assert list(shard.records()) == INSTANCES
+
+
+@pytest.mark.parametrize("size", [0, 10, 60, 200, -1])
+def test_damaged_binary_shard(tmp_path: Path, size):
+    """Tests a cut off or damaged shard is ignored, so it's refetched."""
+    write_shard(tmp_path, "test", "binary", 0, INSTANCES, [])
+    path = tmp_path / "instances-test.bin"
+    data = path.read_bytes()
+    path.write_bytes(data[:size] if size >= 0 else data[:-8] + b"\xff" * 8)
+
+    assert read_shard(tmp_path, "test", "binary") is None
+
+
+def test_damaged_json_shard(tmp_path: Path):
+    """Tests a JSON shard which can't be decoded is ignored, so it's refetched."""
+    (tmp_path / "instances-test.json").write_text('{"fetched_at": 0, "inst')
+
+    assert read_shard(tmp_path, "test", "json") is None
+
+
+def test_json_shard_converted_elsewhere(tmp_path: Path, mocker):
+    """Tests a JSON shard removed by another process converting it isn't an error."""
+    write_shard(tmp_path, "test", "json", 0, INSTANCES, [])
+    mocker.patch.object(assh.store.JsonShard, "read", side_effect=FileNotFoundError)
+
+    assert read_shard(tmp_path, "test", "binary") is None
+
+
+def test_truncated_json_shard_is_removed(tmp_path: Path):
+    """Tests a JSON shard which can't be converted is dropped, to be refetched."""
+    (tmp_path / "instances-test.json").write_text('{"fetched_at": 0, "inst')
+
+    assert read_shard(tmp_path, "test", "binary") is None
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_legacy_cache_is_removed(tmp_path: Path):
+    """Tests the single cache file of older versions is cleaned up."""
+    (tmp_path / "instances-default.json").write_text("{}")
+    write_shard(tmp_path, "default-default", "json", 0, INSTANCES, [])
+
+    remove_legacy_cache(tmp_path)
+    remove_legacy_cache(tmp_path)
+
+    assert [path.name for path in tmp_path.iterdir()] == [
+        "instances-default-default.json"
+    ]
+
+
+@pytest.mark.parametrize("shard_format", ["binary", "json"])
+@pytest.mark.parametrize(
+    "query,expected",
+    [("i-0def456", [1]), ("i-0", [0, 1]), ("WEB", [0]), ("bank-ü", [1]), ("zzz", [])],
+)
+def test_search(tmp_path: Path, shard_format, query, expected):
+    """Tests both formats answer queries identically."""
+    shard = write_shard(tmp_path, "test", shard_format, 0, INSTANCES, [])
+
+    assert shard.search_index([]).search(query) == expected
+
+
+def test_binary_search_tags(tmp_path: Path):
+    """Tests configured search tags are indexed in the binary format."""
+    shard = write_shard(tmp_path, "test", "binary", 0, INSTANCES, ["Role"])
+
+    assert shard.search_index(["Role"]).search("front") == [0]
+    assert shard.search_index([]).search("front") == []
+
+
+def test_empty_binary_shard(tmp_path: Path):
+    """Tests a shard without any instances can be written and searched."""
+    shard = write_shard(tmp_path, "test", "binary", 0, [], [])
+
+    assert isinstance(shard, BinaryShard)
+    assert len(shard) == 0
+    assert shard.search_index([]).search("web") == []
+
+
+def test_unreadable_binary_shard(tmp_path: Path):
+    """Tests a shard from another version of assh is ignored."""
+    (tmp_path / "instances-test.bin").write_bytes(b"\0" * 64)
+
+    assert read_shard(tmp_path, "test", "binary") is None
+
+
+@pytest.mark.parametrize("shard_format", ["binary", "json"])
+@pytest.mark.parametrize(
+    "query,expected",
+    [
+        ("az=eu-west-1a", [0]),
+        ("type=t3.* profile=prod", [1]),
+        ("Role=FRONT*", [0]),
+        ("tag:name=web-1", [0]),
+        ("ip=10.0.0.2", [1]),
+        ("id=i-0d*", [1]),
+        ("az=eu-west-1? web", [0]),
+        ("env=prod", []),
+    ],
+)
+def test_structured_search(tmp_path: Path, shard_format, query, expected):
+    """Tests key=value terms select instances by attribute and tag."""
+    shard = write_shard(tmp_path, "test", shard_format, 0, INSTANCES, [])
+
+    assert shard.search_index([]).search(query) == expected
@@ -0,0 +1,72 @@
+"""Tests for timing the phases of a run."""
+import pytest
+
+import assh.cli
+
+from assh import timings
+
+
+@pytest.fixture
+def enabled(monkeypatch):
+    monkeypatch.setattr(timings, "_enabled", True)
+    monkeypatch.setattr(timings, "_spans", [])
+    return timings._spans
+
+
+def test_spans_do_nothing_until_enabled(monkeypatch):
+    """Tests spans aren't recorded unless timing is enabled."""
+    monkeypatch.setattr(timings, "_spans", [])
+
+    with timings.span("search"):
+        pass
+
+    assert timings._spans == []
+
+
+def test_spans_nest(enabled):
+    """Tests spans record their detail and how deeply they're nested."""
+    with timings.span("lookup"):
+        with timings.span("read cache", shards=2):
+            pass
+
+    assert [(span["name"], span["depth"]) for span in enabled] == [
+        ("read cache", 1),
+        ("lookup", 0),
+    ]
+    assert enabled[0]["shards"] == 2
+
+
+def _span(name, start, duration, depth=0, thread="MainThread", **detail):
+    return {
+        "name": name,
+        "start": start,
+        "duration": duration,
+        "depth": depth,
+        "thread": thread,
+        **detail,
+    }
+
+
+def test_breakdown():
+    """Tests the breakdown lists spans in the order they started, indented."""
+    spans = [
+        _span("search", 0.2, 0.001, depth=1),
+        _span("lookup", 0.1, 0.0125),
+        _span("refresh", 0.15, 0.5, thread="refresh_0", shard="default-eu-west-1"),
+    ]
+
+    assert timings.breakdown(spans, 1.5) == [
+        "assh timings, 1500.0 ms in total:",
+        "      12.5 ms  lookup",
+        "     500.0 ms  refresh (shard=default-eu-west-1) [refresh_0]",
+        "       1.0 ms    search",
+    ]
+
+
+def test_group_options_before_default_command():
+    """Tests options for every command can come before a bare query."""
+    context = assh.cli.main.make_context("assh", ["--timings", "web"])
+
+    assert context.params["show_timings"]
+    assert context.protected_args == ["connect"]
+    assert context.args == ["web"]
@@ -0,0 +1,115 @@
+"""Tests for the registry of SSM port forwarding tunnels."""
+import json
+import os
+import socket
+import subprocess
+import sys
+
+from pathlib import Path
+
+import pytest
+
+from assh.exceptions import TunnelException
+from assh.files import atomic_write_json
+from assh.tests.conftest import make_instance
+from assh.tunnels import (
+    _free_port,
+    list_tunnels,
+    open_tunnel,
+    session_command,
+    tunnels_dir,
+)
+
+INSTANCE = make_instance(name="db", profile="prod", region="eu-west-1")
+
+
+def _register(tool_dir: Path, pid: int, local_port: int, **details):
+    details = {
+        "name": "db-5432",
+        "label": "db",
+        "instance": INSTANCE.to_dict(),
+        "remote_host": None,
+        "remote_port": 5432,
+        "local_port": local_port,
+        "restarts": 0,
+        "ready": True,
+        "pid": pid,
+        **details,
+    }
+    atomic_write_json(tunnels_dir(tool_dir) / f"{details['name']}.json", details)
+
+
+def test_session_command():
+    """Tests tunnels forward to the instance, or to a host beyond it."""
+    details = {"instance": INSTANCE.to_dict(), "remote_port": 5432, "local_port": 15432}
+
+    command = session_command(dict(details, remote_host=None))
+    assert command[:8] == [
+        "aws",
+        "--profile",
+        "prod",
+        "--region",
+        "eu-west-1",
+        "ssm",
+        "start-session",
+        "--target",
+    ]
+    assert command[9:11] == ["--document-name", "AWS-StartPortForwardingSession"]
+    assert json.loads(command[-1]) == {
+        "portNumber": ["5432"],
+        "localPortNumber": ["15432"],
+    }
+
+    command = session_command(dict(details, remote_host="db.internal"))
+    assert command[10] == "AWS-StartPortForwardingSessionToRemoteHost"
+    assert json.loads(command[-1])["host"] == ["db.internal"]
+
+
+def test_exited_tunnels_are_forgotten(tmp_path: Path):
+    """Tests tunnels whose supervisor has gone are cleaned up when listing."""
+    finished = subprocess.Popen([sys.executable, "-c", "pass"])
+    finished.wait()
+    _register(tmp_path, finished.pid, 15432)
+
+    assert list_tunnels(tmp_path) == []
+    assert list(tunnels_dir(tmp_path).iterdir()) == []
+
+
+def test_running_tunnel_is_reused(tmp_path: Path):
+    """Tests asking for the same forward again returns the running tunnel."""
+    _register(tmp_path, os.getpid(), 15432)
+
+    details, reused = open_tunnel(tmp_path, INSTANCE, "db", 5432)
+
+    assert reused
+    assert details["local_port"] == 15432
+
+
+def test_tunnel_names_are_unique(tmp_path: Path):
+    """Tests a name in use by a tunnel to somewhere else isn't taken over."""
+    _register(tmp_path, os.getpid(), 15432, remote_port=3306)
+
+    with pytest.raises(TunnelException):
+        open_tunnel(tmp_path, INSTANCE, "db", 5432, name="db-5432")
+
+
+def test_local_port_in_use(tmp_path: Path, mocker):
+    """Tests a local port which is taken is refused before starting a session."""
+    popen = mocker.patch("subprocess.Popen")
+    with socket.socket() as taken:
+        taken.bind(("127.0.0.1", 0))
+        port = taken.getsockname()[1]
+
+        with pytest.raises(TunnelException, match="already in use"):
+            open_tunnel(tmp_path, INSTANCE, "db", 5432, local_port=port)
+    popen.assert_not_called()
+
+
+def test_free_port():
+    """Tests the local port matches the remote one, unless it's in use."""
+    with socket.socket() as taken:
+        taken.bind(("127.0.0.1", 0))
+        port = taken.getsockname()[1]
+
+        assert _free_port(port) != port
+    assert _free_port(port) == port
@@ -0,0 +1,99 @@
+"""Tests for username rule resolution."""
+import json
+
+from pathlib import Path
+
+import pytest
+
+from assh.images import ImageCache
+from assh.tests.conftest import make_instance
+from assh.usernames import UsernameResolver, UsernameRules
+
+UBUNTU = {"Name": "ubuntu-focal-20.04-amd64", "Description": "Canonical, Ubuntu"}
+
+
+def test_earliest_rule_wins():
+    """Tests rules are applied in order, not by where they match in the text."""
+    rules = UsernameRules(
+        [
+            {"username": "first", "image-name": "amd64"},
+            {"username": "second", "image-name": "^ubuntu"},
+            {"username": "third", "description": "canonical"},
+        ]
+    )
+
+    assert rules.resolve(UBUNTU) == "first"
+    assert rules.resolve({"Name": "ubuntu-arm64", "Description": ""}) == "second"
+    assert rules.resolve({"Name": "debian", "Description": "Canonical"}) == "third"
+
+
+def test_description_rule_before_name_rule():
+    """Tests an earlier description rule beats a later image name rule."""
+    rules = UsernameRules(
+        [
+            {"username": "described", "description": "ubuntu"},
+            {"username": "named", "image-name": "ubuntu"},
+        ]
+    )
+
+    assert rules.resolve(UBUNTU) == "described"
+
+
+@pytest.mark.parametrize(
+    "pattern, expected",
+    [
+        (r"(u)b\1ntu", "custom"),
+        (r"(?i)UBUNTU", "custom"),
+        (r"(?P<distro>ubuntu)-(?P=distro)", "other"),
+    ],
+)
+def test_uncombinable_patterns(pattern, expected):
+    """Tests patterns which can't share a regex are still applied in order."""
+    rules = UsernameRules(
+        [
+            {"username": "custom", "image-name": pattern},
+            {"username": "other", "image-name": ".*"},
+        ]
+    )
+
+    assert rules.resolve(UBUNTU) == expected
+
+
+def test_default_usernames():
+    """Tests the built in usernames apply when no rule matches."""
+    rules = UsernameRules([{"username": "custom", "image-name": "^rhel"}])
+
+    assert rules.resolve(UBUNTU) == "ubuntu"
+    assert rules.resolve({"Name": "centos-7", "Description": "CentOS 7"}) == "centos"
+    assert rules.resolve({"Name": "amzn2"}) == "ec2-user"
+
+
+def test_resolutions_are_remembered(tmp_path: Path):
+    """Tests resolved usernames are stored until the username config changes."""
+    with open(tmp_path / "images.json", "w") as images_file:
+        json.dump({"ami-123": UBUNTU}, images_file)
+    instance = make_instance()
+    config = {"global-username-patterns": [{"username": "fred", "image-name": "focal"}]}
+
+    assert UsernameResolver(config, ImageCache(tmp_path)).resolve(instance) == "fred"
+
+    # Served without looking at the image again
+    (tmp_path / "images.json").unlink()
+    assert UsernameResolver(config, ImageCache(tmp_path)).resolve(instance) == "fred"
+
+    with open(tmp_path / "images.json", "w") as images_file:
+        json.dump({"ami-123": UBUNTU}, images_file)
+    resolver = UsernameResolver({}, ImageCache(tmp_path))
+    assert resolver.resolve(instance) == "ubuntu"
+
+
+def test_truncated_files_are_ignored(tmp_path: Path):
+    """Tests cut-off image and username caches are rebuilt rather than failing."""
+    (tmp_path / "images.json").write_text('{"ami-123": {"Na')
+    (tmp_path / "usernames.json").write_text('{"config": "')
+    instance = make_instance()
+    image_cache = ImageCache(tmp_path)
+    image_cache._save({"ami-123": UBUNTU})
+
+    assert UsernameResolver({}, image_cache).resolve(instance) == "ubuntu"
+    assert json.loads((tmp_path / "usernames.json").read_text())["usernames"]
@@ -0,0 +1,125 @@
+"""Optional timing of each phase of a run, to show where the time went.
+
+Code marks its phases with span(), which costs next to nothing until timing
+is enabled. Once enabled, the spans are reported when the process exits.
+"""
+import atexit
+import contextlib
+import datetime
+import json
+import os
+import sys
+import threading
+import time
+
+import assh
+
+from assh.config import TOOL_DIR
+
+TIMINGS_LOG = TOOL_DIR / "timings.jsonl"
+PROFILES_DIR = TOOL_DIR / "profiles"
+
+_enabled = False
+_spans = []
+_local = threading.local()
+
+
+def _record(name: str, start: float, end: float, depth: int, detail: dict):
+    # list.append is atomic, so spans from refresh threads need no lock
+    _spans.append(
+        {
+            "name": name,
+            "start": start - assh.STARTED_AT,
+            "duration": end - start,
+            "depth": depth,
+            "thread": threading.current_thread().name,
+            **detail,
+        }
+    )
+
+
+@contextlib.contextmanager
+def span(name: str, **detail):
+    """Time the body as a phase called name, nested in any enclosing span."""
+    if not _enabled:
+        yield
+        return
+
+    depth = getattr(_local, "depth", 0)
+    _local.depth = depth + 1
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _local.depth = depth
+        _record(name, start, time.perf_counter(), depth, detail)
+
+
+def _label(record: dict) -> str:
+    detail = {
+        key: value
+        for key, value in record.items()
+        if key not in ("name", "start", "duration", "depth", "thread")
+    }
+    label = record["name"]
+    if detail:
+        pairs = ", ".join(f"{key}={value}" for key, value in detail.items())
+        label += f" ({pairs})"
+    if record["thread"] != "MainThread":
+        label += f" [{record['thread']}]"
+    return label
+
+
+def breakdown(spans: list, total: float) -> list:
+    """Lines showing each span's time, indented under the span it's part of."""
+    lines = [f"assh timings, {total * 1000:.1f} ms in total:"]
+    for record in sorted(spans, key=lambda record: record["start"]):
+        indent = "  " * record["depth"]
+        lines.append(f"{record['duration'] * 1000:>10.1f} ms  {indent}{_label(record)}")
+    return lines
+
+
+def _finish(report: bool, log: bool, profiler):
+    total = time.perf_counter() - assh.STARTED_AT
+    now = datetime.datetime.now(datetime.timezone.utc)
+
+    if profiler is not None:
+        profiler.disable()
+        PROFILES_DIR.mkdir(parents=True, exist_ok=True)
+        path = PROFILES_DIR / f"assh-{now:%Y%m%dT%H%M%S}-{os.getpid()}.prof"
+        profiler.dump_stats(str(path))
+        print(f"Profile written to {path}", file=sys.stderr)
+
+    if log:
+        TIMINGS_LOG.parent.mkdir(parents=True, exist_ok=True)
+        record = {"time": now.isoformat(), "total": total, "spans": _spans}
+        with open(TIMINGS_LOG, "a") as log_file:
+            log_file.write(json.dumps(record) + "\n")
+
+    if report:
+        for line in breakdown(_spans, total):
+            print(line, file=sys.stderr)
+
+
+def enable(report: bool = True, log: bool = False, cprofile: bool = False):
+    """Start timing spans, reporting them when the process exits.
+
+    With log, a JSON record of the run is appended to ~/.assh/timings.jsonl.
+    With cprofile, a cProfile dump is written to ~/.assh/profiles.
+    """
+    global _enabled
+    if _enabled:
+        return
+    _enabled = True
+
+    # Everything before this point was spent importing assh
+    _record("import", assh.STARTED_AT, time.perf_counter(), 0, {})
+
+    profiler = None
+    if cprofile:
+        import cProfile
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    atexit.register(_finish, report, log, profiler)
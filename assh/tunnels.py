@@ -0,0 +1,279 @@
+"""Named SSM port forwards which outlive the terminal that started them.
+
+Each tunnel is kept up by its own detached supervisor process, which starts
+the SSM session and starts it again whenever it drops. Tunnels are recorded
+in ~/.assh/tunnels, so asking for the same forward again reuses the one
+already running instead of setting up another session.
+"""
+import datetime
+import json
+import os
+import re
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+from pathlib import Path
+from typing import List, Optional
+
+from assh.connection import aws_cli_args, aws_cli_env
+from assh.exceptions import TunnelException
+from assh.files import atomic_write_json
+from assh.instance import Instance
+
+# Seconds allowed for a new session to start listening on its local port
+START_TIMEOUT = 30
+
+# Printed by session-manager-plugin once the local port is listening
+READY_MARKER = "Waiting for connections"
+
+# Seconds before restarting a session which dropped, doubling each time it
+# drops again soon after starting
+RECONNECT_DELAY = 1
+MAX_RECONNECT_DELAY = 60
+STABLE_AFTER = 60
+
+
+def tunnels_dir(tool_dir: Path) -> Path:
+    path = tool_dir / "tunnels"
+    if not path.exists():
+        os.makedirs(path, mode=0o700)
+    return path
+
+
+def tunnel_name(label: str, remote_port: int) -> str:
+    return re.sub(r"[^\w.-]", "_", f"{label}-{remote_port}")
+
+
+def _read(path: Path) -> Optional[dict]:
+    try:
+        with open(path) as details_file:
+            return json.load(details_file)
+    except (OSError, ValueError):
+        return None
+
+
+def _is_running(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _bind(port: int) -> Optional[int]:
+    """The port bound, or None if it's in use."""
+    with socket.socket() as probe:
+        try:
+            probe.bind(("127.0.0.1", port))
+        except OSError:
+            return None
+        return probe.getsockname()[1]
+
+
+def _free_port(preferred: int) -> int:
+    """The preferred port if nothing's using it, otherwise any free one."""
+    return _bind(preferred) or _bind(0)
+
+
+def _forget(path: Path):
+    for stale in (path, path.with_suffix(".log")):
+        if stale.exists():
+            os.remove(stale)
+
+
+def list_tunnels(tool_dir: Path) -> List[dict]:
+    """List running tunnels, cleaning up after any whose supervisor has exited."""
+    tunnels = []
+    for path in sorted(tunnels_dir(tool_dir).glob("*.json")):
+        details = _read(path)
+        if details is None or not _is_running(details["pid"]):
+            _forget(path)
+            continue
+        tunnels.append(details)
+    return tunnels
+
+
+def close_tunnel(tool_dir: Path, name: str) -> bool:
+    path = tunnels_dir(tool_dir) / f"{name}.json"
+    details = _read(path)
+    closed = details is not None and _is_running(details["pid"])
+    if closed:
+        os.kill(details["pid"], signal.SIGTERM)
+    _forget(path)
+    return closed
+
+
+def session_command(details: dict) -> List[str]:
+    """The AWS CLI command starting the port forward a tunnel describes."""
+    instance = Instance.from_dict(details["instance"])
+    parameters = {
+        "portNumber": [str(details["remote_port"])],
+        "localPortNumber": [str(details["local_port"])],
+    }
+    document = "AWS-StartPortForwardingSession"
+    if details["remote_host"]:
+        # Reach a host beyond the instance, like a database endpoint
+        document = "AWS-StartPortForwardingSessionToRemoteHost"
+        parameters["host"] = [details["remote_host"]]
+
+    return [
+        "aws",
+        *aws_cli_args(instance),
+        "ssm",
+        "start-session",
+        "--target",
+        instance.id,
+        "--document-name",
+        document,
+        "--parameters",
+        json.dumps(parameters),
+    ]
+
+
+def _wait_until_ready(path: Path, is_running, timeout: float = START_TIMEOUT):
+    """Wait for the supervisor to record that its session is listening."""
+    deadline = time.monotonic() + timeout
+    while True:
+        details = _read(path)
+        if details is not None and details.get("ready"):
+            return details
+        if not is_running():
+            raise TunnelException(f"Tunnel {path.stem} exited while starting")
+        if time.monotonic() > deadline:
+            raise TunnelException(
+                f"Tunnel {path.stem} didn't start within {timeout:.0f}s"
+            )
+        time.sleep(0.2)
+
+
+def open_tunnel(
+    tool_dir: Path,
+    instance: Instance,
+    label: str,
+    remote_port: int,
+    local_port: Optional[int] = None,
+    remote_host: Optional[str] = None,
+    name: Optional[str] = None,
+):
+    """Start a tunnel, or reuse a running one forwarding to the same place.
+
+    Returns the tunnel's details, and whether it was already running.
+    """
+    name = name or tunnel_name(label, remote_port)
+    path = tunnels_dir(tool_dir) / f"{name}.json"
+    for running in list_tunnels(tool_dir):
+        same_target = (
+            running["instance"]["id"] == instance.id
+            and running["remote_port"] == remote_port
+            and running["remote_host"] == remote_host
+        )
+        if same_target and local_port in (None, running["local_port"]):
+            # It may be part way through reconnecting
+            running_path = tunnels_dir(tool_dir) / f"{running['name']}.json"
+            details = _wait_until_ready(
+                running_path, lambda: _is_running(running["pid"])
+            )
+            return details, True
+        if running["name"] == name:
+            raise TunnelException(
+                f"Tunnel {name} already forwards somewhere else, choose another name"
+            )
+
+    if local_port is not None and _bind(local_port) is None:
+        raise TunnelException(f"Local port {local_port} is already in use")
+
+    details = {
+        "name": name,
+        "label": label,
+        "instance": instance.to_dict(),
+        "remote_host": remote_host,
+        "remote_port": remote_port,
+        "local_port": local_port or _free_port(remote_port),
+        "created_at": datetime.datetime.now(datetime.timezone.utc).timestamp(),
+        "restarts": 0,
+        "ready": False,
+    }
+
+    # The supervisor records the tunnel itself, so it's never listed without
+    # the process keeping it up
+    supervisor = subprocess.Popen(
+        [sys.executable, "-m", "assh.tunnels", str(path), json.dumps(details)],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        # Detach, so the tunnel outlives the terminal
+        start_new_session=True,
+    )
+    try:
+        details = _wait_until_ready(path, lambda: supervisor.poll() is None)
+    except TunnelException:
+        supervisor.terminate()
+        _forget(path)
+        raise
+    return details, False
+
+
+def supervise(path: Path, details: dict):
+    """Keep a tunnel's session running until the process is terminated."""
+    stopping = threading.Event()
+    session = None
+
+    def _stop(signum, frame):
+        stopping.set()
+        if session is not None:
+            # Along with the session-manager-plugin the AWS CLI started
+            os.killpg(session.pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, _stop)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+    details["pid"] = os.getpid()
+    atomic_write_json(path, details)
+    instance = Instance.from_dict(details["instance"])
+
+    delay = RECONNECT_DELAY
+    with open(path.with_suffix(".log"), "a") as log:
+        # Stopped by close_tunnel, which also forgets the tunnel
+        while not stopping.is_set():
+            started = time.monotonic()
+            session = subprocess.Popen(
+                session_command(details),
+                # Role credentials are renewed for each session, as they expire
+                env=aws_cli_env(instance),
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                stderr=log,
+                start_new_session=True,
+                universal_newlines=True,
+            )
+            for line in session.stdout:
+                log.write(line)
+                log.flush()
+                if READY_MARKER in line and not details["ready"]:
+                    # Whoever started the tunnel waits for this
+                    details["ready"] = True
+                    atomic_write_json(path, details)
+            session.wait()
+            if stopping.is_set() or not path.exists():
+                break
+
+            if time.monotonic() - started > STABLE_AFTER:
+                delay = RECONNECT_DELAY
+            log.write(f"Session exited with {session.returncode}, restarting\n")
+            log.flush()
+            details["restarts"] += 1
+            details["ready"] = False
+            atomic_write_json(path, details)
+
+            stopping.wait(delay)
+            delay = min(delay * 2, MAX_RECONNECT_DELAY)
+
+
+if __name__ == "__main__":
+    supervise(Path(sys.argv[1]), json.loads(sys.argv[2]))
@@ -0,0 +1,165 @@
+"""Resolve login usernames from images and the username-patterns config."""
+import hashlib
+import json
+import re
+
+from typing import Dict, List, Optional
+
+from assh.config import current_profile
+from assh.files import update_json
+
+# Numbered and named backreferences would point at the wrong groups once
+# patterns are combined
+GROUP_REFERENCE = re.compile(r"\\[1-9]|\(\?P=")
+
+
+def _fingerprint(value) -> str:
+    return hashlib.sha1(json.dumps(value, sort_keys=True).encode()).hexdigest()
+
+
+class UsernameRules:
+    """Custom username rules, compiled into one regex per field.
+
+    Rules are checked in order, and the first whose image-name matches the
+    image name, or whose description matches the description, wins. Each
+    combined regex tries every rule's pattern as a lookahead from the start
+    of the text, so the alternative which matches is always the earliest rule
+    rather than the earliest position in the text.
+    """
+
+    def __init__(self, rules: Optional[list] = None):
+        self.rules = rules if isinstance(rules, list) else []
+        self._patterns = {
+            field: self._compile(field) for field in ("image-name", "description")
+        }
+
+    def _compile(self, field: str):
+        alternatives = []
+        for index, rule in enumerate(self.rules):
+            if field not in rule:
+                continue
+            if GROUP_REFERENCE.search(rule[field]):
+                return None
+            alternatives.append(f"(?=(?s:.)*?(?:{rule[field]}))(?P<rule{index}>)")
+
+        if not alternatives:
+            return re.compile(r"(?!)")
+
+        try:
+            return re.compile(r"\A(?:" + "|".join(alternatives) + ")")
+        except re.error:
+            # Patterns using global flags or clashing group names can't be
+            # combined, so they're tried one at a time instead
+            return None
+
+    def _first_match(self, field: str, text: str) -> Optional[int]:
+        combined = self._patterns[field]
+        if combined is not None:
+            match = combined.match(text)
+            return int(match.lastgroup[len("rule") :]) if match else None
+
+        for index, rule in enumerate(self.rules):
+            if field in rule and re.search(rule[field], text):
+                return index
+        return None
+
+    def resolve(self, image: dict) -> str:
+        # Some images come back without a Description key
+        description = image.get("Description", "").lower()
+
+        matched = [
+            index
+            for index in (
+                self._first_match("image-name", image.get("Name", "")),
+                self._first_match("description", description),
+            )
+            if index is not None
+        ]
+        if matched:
+            return self.rules[min(matched)]["username"]
+
+        if "ubuntu" in description:
+            return "ubuntu"
+
+        if "centos" in description:
+            return "centos"
+
+        return "ec2-user"  # Default to amazon linux / RHEL default username
+
+
+_compiled: Dict[str, UsernameRules] = {}
+
+
+def compile_rules(rules: List[dict]) -> UsernameRules:
+    """Compile rules, reusing the result for identical rules in this process."""
+    key = _fingerprint(rules)
+    if key not in _compiled:
+        _compiled[key] = UsernameRules(rules)
+    return _compiled[key]
+
+
+class UsernameResolver:
+    """Resolves usernames with the configured rules, remembering the results.
+
+    Results are stored on disk by rule set and image ID, and are all dropped
+    once the username configuration changes.
+    """
+
+    def __init__(self, config: dict, image_cache):
+        self.config = config
+        self.image_cache = image_cache
+        # Kept alongside the image cache the usernames are resolved from
+        self.path = image_cache.path.parent / "usernames.json"
+        self.config_fingerprint = _fingerprint(
+            [
+                config.get("username-patterns", {}),
+                config.get("global-username-patterns", []),
+            ]
+        )
+        self._usernames = None
+
+    def rules(self, profile: Optional[str]) -> List[dict]:
+        return [
+            *self.config.get("username-patterns", {}).get(profile, []),
+            *self.config.get("global-username-patterns", []),
+        ]
+
+    @property
+    def usernames(self) -> Dict[str, Dict[str, str]]:
+        if self._usernames is None:
+            self._usernames = self._load()
+        return self._usernames
+
+    def _read(self) -> dict:
+        try:
+            with open(self.path) as usernames_file:
+                saved = json.load(usernames_file)
+        except (OSError, ValueError):
+            saved = {}
+
+        # Resolved with other patterns, so they may no longer be right
+        if saved.get("config") != self.config_fingerprint:
+            return {"config": self.config_fingerprint, "usernames": {}}
+        return saved
+
+    def _load(self) -> Dict[str, Dict[str, str]]:
+        return self._read()["usernames"]
+
+    def _save(self, rules_fingerprint: str, image_id: str, username: str):
+        def _change(saved):
+            saved["usernames"].setdefault(rules_fingerprint, {})[image_id] = username
+
+        self._usernames = update_json(self.path, self._read, _change)["usernames"]
+
+    def resolve(self, instance, use_rules: bool = True) -> str:
+        rules = self.rules(instance.profile or current_profile()) if use_rules else []
+        rules_fingerprint = _fingerprint(rules)
+
+        username = self.usernames.get(rules_fingerprint, {}).get(instance.image)
+        if username is None:
+            image = self.image_cache.get(instance)
+            username = compile_rules(rules).resolve(image or {})
+            # Not remembered unless the image was described, so it's retried
+            if image is not None:
+                self._save(rules_fingerprint, instance.image, username)
+        return username
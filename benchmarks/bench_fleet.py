@@ -0,0 +1,268 @@
+"""Benchmark of the cache and lookup paths over synthetic fleets.
+
+Builds an inventory of each size with realistic tags, then times cold and
+warm cache loads, lookups, tab completion, username resolution and Instance
+serialisation against it. Nothing talks to AWS: the cache is written fresh,
+and every path assh uses points into a throwaway home directory.
+
+    python benchmarks/bench_fleet.py [--sizes 1000,10000,100000] [--repeat 5]
+        [--json results.json] [--compare baseline.json] [--tolerance 1.25]
+
+With --json, results are saved along with the assh version, so runs from
+different releases can be compared with --compare. Comparing exits with
+status 1 if any case got slower than the tolerance allows.
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from pathlib import Path
+
+# assh resolves its paths from HOME when it's imported, so HOME has to point
+# at the throwaway directory first
+HOME = Path(tempfile.mkdtemp(prefix="assh-bench-"))
+os.environ["HOME"] = str(HOME)
+for variable in ("AWS_PROFILE", "AWS_DEFAULT_PROFILE"):
+    os.environ.pop(variable, None)
+
+from assh.caching import _shard_name, find_instances, get_instance, get_instances
+from assh.cli import _autocomplete_instances
+from assh.config import CACHE_DIR, Target
+from assh.images import ImageCache
+from assh.instance import Instance
+from assh.store import write_shard
+from assh.usernames import UsernameResolver
+
+CHECKOUT = Path(__file__).resolve().parent.parent
+
+SERVICES = ("api", "web", "worker", "db", "cache", "search", "queue", "auth")
+ENVIRONMENTS = ("production", "staging", "development")
+TEAMS = ("platform", "payments", "identity", "data", "growth")
+TYPES = ("t3.micro", "t3.large", "m5.large", "m5.xlarge", "c5.2xlarge", "r5.large")
+ZONES = ("eu-west-1a", "eu-west-1b", "eu-west-1c")
+IMAGES = {
+    f"ami-{index:017x}": {
+        "Name": name,
+        "Description": description,
+    }
+    for index, (name, description) in enumerate(
+        [
+            (f"amzn2-ami-hvm-2.0.{index}-x86_64-gp2", "Amazon Linux 2 AMI")
+            for index in range(10)
+        ]
+        + [(f"ubuntu/images/focal-{index}", "Canonical, Ubuntu") for index in range(6)]
+        + [(f"bastion-{index}", "Hardened bastion image") for index in range(4)]
+    )
+}
+
+USERNAME_PATTERNS = [
+    {"username": f"svc{index}", "image-name": f"^custom-{index}-"}
+    for index in range(20)
+] + [{"username": "admin", "description": "hardened"}]
+
+
+def _fleet(count: int, seed: int = 0) -> list:
+    """Instances spread over services and teams, tagged like autoscaled fleets."""
+    rng = random.Random(seed)
+    images = sorted(IMAGES)
+    instances = []
+    for index in range(count):
+        service = rng.choice(SERVICES)
+        environment = rng.choice(ENVIRONMENTS)
+        group = f"{service}-{environment}-{rng.randrange(20)}"
+        instances.append(
+            {
+                "id": f"i-{index:017x}",
+                "state": "running",
+                "type": rng.choice(TYPES),
+                "image": rng.choice(images),
+                "keyname": rng.choice((None, "deploy", f"{environment}-key")),
+                "private_ip": f"10.{index >> 16 & 255}.{index >> 8 & 255}"
+                f".{index & 255}",
+                "public_ip": (
+                    f"203.0.{index >> 8 & 255}.{index & 255}"
+                    if rng.random() < 0.1
+                    else None
+                ),
+                "az": rng.choice(ZONES),
+                "profile": None,
+                "region": "eu-west-1",
+                "role": None,
+                "account_id": "123456789012",
+                "ssm_ping": rng.choice(("Online", "Online", "ConnectionLost", None)),
+                "tags": {
+                    "Name": f"{service}-{environment}-{index}",
+                    "Environment": environment,
+                    "Role": service,
+                    "Team": rng.choice(TEAMS),
+                    "Service": service,
+                    "CostCenter": f"cc-{rng.randrange(40):03d}",
+                    "aws:autoscaling:groupName": group,
+                    "aws:cloudformation:stack-name": f"{group}-stack",
+                },
+            }
+        )
+    return instances
+
+
+def _timed(function):
+    def _run() -> float:
+        start = time.perf_counter()
+        function()
+        return time.perf_counter() - start
+
+    return _run
+
+
+COLD_LOAD = """
+import sys, time
+from pathlib import Path
+from assh.caching import get_instances
+start = time.perf_counter()
+get_instances(Path(sys.argv[1]), ttl=float("inf"))
+print(time.perf_counter() - start)
+"""
+
+
+def _cold_load() -> float:
+    """Time loading the cache in a fresh interpreter, with nothing in memory."""
+    env = dict(os.environ, PYTHONPATH=str(CHECKOUT))
+    result = subprocess.run(
+        [sys.executable, "-c", COLD_LOAD, str(CACHE_DIR)],
+        env=env,
+        stdout=subprocess.PIPE,
+        check=True,
+        universal_newlines=True,
+    )
+    return float(result.stdout)
+
+
+def _prepare(instances: list):
+    shutil.rmtree(HOME / ".assh", ignore_errors=True)
+    CACHE_DIR.mkdir(parents=True)
+    fetched_at = datetime.datetime.now(datetime.timezone.utc).timestamp()
+    write_shard(CACHE_DIR, _shard_name(Target()), "binary", fetched_at, instances, [])
+    with open(CACHE_DIR / "images.json", "w") as images_file:
+        json.dump(IMAGES, images_file)
+
+
+def _cases(instances: list):
+    """Yield each case, with a function timing one run of it."""
+    # Never expire the cache while benchmarking
+    options = {"ttl": float("inf")}
+    middle = instances[len(instances) // 2]
+    name = middle["tags"]["Name"]
+    config = {"global-username-patterns": USERNAME_PATTERNS}
+    loaded = get_instances(CACHE_DIR, **options)
+    dicts = [instance.to_dict() for instance in loaded]
+
+    yield "cold load", _cold_load
+    yield "warm load", _timed(lambda: get_instances(CACHE_DIR, **options))
+    yield "lookup by id", _timed(
+        lambda: get_instance(CACHE_DIR, middle["id"], **options)
+    )
+    yield "lookup by name", _timed(lambda: get_instance(CACHE_DIR, name, **options))
+    yield "search substring", _timed(
+        lambda: find_instances(CACHE_DIR, "worker-staging", **options)
+    )
+    structured = "environment=production role=db type=m5.*"
+    yield "search key=value", _timed(
+        lambda: find_instances(CACHE_DIR, structured, **options)
+    )
+    yield "completion", _timed(lambda: _autocomplete_instances(None, [], name[:-1]))
+
+    def _resolve_usernames():
+        resolver = UsernameResolver(config, ImageCache(CACHE_DIR))
+        for instance in loaded[:1000]:
+            resolver.resolve(instance)
+
+    def _cold_usernames():
+        memo = CACHE_DIR / "usernames.json"
+        if memo.exists():
+            memo.unlink()
+        _resolve_usernames()
+
+    yield "usernames (cold)", _timed(_cold_usernames)
+    yield "usernames (warm)", _timed(_resolve_usernames)
+    yield "Instance.to_dict", _timed(lambda: [item.to_dict() for item in loaded])
+    yield "Instance.from_dict", _timed(
+        lambda: [Instance.from_dict(item) for item in dicts]
+    )
+
+
+def run(sizes, repeat: int) -> list:
+    results = []
+    for size in sizes:
+        instances = _fleet(size)
+        _prepare(instances)
+        for case, timer in _cases(instances):
+            seconds = statistics.median(timer() for _ in range(repeat))
+            results.append({"size": size, "case": case, "seconds": seconds})
+            print(f"{size:>8}  {case:<20}{seconds * 1000:>12.2f} ms", flush=True)
+    return results
+
+
+def compare(results: list, baseline: dict, tolerance: float) -> bool:
+    """Print each case's change from the baseline, returning False on regressions."""
+    before = {
+        (item["size"], item["case"]): item["seconds"] for item in baseline["results"]
+    }
+    print(f"\nCompared with assh {baseline['version']}:")
+
+    ok = True
+    for item in results:
+        previous = before.get((item["size"], item["case"]))
+        if not previous:
+            continue
+        ratio = item["seconds"] / previous
+        regressed = ratio > tolerance
+        ok = ok and not regressed
+        print(
+            f"{item['size']:>8}  {item['case']:<20}{ratio:>8.2f}x"
+            f"{'  REGRESSION' if regressed else ''}"
+        )
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default="1000,10000,100000")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--json", type=Path, help="Save the results here")
+    parser.add_argument("--compare", type=Path, help="Results to compare against")
+    parser.add_argument(
+        "--tolerance", type=float, default=1.25, help="Slowdown allowed by --compare"
+    )
+    args = parser.parse_args()
+
+    try:
+        results = run([int(size) for size in args.sizes.split(",")], args.repeat)
+    finally:
+        shutil.rmtree(HOME, ignore_errors=True)
+
+    report = {
+        "version": (CHECKOUT / "VERSION").read_text().strip(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "results": results,
+    }
+    if args.json:
+        args.json.write_text(json.dumps(report, indent=2))
+
+    if args.compare:
+        baseline = json.loads(args.compare.read_text())
+        if not compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
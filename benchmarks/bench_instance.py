@@ -0,0 +1,126 @@
+"""Microbenchmark of Instance memory use and construction time.
+
+Compares the slotted, lazily tagged Instance against the previous
+implementation, which kept a __dict__, built its tags eagerly and went
+through an AWS-shaped dict in from_dict.
+
+    python benchmarks/bench_instance.py [--count 10000]
+"""
+import argparse
+import gc
+import json
+import time
+import tracemalloc
+
+from assh.instance import Instance
+
+
+class LegacyInstance:
+    def __init__(self, aws_instance):
+        self.id = aws_instance["InstanceId"]
+        self.state = aws_instance["State"]["Name"]
+        self.type = aws_instance["InstanceType"]
+        self.image = aws_instance["ImageId"]
+        self.keyname = aws_instance.get("KeyName")
+        self.private_ip = aws_instance["PrivateIpAddress"]
+        self.public_ip = aws_instance.get("PublicIpAddress")
+        self.tags = {
+            pair["Key"]: pair["Value"] for pair in aws_instance.get("Tags", [])
+        }
+
+    @classmethod
+    def from_dict(cls, instance_dict):
+        return cls(
+            {
+                "InstanceId": instance_dict["id"],
+                "State": {"Name": instance_dict["state"]},
+                "InstanceType": instance_dict["type"],
+                "ImageId": instance_dict["image"],
+                "KeyName": instance_dict["keyname"],
+                "PrivateIpAddress": instance_dict["private_ip"],
+                "PublicIpAddress": instance_dict["public_ip"],
+                "Tags": [
+                    {"Key": key, "Value": value}
+                    for key, value in instance_dict["tags"].items()
+                ],
+            }
+        )
+
+
+def _records(count):
+    return [
+        {
+            "id": f"i-{index:017x}",
+            "state": "running",
+            "type": "m5.large",
+            "image": "ami-0123456789abcdef0",
+            "keyname": "deploy",
+            "private_ip": f"10.{index >> 16 & 255}.{index >> 8 & 255}.{index & 255}",
+            "public_ip": None,
+            "profile": None,
+            "region": "eu-west-1",
+            "tags": {
+                "Name": f"web-{index}",
+                "Environment": "production",
+                "Role": "web",
+                "Team": "platform",
+            },
+        }
+        for index in range(count)
+    ]
+
+
+def _from_binary_fields(record):
+    # As the binary cache hands them over: tags still encoded, name alongside
+    return Instance.from_fields(
+        record["id"],
+        record["state"],
+        record["type"],
+        record["image"],
+        record["keyname"],
+        record["private_ip"],
+        record["public_ip"],
+        record["tags_json"],
+        profile=record["profile"],
+        region=record["region"],
+        name=record["tags"]["Name"],
+    )
+
+
+def _measure(build, records):
+    gc.collect()
+    start = time.perf_counter()
+    instances = [build(record) for record in records]
+    elapsed = time.perf_counter() - start
+
+    del instances
+    gc.collect()
+    tracemalloc.start()
+    instances = [build(record) for record in records]
+    memory, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return elapsed, memory
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--count", type=int, default=10000)
+    args = parser.parse_args()
+
+    records = _records(args.count)
+    for record in records:
+        record["tags_json"] = json.dumps(record["tags"])
+
+    print(f"{'implementation':<28}{'time (ms)':>12}{'memory (KiB)':>16}")
+    for label, build in (
+        ("LegacyInstance.from_dict", LegacyInstance.from_dict),
+        ("Instance.from_dict", Instance.from_dict),
+        ("Instance.from_fields", _from_binary_fields),
+    ):
+        elapsed, memory = _measure(build, records)
+        print(f"{label:<28}{elapsed * 1000:>12.1f}{memory / 1024:>16.1f}")
+
+
+if __name__ == "__main__":
+    main()
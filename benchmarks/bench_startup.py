@@ -0,0 +1,130 @@
+"""Startup benchmark for the completion and cache-hit connect paths.
+
+Each path is run in a fresh interpreter under ``python -X importtime``,
+against a throwaway home directory holding a fresh cache and with ``ssh``
+replaced by a no-op, so nothing talks to AWS or the network.
+
+    python benchmarks/bench_startup.py [--runs 5]
+"""
+import argparse
+import datetime
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from pathlib import Path
+
+from assh.store import write_shard
+
+ENTRYPOINT = "import sys; from assh.cli import main; main(prog_name='assh')"
+
+# Modules which should never be imported when serving from the cache
+HEAVY_MODULES = ("boto3", "botocore", "yaml")
+
+
+def _prepare_home(home: Path):
+    cache_dir = home / ".assh" / "cache"
+    cache_dir.mkdir(parents=True)
+
+    instances = [
+        {
+            "id": f"i-{index:017x}",
+            "state": "running",
+            "type": "t3.micro",
+            "image": "ami-0123456789abcdef0",
+            "keyname": None,
+            "private_ip": "10.0.0.1",
+            "public_ip": "192.0.2.1",
+            "profile": None,
+            "region": None,
+            "tags": {"Name": f"web-{index}"},
+        }
+        for index in range(1000)
+    ]
+    fetched_at = datetime.datetime.now(datetime.timezone.utc).timestamp()
+    write_shard(cache_dir, "default-default", "binary", fetched_at, instances, [])
+
+    with open(cache_dir / "images.json", "w") as images_file:
+        json.dump(
+            {"ami-0123456789abcdef0": {"Name": "al2", "Description": ""}}, images_file
+        )
+
+    bin_dir = home / "bin"
+    bin_dir.mkdir()
+    fake_ssh = bin_dir / "ssh"
+    fake_ssh.write_text("#!/bin/sh\nexit 0\n")
+    fake_ssh.chmod(0o755)
+
+
+def _run(home: Path, args, extra_env):
+    env = dict(
+        os.environ,
+        HOME=str(home),
+        PATH=f"{home / 'bin'}{os.pathsep}{os.environ['PATH']}",
+        **extra_env,
+    )
+    # Make sure the checkout is benchmarked rather than an installed copy
+    env["PYTHONPATH"] = str(Path(__file__).resolve().parent.parent)
+
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", ENTRYPOINT, *args],
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+    )
+    elapsed = time.perf_counter() - start
+
+    imported = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, module = line.split("|")
+        if cumulative.strip().isdigit():
+            imported[module.strip()] = int(cumulative)
+
+    return elapsed, imported
+
+
+PATHS = {
+    "completion": (
+        [],
+        {"_ASSH_COMPLETE": "complete", "COMP_WORDS": "assh web-12", "COMP_CWORD": "1"},
+    ),
+    "connect": (["web-123"], {}),
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as home:
+        home = Path(home)
+        _prepare_home(home)
+
+        print(f"{'path':<12}{'wall (ms)':>12}{'assh.cli (ms)':>16}  heavy imports")
+        for name, (argv, env) in PATHS.items():
+            walls, imports = [], []
+            for _ in range(args.runs):
+                elapsed, imported = _run(home, argv, env)
+                walls.append(elapsed)
+                imports.append(imported.get("assh.cli", 0))
+
+            heavy = [module for module in HEAVY_MODULES if module in imported]
+            print(
+                f"{name:<12}"
+                f"{statistics.median(walls) * 1000:>12.1f}"
+                f"{statistics.median(imports) / 1000:>16.1f}"
+                f"  {', '.join(heavy) or 'none'}"
+            )
+
+
+if __name__ == "__main__":
+    main()